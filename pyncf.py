@@ -32,8 +32,8 @@ of users and applications, especially in portable environments.
 ## Status
 
 Basic metadata and data extraction functional, but has not been tested very extensively, so likely
-to contain some issues. No file writing implemented yet. Only Classic and 64-bit formats supported so far,
-though NetCDF-4 should be easy to implement. 
+to contain some issues. Files can be written with NetCDFWriter. Classic, 64-bit offset and 64-bit data (CDF-5)
+formats are supported, and NetCDF-4 files can be read (the root group only). 
 
 
 ## Basic usage
@@ -63,6 +63,27 @@ values, by specifying which two dimensions to get your data for and fixing all r
     timelabels = ncfile.read_dimension_values("time")
     datamatrix = ncfile.read_2d_data(ydim="latitude", xdim="longitude", time=43)
 
+For more general access, any N-dimensional subset of a variable can be read as nested lists
+by giving the start index, count and stride for each of its dimensions:
+
+    cube = ncfile.read_slice("temperature", start=[0,0,0], count=[90,73,144], stride=[1,1,1])
+
+Variables can also be accessed as lazy objects that only read data when indexed:
+
+    temperature = ncfile.variables["temperature"]
+    temperature.shape, temperature.dimensions, temperature.attributes
+    cube = temperature[0:90, ::2, ::2]
+
+New files are written by defining their dimensions, attributes and variables, then writing the non-record
+variables and appending the records one at a time:
+
+    with pyncf.NetCDFWriter("derived.nc") as writer:
+        writer.add_dimension("time")
+        writer.add_dimension("latitude", 73)
+        writer.add_variable("temperature", "NC_SHORT", ["time", "latitude"])
+        for values in records:
+            writer.append_record({"temperature": values})
+
 ## Author
 
 Karim Bahgat, 2016
@@ -78,6 +99,38 @@ __version__ = "0.1.0"
 
 
 import struct
+import mmap
+import re
+import glob
+import os
+import sys
+import collections
+import bisect
+import array
+import hashlib
+import threading
+import datetime
+import operator
+import math
+import zlib
+import xml.etree.ElementTree as ElementTree
+import json
+import multiprocessing
+
+try:
+    import cPickle as pickle # much faster on python 2
+except ImportError:
+    import pickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import concurrent.futures as futures # on python 2 requires the futures backport
+except ImportError:
+    futures = None
 
 
 
@@ -86,28 +139,108 @@ import struct
 
 class NetCDF(object):
 
-    def __init__(self, filepath):
-
-        # detect format version
-        with open(filepath, "rb") as fileobj:
-            fileobj.read(3) # skip the first three cdf characters
-            formatcode = fileobj.read(1) # the format code
+    def __init__(self, filepath, use_mmap=False, strict=True, cache=None, mask=True, header_cache=None):
+        """
+        Opens a NetCDF file and reads its header.
+        If use_mmap is True, the file is memory mapped instead of read through a file object,
+        so that data is decoded directly from the page cache without any copying. 
+        If strict is False, names and padding in the header are not validated, for faster opening. 
+        Cache can be a BlockCache that all reads go through, which may be shared between
+        many NetCDF instances (not used when memory mapped). 
+        Mask controls how values equal to a variable's _FillValue or missing_value, or outside
+        its valid_min, valid_max or valid_range, are returned: if True as None, or as masked arrays
+        for numpy output, if "nan" as NaN, and if False they are returned unchanged. 
+        Header_cache can be a directory, or True to use a file next to the NetCDF file, where the parsed
+        header and variable layouts are stored after the first time the file is opened, so that
+        reopening the same unchanged file only needs a quick load instead of parsing the header. 
+        The cache files are pickles, which can run arbitrary code when loaded, so the cache directory
+        must only be writable by trusted users. A cache file that cannot be loaded is ignored and rebuilt,
+and one that cannot be written is skipped. 
+        """
+        if mask not in (True, False, "nan"):
+            raise Exception("Mask must be either True, False or 'nan', not %r" % mask)
+        fileobj = open(filepath, "rb")
+        try:
+            # use the cached header if the file has not changed since it was stored
+            cached = None
+            if header_cache:
+                cachepath = _calc_header_cache_path(filepath, header_cache)
+                stat = os.fstat(fileobj.fileno())
+                cached = _load_header_cache(cachepath, filepath, (stat.st_size, stat.st_mtime))
+
+            # detect format version
+            magic = fileobj.read(8)
             formatcodes = {b"\x01": "classic format",
-                           b"\x02": "64-bit offset format"}
-            formatname = formatcodes[formatcode]
-
-        # initialize backend
-        if formatname in ("classic format", "64-bit offset format"):
-            self._backend = _NetCDFClassicBackend(filepath)
-        else:
-            raise Exception("Could not recognize the NetCDF format version")
-
-        # read the header on startup
-        self.header = self._backend.read_header()
+                           b"\x02": "64-bit offset format",
+                           b"\x05": "64-bit data format"}
+            formatname = None
+            if magic[:3] == b"CDF":
+                formatname = formatcodes.get(magic[3:4]) # the format code after the three cdf characters
+            elif magic == _NetCDF4Backend.SIGNATURE:
+                formatname = "NetCDF-4 format" # an HDF5 file
+
+            # initialize backend
+            if formatname in ("classic format", "64-bit offset format"):
+                if use_mmap:
+                    self._backend = _NetCDFClassicMmapBackend(filepath, fileobj)
+                else:
+                    self._backend = _NetCDFClassicBackend(filepath, cache, fileobj)
+            elif formatname == "64-bit data format":
+                if use_mmap:
+                    self._backend = _NetCDF5MmapBackend(filepath, fileobj)
+                else:
+                    self._backend = _NetCDF5Backend(filepath, cache, fileobj)
+            elif formatname == "NetCDF-4 format":
+                if use_mmap:
+                    self._backend = _NetCDF4MmapBackend(filepath, fileobj)
+                else:
+                    self._backend = _NetCDF4Backend(filepath, cache, fileobj)
+            else:
+                raise Exception("Could not recognize the NetCDF format version")
+
+            self._backend.mask = mask
+
+            # read the header on startup
+            if cached is not None:
+                try:
+                    if cached["header"]["magic"][-1] != formatname:
+                        raise Exception("The cached header is for another format")
+                    self.header = self._backend.load_header(cached["header"], cached["layouts"], cached.get("derived"))
+                except Exception:
+                    cached = None # eg a cache file from an incompatible version, so read and store it again
+            if cached is None:
+                self.header = self._backend.read_header(strict)
+                if header_cache:
+                    _save_header_cache(cachepath, filepath, self._backend)
+        except Exception:
+            # do not leak the file handle of a file that cannot be opened
+            if hasattr(self, "_backend"):
+                self._backend.close()
+            else:
+                fileobj.close()
+            raise
 
         # load backend methods
         self.read_dimension_values = self._backend.read_dimension_values
         self.read_2d_data = self._backend.read_2d_data
+        self.read_slice = self._backend.read_slice
+        self.read_slices = self._backend.read_slices
+        self.read_point_series = self._backend.read_point_series
+        self.read_points = self._backend.read_points
+        self.sel = self._backend.sel
+        self.read_bbox = self._backend.read_bbox
+        self.read_overview = self._backend.read_overview
+        self.build_overviews = self._backend.build_overviews
+        self.read_data_buffer = self._backend.read_data_buffer
+        self.get_memmap = self._backend.get_memmap
+        self.read_dimension_times = self._backend.read_dimension_times
+        self.iter_records = self._backend.iter_records
+        self.aggregate = self._backend.aggregate
+        self.calc_statistics = self._backend.calc_statistics
+        self.get_band_statistics = self._backend.get_band_statistics
+        self.read_pam_statistics = self._backend.read_pam_statistics
+        self.write_pam_statistics = self._backend.write_pam_statistics
+        self.close = self._backend.close
         
         self.get_varinfo = self._backend.get_varinfo
         self.get_varattr = self._backend.get_varattr
@@ -117,6 +250,713 @@ class NetCDF(object):
         self.get_coordinate_variables = self._backend.get_coordinate_variables
         self.get_record_variables = self._backend.get_record_variables
 
+        # lazy variable objects
+        self.variables = collections.OrderedDict((vardict["name"], Variable(self._backend, vardict["name"]))
+                                                 for vardict in self.header["var_list"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MultiNetCDF(object):
+
+    def __init__(self, filepaths, max_open=64, **options):
+        """
+        Opens a collection of NetCDF files with the same dimensions and variables as a single dataset,
+        with their records concatenated along the record dimension, eg one file per month of a reanalysis. 
+        Filepaths is either a list of files in record order, or a glob pattern whose matches are sorted by name. 
+        Each header is read once to check that the files are compatible and to count their records,
+        and a global record index is mapped to a file and a record in that file with a prefix sum of
+        the record counts. At most max_open files are kept open at a time, closing the least recently used,
+        so that collections of thousands of files do not run out of file handles. 
+        Any other options are passed on when opening each file (see NetCDF). 
+        """
+        if isinstance(filepaths, (bytes, type(u""))):
+            filepaths = sorted(glob.glob(filepaths))
+        if not filepaths:
+            raise Exception("Must be given at least one file")
+        if max_open < 1:
+            raise Exception("Must be allowed to keep at least one file open")
+        self.filepaths = list(filepaths)
+        self.max_open = max_open
+        self.options = options
+        self.open_files = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # check that the files match the first one, and count their records
+        self.record_offsets = [0]
+        for fileindex,filepath in enumerate(self.filepaths):
+            ncfile = self.get_file(fileindex)
+            schema = self.calc_schema(ncfile.header)
+            if fileindex == 0:
+                self.header = ncfile.header
+                firstschema = schema
+            elif schema != firstschema:
+                raise Exception("The dimensions or variables of %r do not match those of %r" % (filepath, self.filepaths[0]))
+            self.record_offsets.append(self.record_offsets[-1] + ncfile._backend.numrecs)
+        self.numrecs = self.record_offsets[-1]
+
+        first = self.get_file(0)
+        self.record_dimension = (first.get_record_dimension() or dict()).get("name")
+        self.get_varinfo = first.get_varinfo
+        self.get_varattr = first.get_varattr
+        self.get_diminfo = first.get_diminfo
+        self.get_record_dimension = first.get_record_dimension
+        self.get_nonrecord_variables = first.get_nonrecord_variables
+        self.get_coordinate_variables = first.get_coordinate_variables
+        self.get_record_variables = first.get_record_variables
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            while self.open_files:
+                self.open_files.popitem()[1].close()
+
+    def calc_schema(self, header):
+        dims = tuple((dimdict["name"], dimdict["dim_length"]) for dimdict in header["dim_list"])
+        variables = tuple((vardict["name"], vardict["nc_type"], tuple(vardict["dimids"])) for vardict in header["var_list"])
+        return dims, variables
+
+    def get_file(self, fileindex):
+        """
+        Returns the opened NetCDF file at the given index, opening it if needed and closing
+        the least recently used file if too many are open. 
+        """
+        filepath = self.filepaths[fileindex]
+        with self.lock:
+            ncfile = self.open_files.pop(filepath, None)
+            if ncfile is None:
+                ncfile = NetCDF(filepath, **self.options)
+            self.open_files[filepath] = ncfile
+            while len(self.open_files) > self.max_open:
+                self.open_files.popitem(last=False)[1].close()
+        return ncfile
+
+    def locate_record(self, index):
+        """
+        Maps a global record index to the index of the file it is in and the record index within that file. 
+        """
+        if not 0 <= index < self.numrecs:
+            raise Exception("Record %s is outside the %s records" % (index, self.numrecs))
+        fileindex = bisect.bisect_right(self.record_offsets, index) - 1
+        return fileindex, index - self.record_offsets[fileindex]
+
+    def calc_record_pieces(self, start, count, stride):
+        """
+        Splits a strided range of global record indexes into the range in each file it spans. 
+        Returns a list of (file index, local start, count) tuples. 
+        """
+        pieces = []
+        k = 0
+        while k < count:
+            fileindex, localstart = self.locate_record(start + k * stride)
+            filenrecs = self.record_offsets[fileindex+1] - self.record_offsets[fileindex]
+            n = min(count - k, (filenrecs - localstart + stride - 1) // stride)
+            pieces.append((fileindex, localstart, n))
+            k += n
+        return pieces
+
+    def join_records(self, pieces, output):
+        """
+        Concatenates the results read from each file along their first dimension. 
+        """
+        if len(pieces) == 1:
+            return pieces[0]
+        elif output == "numpy":
+            return numpy.ma.concatenate(pieces) if isinstance(pieces[0], numpy.ma.MaskedArray) else numpy.concatenate(pieces)
+        elif output in ("array", "packed"):
+            values = pieces[0].__class__(pieces[0].typecode)
+            for piece in pieces:
+                values.extend(piece)
+            shape = (sum(piece.shape[0] for piece in pieces),) + tuple(pieces[0].shape[1:])
+            self.get_file(0)._backend.set_array_shape(values, getattr(pieces[0], "_layout", None), shape)
+            return values
+        else:
+            values = []
+            for piece in pieces:
+                values.extend(piece)
+            return values
+
+    def read_dimension_values(self, dimname):
+        """
+        Reads the values of a dimension's coordinate variable, which for the record dimension
+        are concatenated from all the files. 
+        """
+        if dimname != self.record_dimension:
+            return self.get_file(0).read_dimension_values(dimname)
+        values = []
+        for fileindex in range(len(self.filepaths)):
+            values.extend(self.get_file(fileindex).read_dimension_values(dimname))
+        return values
+
+    def read_slice(self, varname, start=None, count=None, stride=None, output="list"):
+        """
+        Same as NetCDF.read_slice, but where the record dimension spans all the files, so that
+        a slice crossing file boundaries is read from each file in turn and joined. 
+        """
+        first = self.get_file(0)
+        layout = first._backend.get_layout(varname)
+        if not layout.recvar:
+            return first.read_slice(varname, start, count, stride, output)
+
+        dimlengths = (self.numrecs,) + tuple(layout.shape[1:])
+        if start is None:
+            start = [0 for _ in dimlengths]
+        if stride is None:
+            stride = [1 for _ in dimlengths]
+        if count is None:
+            count = [(dimlength - index + step - 1) // step for dimlength,index,step in zip(dimlengths,start,stride)]
+        if not len(start) == len(count) == len(stride) == len(dimlengths):
+            raise Exception("Start, count and stride must have one item for each of the variable's %s dimensions" % len(dimlengths))
+        if stride[0] < 1 or start[0] < 0 or (count[0] and start[0] + (count[0]-1)*stride[0] >= self.numrecs):
+            raise Exception("Slice is outside the bounds of the variable's dimensions")
+
+        pieces = [self.get_file(fileindex).read_slice(varname, [localstart] + list(start[1:]), [n] + list(count[1:]), stride, output)
+                  for fileindex,localstart,n in self.calc_record_pieces(start[0], count[0], stride[0])]
+        if not pieces:
+            return first.read_slice(varname, [0] + list(start[1:]), [0] + list(count[1:]), stride, output)
+        return self.join_records(pieces, output)
+
+    def read_point_series(self, varname, output="list", **fixed_indexes):
+        """
+        Same as NetCDF.read_point_series, across all the records of all the files. 
+        """
+        pieces = [self.get_file(fileindex).read_point_series(varname, output, **fixed_indexes)
+                  for fileindex in range(len(self.filepaths))]
+        return self.join_records(pieces, output)
+
+    def read_2d_data(self, varname, xdim="longitude", ydim="latitude", output="list", **extradims):
+        """
+        Same as NetCDF.read_2d_data, where the index of the record dimension is a global record index
+        that is looked up in the file it is in. 
+        """
+        first = self.get_file(0)
+        if not first._backend.get_layout(varname).recvar or self.record_dimension not in extradims:
+            # fixed variables are the same in every file, and a grid along the record dimension is only in one file
+            if self.record_dimension in (xdim, ydim) and len(self.filepaths) > 1:
+                raise Exception("Grids along the record dimension cannot span multiple files, use read_slice instead")
+            return first.read_2d_data(varname, xdim, ydim, output, **extradims)
+        fileindex, localindex = self.locate_record(extradims[self.record_dimension])
+        extradims[self.record_dimension] = localindex
+        return self.get_file(fileindex).read_2d_data(varname, xdim, ydim, output, **extradims)
+
+    def iter_records(self, varnames=None, start=0, stop=None, output="list"):
+        """
+        Same as NetCDF.iter_records, continuing from one file to the next, with global record indexes. 
+        """
+        if stop is None:
+            stop = self.numrecs
+        for fileindex,localstart,n in self.calc_record_pieces(start, max(0, stop - start), 1):
+            offset = self.record_offsets[fileindex]
+            for index,record in self.get_file(fileindex).iter_records(varnames, localstart, localstart + n, output):
+                yield offset + index, record
+
+
+class NetCDFWriter(object):
+
+    def __init__(self, filepath, format="classic format"):
+        """
+        Creates a new NetCDF file, in either the "classic format" or the "64-bit offset format"
+        needed for files larger than 2 GB. 
+        First add the dimensions, attributes and variables, then write the values of the non-record
+        variables and append the records one at a time, and finally close the file. 
+        The header is written with the first values, after which no more definitions can be added. 
+        Non-record variables start out filled with their fill value, so any values that are never
+        written read as missing. 
+        Values are written straight to the file, so large files can be written piece by piece
+        without holding a whole variable in memory. 
+        """
+        self._backend = _NetCDFClassicWriterBackend(filepath, format)
+        self.header = self._backend.header
+
+        # load backend methods
+        self.add_dimension = self._backend.add_dimension
+        self.add_attribute = self._backend.add_attribute
+        self.add_variable = self._backend.add_variable
+        self.write_variable = self._backend.write_variable
+        self.append_record = self._backend.append_record
+        self.close = self._backend.close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Variable(object):
+    """
+    A lightweight proxy for a variable, exposing its metadata from the header
+    and reading only the values needed when indexed like a nested list or numpy array,
+    eg variable[10, 20:40, ::2]. 
+    """
+
+    __slots__ = ("_backend", "name")
+
+    def __init__(self, backend, name):
+        self._backend = backend
+        self.name = name
+
+    def __repr__(self):
+        return "<Variable %s %s %s>" % (self.name, self.dtype, self.shape)
+
+    def __len__(self):
+        if not self.shape:
+            raise TypeError("Scalar variables have no length")
+        return self.shape[0]
+
+    @property
+    def dtype(self):
+        return self._backend.get_layout(self.name).dtype
+
+    @property
+    def shape(self):
+        return self._backend.get_layout(self.name).shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dimensions(self):
+        return self._backend.get_layout(self.name).dimnames
+
+    @property
+    def attributes(self):
+        return dict(self._backend.varattr_index[self.name])
+
+    def __getitem__(self, key):
+        shape = self.shape
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        # expand any ellipsis and missing trailing dimensions to full slices
+        nexplicit = len([item for item in key if item is not Ellipsis])
+        items = []
+        for item in key:
+            if item is Ellipsis:
+                items.extend([slice(None)] * (len(shape) - nexplicit))
+            else:
+                items.append(item)
+        if len(items) > len(shape):
+            raise IndexError("Too many indexes for a variable with %s dimensions" % len(shape))
+        items.extend([slice(None)] * (len(shape) - len(items)))
+
+        if not shape:
+            return self._backend.read_slice(self.name)
+
+        # translate to start, count and stride, remembering which dimensions to drop or reverse
+        start, count, stride, dimflags = [], [], [], []
+        for item,length in zip(items, shape):
+            if isinstance(item, slice):
+                indexes = range(*item.indices(length))
+                step = item.step or 1
+                if not indexes:
+                    start.append(0); count.append(0); stride.append(1)
+                    dimflags.append((False, False))
+                elif step > 0:
+                    start.append(indexes[0]); count.append(len(indexes)); stride.append(step)
+                    dimflags.append((False, False))
+                else:
+                    # negative step, read ascending and reverse afterwards
+                    start.append(indexes[-1]); count.append(len(indexes)); stride.append(-step)
+                    dimflags.append((False, True))
+            else:
+                index = int(item)
+                if index < 0:
+                    index += length
+                if not 0 <= index < length:
+                    raise IndexError("Index %s is out of bounds for a dimension of length %s" % (item, length))
+                start.append(index); count.append(1); stride.append(1)
+                dimflags.append((True, False))
+
+        values = self._backend.read_slice(self.name, start, count, stride)
+        return self._select(values, dimflags)
+
+    def _select(self, values, dimflags):
+        # drop and reverse the dimensions of nested lists, innermost first
+        drop, reverse = dimflags[0]
+        if len(dimflags) > 1:
+            values = [self._select(subvalues, dimflags[1:]) for subvalues in values]
+        if reverse:
+            values = values[::-1]
+        if drop:
+            values = values[0]
+        return values
+
+
+
+class GridArray(array.array):
+    """
+    A compact result container holding all the values of a read in a single flat array.array,
+    returned when output is "array", instead of one list per row and one object per value. 
+    The shape attribute gives the dimensions of the values in row-major order, and row() and rows()
+    give the values along the last dimension. Masked values are NaN. 
+    Supports the buffer protocol, so can be passed directly to eg PIL.Image.frombytes
+    via tobytes(), or to numpy.frombuffer without copying. 
+    """
+
+    def __repr__(self):
+        return "<GridArray %r %s>" % (self.typecode, self.shape)
+
+    def row(self, index):
+        length = self.shape[-1] if self.shape else 1
+        return self[index*length:(index+1)*length]
+
+    def rows(self):
+        length = self.shape[-1] if self.shape else 1
+        return [self[i:i+length] for i in range(0, len(self), length or 1)]
+
+    if not hasattr(array.array, "tobytes"):
+        # older name on python 2
+        def tobytes(self):
+            return self.tostring()
+
+class PackedArray(GridArray):
+    """
+    The raw values of a variable exactly as stored, in a GridArray of the variable's
+    integer or float type, eg array("h") for packed shorts, without scale_factor and add_offset
+    applied or invalid values masked. 
+    The scale_factor, add_offset, missing_values, valid_min and valid_max attributes tell how to decode
+    the values, which can be done in bulk with decode(). 
+    Staying in packed space saves memory and time for eg thresholds and histograms,
+    by comparing the raw values against encode(value) instead of decoding every value. 
+    """
+
+    def __repr__(self):
+        return "<PackedArray %r %s>" % (self.typecode, self.shape)
+
+    @property
+    def scale_factor(self):
+        return self._layout.scale_factor
+
+    @property
+    def add_offset(self):
+        return self._layout.add_offset
+
+    @property
+    def missing_values(self):
+        return self._layout.missing_values
+
+    @property
+    def valid_min(self):
+        return self._layout.valid_min
+
+    @property
+    def valid_max(self):
+        return self._layout.valid_max
+
+    def encode(self, value):
+        """
+        Converts a decoded value to its packed equivalent, by reversing scale_factor and add_offset. 
+        """
+        if self.add_offset is not None:
+            value = value - self.add_offset
+        if self.scale_factor is not None:
+            value = value / float(self.scale_factor)
+        return value
+
+    def decode(self, output="list"):
+        """
+        Masks and applies scale_factor and add_offset to all the values in one pass,
+        returning them as nested lists, or if output is "numpy" a numpy array, or if "array" a GridArray,
+        with the array's shape. 
+        """
+        backend = self._backend
+        if output == "array":
+            values = GridArray("d", backend.decode_values(self._layout, self.tolist(), output))
+            backend.set_array_shape(values, self._layout, self.shape)
+            return values
+        elif output == "numpy":
+            if numpy is None:
+                raise Exception("Reading data as numpy arrays requires the numpy package")
+            values = numpy.frombuffer(self, dtype=self.typecode)
+            return backend.decode_values(self._layout, values, output).reshape(self.shape)
+        elif output == "list":
+            values = backend.decode_values(self._layout, self.tolist())
+            if not self.shape:
+                return values[0]
+            return backend.nest_values(values, self.shape)
+        else:
+            raise Exception("Output must be either 'list', 'numpy' or 'array', not %r" % output)
+
+class BlockCache(object):
+    """
+    A size bounded, least recently used cache of file data, stored as fixed size blocks
+    aligned to multiples of the block size and keyed by file identity and block number. 
+    A single cache can be shared by many NetCDF instances, including of different files,
+    and is safe to use from multiple threads. 
+    Reads larger than half the cache bypass it, so as not to flush everything else. 
+    The hits and misses attributes count the number of blocks found and not found in the cache. 
+    """
+
+    def __init__(self, maxsize=64*1024*1024, blocksize=64*1024):
+        self.maxsize = maxsize
+        self.blocksize = blocksize
+        self.blocks = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<BlockCache %s/%s bytes, %s hits, %s misses>" % (self.size, self.maxsize, self.hits, self.misses)
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.size = 0
+
+    def read(self, fileid, read_file_at, offset, n):
+        """
+        Reads n bytes at an offset of the file identified by fileid, where read_file_at(offset, n)
+        is used to read any blocks not already in the cache. 
+        """
+        if n > self.maxsize // 2:
+            return read_file_at(offset, n)
+
+        blocksize = self.blocksize
+        firstblock = offset // blocksize
+        lastblock = (offset + n - 1) // blocksize if n else firstblock
+
+        with self.lock:
+            found = dict()
+            for blocknum in range(firstblock, lastblock + 1):
+                block = self.blocks.pop((fileid, blocknum), None)
+                if block is not None:
+                    # reinsert as most recently used
+                    self.blocks[(fileid, blocknum)] = block
+                    found[blocknum] = block
+            self.hits += len(found)
+            self.misses += lastblock + 1 - firstblock - len(found)
+
+        # read each consecutive range of missing blocks with a single read
+        blocknum = firstblock
+        while blocknum <= lastblock:
+            if blocknum in found:
+                blocknum += 1
+                continue
+            endnum = blocknum
+            while endnum + 1 <= lastblock and endnum + 1 not in found:
+                endnum += 1
+            raw = read_file_at(blocknum * blocksize, (endnum + 1 - blocknum) * blocksize)
+            for i in range(endnum + 1 - blocknum):
+                found[blocknum + i] = raw[i*blocksize:(i+1)*blocksize]
+            self.store(fileid, [(num, found[num]) for num in range(blocknum, endnum + 1)])
+            blocknum = endnum + 1
+
+        raw = b"".join([found[num] for num in range(firstblock, lastblock + 1)])
+        start = offset - firstblock * blocksize
+        return raw[start:start+n]
+
+    def store(self, fileid, blocks):
+        with self.lock:
+            for blocknum,block in blocks:
+                old = self.blocks.pop((fileid, blocknum), None)
+                if old is not None:
+                    self.size -= len(old)
+                self.blocks[(fileid, blocknum)] = block
+                self.size += len(block)
+            # evict the least recently used blocks
+            while self.size > self.maxsize and self.blocks:
+                _, block = self.blocks.popitem(last=False)
+                self.size -= len(block)
+
+
+
+
+# Internal structures
+
+# everything needed to locate and decode a variable's values, computed once per variable
+_VariableLayout = collections.namedtuple("_VariableLayout", ["name", "dtype", "struct_code", "itemsize",
+                                                             "dimnames", "shape", "product_vector",
+                                                             "recvar", "recsize", "begin", "byte_strides",
+                                                             "scale_factor", "add_offset", "fill_value",
+                                                             "missing_values", "valid_min", "valid_max"])
+
+
+class _CoordinateIndex(object):
+    """
+    Binary search lookups of a coordinate variable's values, which must be monotonic,
+    either increasing or decreasing (such as latitudes going from north to south). 
+    """
+
+    __slots__ = ("name", "keys", "descending")
+
+    def __init__(self, name, values):
+        self.name = name
+        self.descending = len(values) > 1 and values[0] > values[-1]
+        # always search in increasing order
+        self.keys = list(reversed(values)) if self.descending else list(values)
+        if any(( key1 > key2 for key1,key2 in zip(self.keys, self.keys[1:]) )):
+            raise Exception("The %r coordinate variable must be monotonically increasing or decreasing to look up values" % name)
+
+    def to_index(self, i):
+        # position in the increasing keys to index in the coordinate variable
+        if self.descending:
+            return len(self.keys) - 1 - i
+        return i
+
+    def exact(self, label):
+        i = bisect.bisect_left(self.keys, label)
+        if i < len(self.keys) and self.keys[i] == label:
+            return self.to_index(i)
+        raise Exception("Could not find the value %r in the %r coordinate variable" % (label, self.name))
+
+    def nearest(self, label):
+        if not self.keys:
+            raise Exception("The %r coordinate variable is empty" % self.name)
+        i = bisect.bisect_left(self.keys, label)
+        if i == len(self.keys) or (i > 0 and label - self.keys[i-1] <= self.keys[i] - label):
+            i -= 1
+        return self.to_index(i)
+
+    def range(self, minlabel, maxlabel):
+        # a missing bound means no limit
+        i = 0 if minlabel is None else bisect.bisect_left(self.keys, minlabel)
+        j = len(self.keys) if maxlabel is None else bisect.bisect_right(self.keys, maxlabel)
+        j = max(i, j)
+        if self.descending:
+            i, j = len(self.keys) - j, len(self.keys) - i
+        return i, j
+
+
+
+def _find_array_typecode(typecodes, itemsize):
+    # the first array.array typecode with the given size, if any, since sizes vary by platform and version
+    for typecode in typecodes:
+        try:
+            if array.array(typecode).itemsize == itemsize:
+                return typecode
+        except ValueError:
+            pass # not supported, eg "q" on python 2
+    return None
+
+def _calc_header_cache_path(filepath, header_cache):
+    # either next to the file, or in a cache directory named by a hash of the full path
+    if header_cache is True:
+        return filepath + ".hdr"
+    realpath = os.path.realpath(filepath)
+    if not isinstance(realpath, bytes):
+        realpath = realpath.encode("utf8")
+    return os.path.join(header_cache, hashlib.md5(realpath).hexdigest() + ".hdr")
+
+def _load_header_cache(cachepath, filepath, signature):
+    """
+    Returns the header and layouts stored in a header cache file, or None if there is none,
+    it cannot be loaded, or it was stored for another file or an earlier version of the file. 
+    """
+    if not os.path.exists(cachepath):
+        return None
+    try:
+        with open(cachepath, "rb") as fileobj:
+            stored = pickle.loads(fileobj.read())
+        if stored["source"] != signature or stored["path"] != os.path.realpath(filepath):
+            return None
+    except Exception:
+        return None # eg a partly written, corrupt or outdated cache file
+    return stored
+
+def _save_header_cache(cachepath, filepath, backend):
+    stat = os.fstat(backend.fileno) if hasattr(backend, "fileno") else os.stat(filepath)
+    layouts = dict((vardict["name"], backend.get_layout(vardict["name"])) for vardict in backend.header["var_list"])
+    stored = dict(source = (stat.st_size, stat.st_mtime),
+                  path = os.path.realpath(filepath),
+                  header = backend.header,
+                  layouts = layouts,
+                  derived = backend.get_derived(),
+                  )
+    tmppath = "%s.%s.tmp" % (cachepath, os.getpid())
+    try:
+        with open(tmppath, "wb") as fileobj:
+            pickle.dump(stored, fileobj, 2)
+        if os.path.exists(cachepath):
+            os.remove(cachepath) # cannot rename onto an existing file on windows
+        os.rename(tmppath, cachepath)
+    except (IOError, OSError):
+        # eg a read only or missing cache directory, the file is still usable without the cache
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+def _aggregate_records(filepath, varname, firstrecord, keys, records_per_read, options):
+    """
+    Reduces a contiguous range of records of a variable, starting at firstrecord and with
+    the group key of each record in a 1-tuple, or None to skip the record, into the count, sum,
+    min and max of each value in each group. 
+    Runs in a worker process, so opens its own handle to the file, with the same options
+    as the file being aggregated. 
+    """
+    ncfile = NetCDF(filepath, **options)
+    backend = ncfile._backend
+    layout = backend.get_layout(varname)
+    nvalues = 1
+    for dimlength in layout.shape[1:]:
+        nvalues *= dimlength
+
+    accums = dict()
+    for blockstart in range(0, len(keys), records_per_read):
+        nrecords = min(records_per_read, len(keys) - blockstart)
+        start = [firstrecord + blockstart] + [0 for _ in layout.shape[1:]]
+        count = [nrecords] + list(layout.shape[1:])
+        values = backend.read_hyperslab(varname, start, count)
+
+        for i in range(nrecords):
+            if keys[blockstart + i] is None:
+                continue # a record without a valid time
+            key, = keys[blockstart + i]
+            recvalues = values[i*nvalues:(i+1)*nvalues]
+            accum = accums.get(key)
+            if accum is None:
+                accum = accums[key] = dict(count=[0]*nvalues, sum=[0]*nvalues, min=[None]*nvalues, max=[None]*nvalues)
+            if None in recvalues:
+                # masked values are None and are skipped
+                accum["count"] = [n + (value is not None) for n,value in zip(accum["count"], recvalues)]
+                accum["sum"] = [total + value if value is not None else total for total,value in zip(accum["sum"], recvalues)]
+            else:
+                accum["count"] = [n + 1 for n in accum["count"]]
+                accum["sum"] = list(map(operator.add, accum["sum"], recvalues))
+            accum["min"] = list(map(_min_valid, accum["min"], recvalues))
+            accum["max"] = list(map(_max_valid, accum["max"], recvalues))
+
+    ncfile.close()
+    return accums
+
+def _merge_aggregates(partials):
+    merged = dict()
+    for accums in partials:
+        for key,accum in accums.items():
+            total = merged.get(key)
+            if total is None:
+                merged[key] = accum
+            else:
+                total["count"] = list(map(operator.add, total["count"], accum["count"]))
+                total["sum"] = list(map(operator.add, total["sum"], accum["sum"]))
+                total["min"] = list(map(_min_valid, total["min"], accum["min"]))
+                total["max"] = list(map(_max_valid, total["max"], accum["max"]))
+    return merged
+
+def _min_valid(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a if a <= b else b
+
+def _max_valid(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a if a >= b else b
+
 
 
 
@@ -128,6 +968,24 @@ class _NetCDFClassicBackend(object):
     # options
     endian = ">" # big endian
 
+    # read the whole covering span of a strided selection at once
+    # as long as it is no more than this many times the bytes actually needed
+    span_read_ratio = 4
+
+    # when reading values that are far apart, still read them together with
+    # a single read if the gap between them is no more than this many bytes
+    coalesce_gap = 4096
+
+    # initial number of bytes to read when parsing the header, grown as needed
+    header_read_size = 65536
+
+    # header integers
+    non_neg_struct = struct.Struct(">I")
+    att_type_struct = struct.Struct(">4sI")
+
+    # overview files start with a magic string, followed by the length of a json header
+    overview_header_struct = struct.Struct(">I")
+
 
     # Constants
 
@@ -137,6 +995,7 @@ class _NetCDFClassicBackend(object):
     NC_VARIABLE = b"\x00\x00\x00\x0B"
     NC_ATTRIBUTE = b"\x00\x00\x00\x0C"
     PADDING_HEADER = b"\x00"
+    OVERVIEW_MAGIC = b"PYNCFOVR\x01"
 
 
     # Dictionary loopups
@@ -153,12 +1012,28 @@ class _NetCDFClassicBackend(object):
                      }
 
     dtype_sizes = {"NC_BYTE": 1,
-                   "NC_CHAR": 2,
+                   "NC_CHAR": 1,
                    "NC_SHORT": 2,
                    "NC_INT": 4,
                    "NC_FLOAT": 4,
                    "NC_DOUBLE": 8,
                    }
+
+    struct_codes = {"NC_BYTE": "b",
+                    "NC_CHAR": "c",
+                    "NC_SHORT": "h",
+                    "NC_INT": "i",
+                    "NC_FLOAT": "f",
+                    "NC_DOUBLE": "d",
+                    }
+
+    numpy_dtypes = {"NC_BYTE": ">i1",
+                    "NC_CHAR": "S1",
+                    "NC_SHORT": ">i2",
+                    "NC_INT": ">i4",
+                    "NC_FLOAT": ">f4",
+                    "NC_DOUBLE": ">f8",
+                    }
                
     tags = {"STREAMING": STREAMING,
             "ZERO": ZERO,
@@ -169,89 +1044,90 @@ class _NetCDFClassicBackend(object):
             "PADDING_HEADER": PADDING_HEADER,
             }
 
+    # time coordinates
+    time_units_pattern = re.compile(br"\s*(\w+)\s+since\s+(-?\d+)-(\d+)-(\d+)(?:[ T](\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?")
+    time_unit_seconds = {b"second": 1, b"sec": 1, b"minute": 60, b"min": 60, b"hour": 3600, b"hr": 3600, b"day": 86400}
+    time_groupings = {"month": lambda time: time.month,
+                      "season": lambda time: ("DJF","DJF","MAM","MAM","MAM","JJA","JJA","JJA","SON","SON","SON","DJF")[time.month-1],
+                      "year": lambda time: time.year,
+                      "yearmonth": lambda time: (time.year, time.month),
+                      "all": lambda time: None,
+                      }
+
+    # array.array typecodes of each type, for packed output
+    array_typecodes = {"NC_BYTE": "b",
+                       "NC_SHORT": "h",
+                       "NC_INT": "i" if array.array("i").itemsize == 4 else "l",
+                       "NC_FLOAT": "f",
+                       "NC_DOUBLE": "d",
+                       }
+
+    # the maximum number of values to read at a time when computing statistics
+    stats_chunk_size = 1024*1024
+
+    # default fill values of each type, for variables that do not set a _FillValue
+    default_fill_values = {"NC_BYTE": -127,
+                           "NC_CHAR": b"\x00",
+                           "NC_SHORT": -32767,
+                           "NC_INT": -2147483647,
+                           "NC_FLOAT": 9.9692099683868690e+36,
+                           "NC_DOUBLE": 9.9692099683868690e+36,
+                           }
+
+    # how masked values are returned, see NetCDF
+    mask = True
+
+    # names must start with an alphanumeric or underscore, followed by alphanumerics or special characters,
+    # where bytes above 127 are allowed as part of multibyte utf8 encoded characters
+    name_pattern = re.compile(br"[\w\x80-\xff][\w\x80-\xff" + re.escape(b"""_.@+- !"#$%&\()*,:;<=>?[\\]^'{|}~""") + br"]*\Z")
+
 
     ################################################
 
-    def __init__(self, filepath):
-        self.fileobj = open(filepath, "rb")
+    def __init__(self, filepath, cache=None, fileobj=None):
+        self.filepath = filepath
+        self.fileobj = fileobj or open(filepath, "rb")
         self.fileobj.seek(0)
 
+        # optional block cache, where files are identified by path, size and modification time
+        self.cache = cache
+        stat = os.fstat(self.fileobj.fileno())
+        self.fileid = (os.path.realpath(filepath), stat.st_size, stat.st_mtime)
 
-    # Basic reading
-
-    def read_struct_type(self, struct_type, n):
-        fmt = self.endian + bytes(n) + struct_type
-        size = struct.calcsize(fmt)
-        raw = self.read_bytes(size)
-        value = struct.unpack(fmt, raw)
-        if len(value) == 1:
-            value = value[0]
-        return value
-
-    def read_chars(self, n):
-        fmt = self.endian + bytes(n) + "s"
-        size = struct.calcsize(fmt)
-        raw = self.read_bytes(size)
-        value = struct.unpack(fmt, raw)
-        return value[0] # unpack returns a tuple
-
-    def read_short(self, n):
-        value = self.read_struct_type("h", n)
-        return value
-
-    def read_int(self, n):
-        value = self.read_struct_type("i", n)
-        return value
+        # reads at an offset use positional io where available so that threads do not share a file position,
+        # otherwise the seek and read are done together under a lock
+        self.fileno = self.fileobj.fileno()
+        self.lock = threading.Lock()
 
-    def read_float(self, n):
-        value = self.read_struct_type("f", n)
-        return value
 
-    def read_double(self, n):
-        value = self.read_struct_type("d", n)
-        return value
+    # Basic reading
 
-    def read_bytes(self, n):
-        raw = self.fileobj.read(n)
+    def close(self):
+        self.fileobj.close()
+
+    def read_at(self, offset, n):
+        if self.cache is not None:
+            return self.cache.read(self.fileid, self.read_file_at, offset, n)
+        return self.read_file_at(offset, n)
+
+    def read_file_at(self, offset, n):
+        if hasattr(os, "pread"):
+            raw = os.pread(self.fileno, n, offset)
+            # very large reads may return less than requested
+            while len(raw) < n:
+                more = os.pread(self.fileno, n - len(raw), offset + len(raw))
+                if not more:
+                    break
+                raw += more
+        else:
+            with self.lock:
+                self.fileobj.seek(offset, 0)
+                raw = self.fileobj.read(n)
         return raw
 
 
-    # Header specific reading
-
-    def read_chars_header(self, n):
-        value = self.read_chars(n)
-        self.read_size_leftover_padding_header(n)
-        return value
-
-    def read_bytes_header(self, n):
-        value = self.read_bytes(n)
-        self.read_size_leftover_padding_header(n)
-        return value
-
-    def read_short_header(self, n):
-        value = self.read_struct_type("h", n)
-        size = 2 * n   # a single short value is 2 bytes
-        self.read_size_leftover_padding_header(size)
-        return value
-
-
     # Positioning
 
-    def set_checkpoint(self):
-        self.pos = self.fileobj.tell()
-
-    def return_to_checkpoint(self):
-        self.fileobj.seek(self.pos, 0) # absolute position
-
-    def read_size_leftover_padding_header(self, size):
-        remainder = size % 4 # distance to next 4-byte
-        if remainder:
-            padding = 4 - remainder
-            for _ in range(padding):
-                padfound = self.read_tag("PADDING_HEADER")
-                if not padfound:
-                    raise Exception("Attempted to skip a byte as padding, but the byte did not have the padding signature")
-
     def round_nearest_4byte_boundary(self, size):
         padding = self.padding_to_nearest_4byte_boundary(size)
         if padding:
@@ -263,266 +1139,188 @@ class _NetCDFClassicBackend(object):
         if remainder:
             padding = 4 - remainder
             return padding
-        
-    
 
-    # Convenience
-    
-    def read_tag(self, tag):
-        tagcode = self.tags[tag]
-        tagsize = len(tagcode)
-        raw = self.read_bytes(tagsize)
-        if raw == tagcode:
-            return tag
+    ##########
+    # Header
+    ##########
 
-    def read_alternatives(self, *alternatives):
+    # The header is read into a buffer and parsed in a single pass, where each
+    # parse method takes the buffer and a position and returns the parsed value
+    # along with the position right after it. 
+
+    def read_header(self, strict=True):
         """
-        When there are multiple alternative method readings to be tried.
-        Returns the first non-None result.
+        Reads and parses the header into a dictionary structure based exactly on the format specification.
+        If strict is False, names are not validated and header padding is not checked, which
+        is faster but may let some malformed files through. 
         """
-        self.set_checkpoint()
-        
-        for alt in alternatives:
-            result = alt()
-            
-            if result != None:
-                return result
-
-            self.return_to_checkpoint()
-
-        else:
-            raise Exception("Did not find any of the required alternatives.")
-
-
-    # Multi Use
-
-    def read_non_neg(self):
-        return self.read_struct_type("I", 1) #unsigned ints
-
-    def read_nelems(self):
-        return self.read_non_neg()
-
-    def read_name(self):
-        nelems = self.read_nelems()
-        namestring = self.read_namestring(nelems)
-        return namestring
-
-    def read_namestring(self, nelems): 
-        # alternatively just read full string of length nelems
-        namestring = self.read_chars(nelems)
-
-        # check has at least one char
-        assert len(namestring) > 0
-
-        # validate first character
-        self.check_id1(namestring[0])
-
-        # validate subsequent items
-        if len(namestring) > 1:
-            for char in namestring[1:]:
-                self.check_idn(char)
-
-        # possibly decode to utf8
-        # ...
-
-        # skip padding to next 4-byte boundary
-        self.read_size_leftover_padding_header(nelems)
-
-        return namestring
+        self.strict = strict
+
+        # read as much as needed for the full header
+        size = self.header_read_size
+        while True:
+            buf = self.read_at(0, size)
+            try:
+                self.parse_header(buf)
+                break
+            except struct.error:
+                if len(buf) < size:
+                    raise Exception("The file ended before the end of the header")
+                size *= 4
+
+        self.build_indexes()
 
-    def check_id1(self, id1):        
-        if self.check_alphanumeric(id1):
-            pass
-        elif id1 == "_":
-            pass
-        else:
-            raise Exception("ID1 must be either alphanumeric or an underscore")
-
-        return id1
-
-    def check_idn(self, idn):        
-        if self.check_alphanumeric(idn):
-            pass
-        elif idn in "_.@+-": # special 1
-            pass
-        elif idn in """ !"#$%&\()*,:;<=>?[\\]^'{|}~""": # special 2
-            pass
-        else:
-            raise Exception("IDN must be either alphanumeric or a special character of type 1 or 2")
-
-        return idn
-
-    def check_alphanumeric(self, char):
-        if char.isalnum(): # assumes this captures multibyte encoded chars
-            return char
-        else:
-            return False
-
-    def read_nc_type(self):
-        nc_type = self.read_bytes(4)
-        nc_type = self.dtypecodes[nc_type]
-        return nc_type
-
-    def read_values(self, dtype, n):
-        if dtype == "NC_BYTE":
-            values = self.read_bytes_header(n)
-        elif dtype == "NC_CHAR":
-            values = self.read_chars_header(n)
-        elif dtype == "NC_SHORT":
-            values = self.read_short_header(n)
-        else:
-            struct_type = dict(NC_SHORT="h",
-                               NC_INT="i",
-                               NC_FLOAT="f",
-                               NC_DOUBLE="d",
-                               )[dtype]
-            values = self.read_struct_type(struct_type, n)
-        return values
+        return self.header
 
-    ##########
-    # Header
-    ##########
+    def load_header(self, header, layouts, derived=None):
+        """
+        Uses an already parsed header and variable layouts, eg from a header cache, instead of reading them,
+        along with the values derived from the header by build_indexes if given. 
+        """
+        self.strict = True
+        self.header = header
+        self.build_indexes(derived)
+        self.layouts.update(layouts)
+        return self.header
 
-    def read_header(self):
+    def parse_header(self, buf):
         self.header = dict()
-        self.header.update( magic = self.read_magic(),
-                            numrecs = self.read_numrecs()
-                            )
-        self.header.update( dim_list = self.read_dim_list() )
-        self.header.update( gatt_list = self.read_gatt_list() )
-        self.header.update( var_list = self.read_var_list() )
-
-        return self.header
+        magic, pos = self.parse_magic(buf, 0)
+        self.header.update( magic = magic )
+        numrecs, pos = self.parse_numrecs(buf, pos)
+        self.header.update( numrecs = numrecs )
+        dim_list, pos = self.parse_list(buf, pos, "NC_DIMENSION", self.parse_dim)
+        self.header.update( dim_list = dim_list )
+        gatt_list, pos = self.parse_list(buf, pos, "NC_ATTRIBUTE", self.parse_att)
+        self.header.update( gatt_list = gatt_list )
+        var_list, pos = self.parse_list(buf, pos, "NC_VARIABLE", self.parse_var)
+        self.header.update( var_list = var_list )
+        return self.header, pos
 
 
     # MISC
 
-    def read_magic(self):
-        chars = self.read_chars(3)
-        if not chars == "CDF":
+    def parse_magic(self, buf, pos):
+        chars, versioncode = struct.unpack_from("3s1s", buf, pos)
+        if not chars == b"CDF":
             raise Exception("Magic number must start with the characters C, D, F")
-        versioncode = self.read_bytes(1)
         version = self.formatcodes[versioncode]
-        return chars,version
-
-    def read_numrecs(self):
-        numrecs = self.read_alternatives(lambda: self.read_tag("STREAMING"),
-                                         self.read_non_neg,
-                                         )
-        return numrecs
+        return (chars,version), pos + 4
 
+    def parse_numrecs(self, buf, pos):
+        if struct.unpack_from("%is" % len(self.STREAMING), buf, pos)[0] == self.STREAMING:
+            return "STREAMING", pos + len(self.STREAMING)
+        return self.parse_non_neg(buf, pos)
 
-    # DIM LIST
+    def parse_non_neg(self, buf, pos):
+        return self.non_neg_struct.unpack_from(buf, pos)[0], pos + self.non_neg_struct.size
 
-    def read_dim_list(self):
-        tag = self.read_alternatives(lambda: self.read_tag("ABSENT"),
-                                      lambda: self.read_tag("NC_DIMENSION"),
-                                      )
-        if tag == "ABSENT":
-            dim_list = []
-            
-        elif tag == "NC_DIMENSION":
-            nelems = self.read_nelems()
-            dim_list = [self.read_dim() for _ in range(nelems)]
-            
-        return dim_list
-
-    def read_dim(self):
-        dimdict = dict( name = self.read_name(),
-                        dim_length = self.read_dim_length(),
-                        )
-        return dimdict
+    def parse_offset(self, buf, pos):
+        if self.header["magic"][-1] == "classic format":
+            return self.parse_non_neg(buf, pos)
+        elif self.header["magic"][-1] == "64-bit offset format":
+            return struct.unpack_from(">q", buf, pos)[0], pos + 8
+
+    def parse_padding(self, buf, pos, size):
+        padding = -size % 4 # distance to next 4-byte
+        if padding and self.strict:
+            if struct.unpack_from("%is" % padding, buf, pos)[0] != self.PADDING_HEADER * padding:
+                raise Exception("Attempted to skip a byte as padding, but the byte did not have the padding signature")
+        return pos + padding
+
+    def parse_name(self, buf, pos):
+        nelems = self.non_neg_struct.unpack_from(buf, pos)[0]
+        pos += self.non_neg_struct.size
+        name = struct.unpack_from("%is" % nelems, buf, pos)[0]
+        if self.strict:
+            if not self.name_pattern.match(name):
+                raise Exception("Invalid name %r: must start with an alphanumeric or underscore, followed by alphanumerics or special characters" % name)
+            return name, self.parse_padding(buf, pos + nelems, nelems)
+        return name, pos + nelems + (-nelems % 4)
+
+    def parse_nc_type(self, buf, pos):
+        nc_type = self.dtypecodes[struct.unpack_from("4s", buf, pos)[0]]
+        return nc_type, pos + 4
+
+    def parse_values(self, buf, pos, dtype, n):
+        if dtype in ("NC_BYTE", "NC_CHAR"):
+            values = struct.unpack_from("%is" % n, buf, pos)[0]
+        else:
+            values = struct.unpack_from("%s%i%s" % (self.endian, n, self.struct_codes[dtype]), buf, pos)
+            if len(values) == 1:
+                values = values[0]
+        size = n * self.dtype_sizes[dtype]
+        if self.strict:
+            return values, self.parse_padding(buf, pos + size, size)
+        return values, pos + size + (-size % 4)
+
+    def parse_list(self, buf, pos, tag, parse_item):
+        """
+        Lists are either ABSENT (a zero tag and zero elements), or the given tag
+        followed by the number of elements and the elements themselves. 
+        """
+        tagcode = struct.unpack_from("4s", buf, pos)[0]
+        nelems, pos = self.parse_non_neg(buf, pos + 4)
+        if tagcode == self.ZERO and nelems == 0:
+            return [], pos
+        elif tagcode != self.tags[tag]:
+            raise Exception("Expected either ABSENT or %s" % tag)
 
-    def read_dim_length(self):
-        dim_length = self.read_non_neg()
-        return dim_length
+        items = []
+        for _ in range(nelems):
+            item, pos = parse_item(buf, pos)
+            items.append(item)
+        return items, pos
 
 
-    # GATT LIST
+    # DIM LIST
 
-    def read_gatt_list(self):
-        gatt_list = self.read_att_list()
-        return gatt_list
+    def parse_dim(self, buf, pos):
+        name, pos = self.parse_name(buf, pos)
+        dim_length, pos = self.parse_non_neg(buf, pos)
+        dimdict = dict( name = name,
+                        dim_length = dim_length,
+                        )
+        return dimdict, pos
 
 
     # ATT LIST
 
-    def read_att_list(self):
-        tag = self.read_alternatives(lambda: self.read_tag("ABSENT"),
-                                      lambda: self.read_tag("NC_ATTRIBUTE"),
-                                      )
-        if tag == "ABSENT":
-            att_list = []
-            
-        elif tag == "NC_ATTRIBUTE":
-            nelems = self.read_nelems()
-            att_list = [self.read_att() for _ in range(nelems)]
-            
-        return att_list
-
-    def read_att(self):
-        attdict = dict(name = self.read_name(),
-                        nc_type = self.read_nc_type(),
-                        nelems = self.read_nelems(),
+    def parse_att(self, buf, pos):
+        name, pos = self.parse_name(buf, pos)
+        typecode, nelems = self.att_type_struct.unpack_from(buf, pos) # nc_type and nelems together
+        nc_type = self.dtypecodes[typecode]
+        values, pos = self.parse_values(buf, pos + self.att_type_struct.size, nc_type, nelems)
+        attdict = dict( name = name,
+                        nc_type = nc_type,
+                        nelems = nelems,
+                        values = values,
                         )
-        attdict["values"] = self.read_values(attdict["nc_type"], attdict["nelems"])
-        return attdict
+        return attdict, pos
 
 
     # VAR LIST
 
-    def read_var_list(self):
-        tag = self.read_alternatives(lambda: self.read_tag("ABSENT"),
-                                      lambda: self.read_tag("NC_VARIABLE"),
-                                      )
-        if tag == "ABSENT":
-            var_list = []
-            
-        elif tag == "NC_VARIABLE":
-            nelems = self.read_nelems()
-            var_list = [self.read_var() for _ in range(nelems)]
-            
-        return var_list
-
-    def read_var(self):
-        vardict = dict( name = self.read_name(),
-                        nelems = self.read_nelems(),
-                        )
-        vardict.update(
-                        dimids = self.read_dimids(vardict["nelems"]),
-                        vatt_list = self.read_vatt_list(),
-                        nc_type = self.read_nc_type(),
-                        vsize = self.read_vsize(),
-                        begin = self.read_begin(),
+    def parse_var(self, buf, pos):
+        name, pos = self.parse_name(buf, pos)
+        nelems, pos = self.parse_non_neg(buf, pos)
+        dimids = []
+        for _ in range(nelems):
+            dimid, pos = self.parse_non_neg(buf, pos)
+            dimids.append(dimid)
+        vatt_list, pos = self.parse_list(buf, pos, "NC_ATTRIBUTE", self.parse_att)
+        nc_type, pos = self.parse_nc_type(buf, pos)
+        vsize, pos = self.parse_non_neg(buf, pos)
+        begin, pos = self.parse_offset(buf, pos)
+        vardict = dict( name = name,
+                        nelems = nelems,
+                        dimids = dimids,
+                        vatt_list = vatt_list,
+                        nc_type = nc_type,
+                        vsize = vsize,
+                        begin = begin,
                         )
-        return vardict
-
-    def read_dimids(self, nelems):
-        dimids = [self.read_dimid() for _ in range(nelems)]
-        return dimids
-
-    def read_dimid(self):
-        dimid = self.read_non_neg()
-        return dimid
-
-    def read_vatt_list(self):
-        vatt_list = self.read_att_list()
-        return vatt_list
-
-    def read_vsize(self):
-        vsize = self.read_non_neg()
-        return vsize
-
-    def read_begin(self):
-        begin = self.read_offset()
-        return begin
-
-    def read_offset(self):
-        if self.header["magic"][-1] == "classic format":
-            offset = self.read_non_neg()
-        elif self.header["magic"][-1] == "64-bit offset format":
-            offset = self.read_struct_type("q", 1)
-        return offset
+        return vardict, pos
 
     ########
     # Data
@@ -532,199 +1330,1430 @@ class _NetCDFClassicBackend(object):
         """
         Reads the values from a dimension if it has a corresponding coordinate variable. 
         """
-        varinfo = self.get_varinfo(dimname)
-        diminfo = self.get_diminfo(dimname)
-
-        # get dtype
-        dtype = varinfo["nc_type"]
-
-        # read values
-        offset = varinfo["begin"]
-        dim_length = diminfo["dim_length"] or self.header["numrecs"]
+        layout = self.get_layout(dimname)
 
-        self.fileobj.seek(offset, 0)
-        recvar = diminfo["dim_length"] == 0
-        if recvar:
-            recsize = self.calc_recsize()
-            values = []
-            for _ in range(self.header["numrecs"]):
-                values.append(self.read_int(1))
-                self.fileobj.read(recsize) # skip to next record
-        else:
-            values = self.read_values(dtype, dim_length)
+        # read values, which for the record dimension lie at the start of each record
+        values = self.read_strided(layout.begin, layout.dtype, layout.shape, layout.byte_strides)
         
         return values
 
-    def read_2d_data(self, varname, xdim="longitude", ydim="latitude", **extradims):
+    def read_dimension_times(self, dimname):
+        """
+        Reads the values of a time dimension's coordinate variable as datetime objects,
+        based on its units attribute of the form "<units> since <date> [<time>]", 
+        eg "hours since 1900-01-01 00:00:0.0". Only the standard gregorian calendar is supported. 
+        Masked time values are returned as None. 
+        """
+        units = (self.get_varattr(dimname, "units") or b"").rstrip(b"\x00")
+        match = self.time_units_pattern.match(units)
+        if not match:
+            raise Exception("The units of the %r coordinate variable must be of the form '<units> since <date>', not %r" % (dimname, units))
+        unit, year, month, day, hour, minute, second = match.groups()
+        calendar = (self.get_varattr(dimname, "calendar") or b"standard").rstrip(b"\x00").lower()
+        if calendar not in (b"standard", b"gregorian", b"proleptic_gregorian"):
+            raise Exception("Only the standard gregorian calendar is supported, not %r" % calendar)
+
+        unitseconds = self.time_unit_seconds[unit.lower().rstrip(b"s")]
+        epoch = datetime.datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0))
+        epoch += datetime.timedelta(seconds=float(second or 0))
+
+        times = [epoch + datetime.timedelta(seconds=value*unitseconds) if value is not None and value == value else None
+                 for value in self.read_slice(dimname)] # decoded and masked, unlike read_dimension_values
+        return times
+
+    def aggregate(self, varname, stat="mean", groupby="month", max_workers=None, records_per_read=16):
+        """
+        Computes a statistic of a record variable over groups of records binned by the time coordinate
+        of the record dimension, such as monthly climatologies or seasonal means. 
+        Stat is one of "mean", "min", "max", "sum" or "count". Groupby is one of "month" (1-12 across all years),
+        "season" ("DJF", "MAM", "JJA" or "SON" across all years), "year", "yearmonth" ((year, month) tuples)
+        and "all", or a function that takes a datetime and returns a group key. Masked values are skipped,
+        so count gives the number of valid values in each group, as are records whose time is masked. 
+        The records are split into one contiguous range per worker, each reduced in a separate process
+        with its own file handle, and the partial results are merged. A max_workers of 1 runs in this process. 
+        Returns a dictionary of group keys and grids of the statistic in the shape of the variable's
+        remaining dimensions, as nested lists. 
+        """
+        layout = self.get_layout(varname)
+        if not layout.recvar:
+            raise Exception("Can only aggregate record variables")
+        if stat not in ("mean", "min", "max", "sum", "count"):
+            raise Exception("Stat must be one of 'mean', 'min', 'max', 'sum' or 'count', not %r" % stat)
+
+        # the group of each record
+        keyfunc = groupby if callable(groupby) else self.time_groupings[groupby]
+        keys = [(keyfunc(time),) if time is not None else None for time in self.read_dimension_times(layout.dimnames[0])]
+
+        # split into contiguous record ranges
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        nparts = max(1, min(max_workers, len(keys)))
+        bounds = [len(keys) * i // nparts for i in range(nparts + 1)]
+
+        # open the file in each worker the same way, where masked values are None so they can be skipped,
+        # and the block cache can only be shared within this process
+        options = dict(use_mmap = isinstance(self, _NetCDFClassicMmapBackend),
+                       strict = self.strict,
+                       cache = self.cache if nparts == 1 else None,
+                       mask = bool(self.mask),
+                       )
+        tasks = [(self.filepath, varname, bounds[i], keys[bounds[i]:bounds[i+1]], records_per_read, options)
+                 for i in range(nparts)]
+
+        # reduce each range
+        if nparts == 1:
+            partials = [_aggregate_records(*task) for task in tasks]
+        else:
+            if futures is None:
+                raise Exception("Parallel aggregation requires the concurrent.futures module (pip install futures on python 2), or set max_workers to 1")
+            with futures.ProcessPoolExecutor(max_workers=nparts) as executor:
+                partials = list(executor.map(_aggregate_records, *zip(*tasks)))
+
+        # merge and finalize
+        results = dict()
+        for key,accum in _merge_aggregates(partials).items():
+            if stat == "mean":
+                grid = [total / float(n) if n else None for total,n in zip(accum["sum"], accum["count"])]
+            else:
+                grid = accum[stat]
+            if self.mask == "nan":
+                grid = [value if value is not None else float("nan") for value in grid]
+            results[key] = self.nest_values(grid, layout.shape[1:]) if len(layout.shape) > 1 else grid[0]
+
+        return results
+
+    def read_2d_data(self, varname, xdim="longitude", ydim="latitude", output="list", **extradims):
         """
         Extracts a 2-dimensional grid of a variable as a list of lists, with xdim increasing to the right (row values),
         and ydim increasing downwards (rows). 
         Must ensure that extradims keywords fixes all other dimensions at a specified value.
         Xdim and ydim default to longitude and latitude, but it is possible to mix and mash other dimensions,
         just remember to set all remaining extradims. 
+        If output is "numpy", returns a 2d numpy array instead (requires numpy), if "array" a GridArray
+        with shape (rows, columns), or if "packed" a PackedArray of the raw undecoded values. 
         """
-        varinfo = self.get_varinfo(varname)
-        xdiminfo = self.get_diminfo(xdim)
-        ydiminfo = self.get_diminfo(ydim)
-
-        # get dtype and size
-        dtype = varinfo["nc_type"]
-        dtypesize = self.dtype_sizes[dtype]
-
-        # detect if record variable
-        recvar = varinfo["name"] in (rv["name"] for rv in self.get_record_variables())
-
-        # however, dont treat as record variable if using the record dimension as one of the two dimensions to extract
-        firstdim = self.header["dim_list"][varinfo["dimids"][0]]
-        recvar = firstdim["name"] not in (xdim,ydim)
-
-        # calculate record size
-        if recvar:
-            recsize = self.calc_recsize()
-
-        # TODO: something to do with padding after each record if only one record variable
-        # ...
+        layout = self.get_layout(varname)
+        xdimlength = layout.shape[layout.dimnames.index(xdim)]
+        ydimlength = layout.shape[layout.dimnames.index(ydim)]
+        rows = self.read_2d_window(varname, xdim, ydim, 0, xdimlength, 0, ydimlength, output, extradims)
+        return rows
 
-        # calculate product vector
-        product_vector = self.calc_product_vector(varname)
-        product_vector.append(1) # add 1 to allow the last coordinate to stay as is
-        product_vector = product_vector[1:] # skew one to the left, so will line up with one higher dimension
-        if recvar: product_vector = product_vector[1:] # skew again because the coordinate vector will drop its record coordinate
+    def read_2d_window(self, varname, xdim, ydim, xstart, xcount, ystart, ycount, output="list", extradims=None, xstride=1, ystride=1):
+        """
+        Same as read_2d_data, but only extracts a window of the grid given by the start index
+        and number of indexes along the xdim and ydim, with extradims given as a dictionary. 
+        Optionally only every xstride'th column and ystride'th row is read. 
+        """
+        layout = self.get_layout(varname)
+        dimnames = layout.dimnames
+        extradims = extradims or dict()
 
         # TODO: ensure that extradims and the x and y dims together contains indexes for all dimensions of the variable
         # ...
 
-        # TODO: allow extradims to reference the actual dimension values by looking it up in its coordinate variable values
-        # ...
+        # the window along the x and y dims, and a single index for all other dims
+        start = []
+        count = []
+        stride = []
+        for dimname in dimnames:
+            if dimname == xdim:
+                start.append(xstart)
+                count.append(xcount)
+                stride.append(xstride)
+            elif dimname == ydim:
+                start.append(ystart)
+                count.append(ycount)
+                stride.append(ystride)
+            else:
+                start.append(extradims[dimname])
+                count.append(1)
+                stride.append(1)
+
+        # read all values at once, ordered as they are stored
+        values = self.read_hyperslab(varname, start, count, stride, output=output)
+
+        # split into rows
+        xdimlength = xcount
+        ydimlength = ycount
+        if output == "numpy":
+            if dimnames.index(xdim) < dimnames.index(ydim):
+                rows = values.reshape((xdimlength, ydimlength)).T
+            else:
+                rows = values.reshape((ydimlength, xdimlength))
+        elif output in ("array", "packed"):
+            # a single flat array in row order
+            if dimnames.index(xdim) < dimnames.index(ydim):
+                rows = values.__class__(values.typecode)
+                for y in range(ydimlength):
+                    rows.extend(values[y::ydimlength])
+            else:
+                rows = values
+            self.set_array_shape(rows, layout, (ydimlength, xdimlength))
+        elif dimnames.index(xdim) < dimnames.index(ydim):
+            # xdim varies slowest in the file, so each row is every ydimlength'th value
+            rows = [values[y::ydimlength] for y in range(ydimlength)]
+        else:
+            rows = [values[y*xdimlength:(y+1)*xdimlength] for y in range(ydimlength)]
 
-        # TODO OPTIMIZATION: alternatively find the byte interval between every value to be read,
-        # and instead batch read all values at once using a slice with a step value,
-        # potentially implemented via a memoryview for optimal efficiency.
-        # ...
+        return rows
 
-        # find each value one at a time by computing offsets
-        # TODO: calculate number of records if numrecs is STREAMING
-        begin = varinfo["begin"]
-        rows = []
-        xdimlength = xdiminfo["dim_length"] or self.header["numrecs"] # record dimensions have length 0, so must use number of records
-        ydimlength = ydiminfo["dim_length"] or self.header["numrecs"] # record dimensions have length 0, so must use number of records
-        for y in range(ydimlength):
-            row = []
-            for x in range(xdimlength):
-                indexdict = {xdim:x, ydim:y}
-                indexdict.update(**extradims)
-
-                #
-                coord = [indexdict[self.header["dim_list"][dimid]["name"]] for dimid in varinfo["dimids"]] # aka index list for desired value
-                if recvar: 
-                    coord_mod = coord[1:] # drop the record coordinate so doesnt affect calculation
-                else:
-                    coord_mod = list(coord) 
-                #print coord,coord_mod,product_vector
-                
-                offset = sum(( coordindex*prodvec for coordindex,prodvec in zip(coord_mod,product_vector) ))
-                #print offset
-
-                #
-                offset *= dtypesize
-                #print offset
-
-                #
-                offset += begin
-                #print begin
-                #print offset
-
-                #
-                if recvar:
-                    recnum = coord[0]
-                    offset += recnum * recsize
-                    #print offset
-
-                # fetch the data
-                self.fileobj.seek(offset, 0)
-                n = 1
-                if dtype == "NC_CHAR":
-                    value = self.read_chars(n)
-                elif dtype == "NC_BYTE":
-                    value = self.read_bytes(n)
-                elif dtype == "NC_SHORT":
-                    value = self.read_short(n)
-                elif dtype == "NC_INT":
-                    value = self.read_int(n)
-                elif dtype == "NC_FLOAT":
-                    value = self.read_float(n)
-                elif dtype == "NC_DOUBLE":
-                    value = self.read_double(n)
-
-                # TODO: handle fill values?
-                # ...
-
-                # apply transformations to value if given in attributes
-                attr = self.get_varattr(varname, "scale_factor")
-                if attr is not None:
-                    value *= attr
-
-                attr = self.get_varattr(varname, "add_offset")
-                if attr is not None:
-                    value += attr
-
-                # add value
-                row.append(value)
-
-            rows.append(row)
+    def read_bbox(self, varname, bbox, xdim="longitude", ydim="latitude", output="list", **extradims):
+        """
+        Extracts the part of a 2-dimensional grid covering a bounding box of coordinate values,
+        given as (xmin, ymin, xmax, ymax), with rows and columns as in read_2d_data. 
+        Only the rows and columns inside the box are read, found from the coordinate variables of xdim and ydim.
+        If xdim is longitude in degrees the box may cross the antimeridian, eg from 170 to -170,
+        in which case it is read as two pieces on either side of the seam and joined. 
+        """
+        xmin, ymin, xmax, ymax = bbox
+        ystart, ystop = self.get_label_range(ydim, min(ymin,ymax), max(ymin,ymax))
+        if self.is_longitude(xdim):
+            xranges = self.calc_wrapped_label_ranges(xdim, xmin, xmax)
+        else:
+            xranges = [self.get_label_range(xdim, xmin, xmax)]
+
+        pieces = [self.read_2d_window(varname, xdim, ydim, xstart, xstop-xstart, ystart, ystop-ystart, output, extradims)
+                  for xstart,xstop in xranges]
+
+        # join the pieces side by side
+        if len(pieces) == 1:
+            rows = pieces[0]
+        elif output == "numpy":
+            rows = numpy.ma.concatenate(pieces, axis=1) if self.mask is True else numpy.concatenate(pieces, axis=1)
+        elif output in ("array", "packed"):
+            left,right = pieces
+            ycount, leftcount = left.shape
+            rightcount = right.shape[1]
+            rows = left.__class__(left.typecode)
+            for y in range(ycount):
+                rows.extend(left[y*leftcount:(y+1)*leftcount])
+                rows.extend(right[y*rightcount:(y+1)*rightcount])
+            self.set_array_shape(rows, getattr(left, "_layout", None), (ycount, leftcount + rightcount))
+        else:
+            rows = [leftrow + rightrow for leftrow,rightrow in zip(*pieces)]
 
         return rows
 
-    def calc_product_vector(self, varname):
-        varinfo = self.get_varinfo(varname)
-        dimidlengths = [self.header["dim_list"][dimid]["dim_length"] for dimid in varinfo["dimids"]]
-        product_vector = []
-        prevlength = 1
-        for dimidlength in reversed(dimidlengths):
-            cumulprod = prevlength * dimidlength
-            product_vector.append(cumulprod)
-            prevlength = cumulprod
-        product_vector = list(reversed(product_vector))
+    def read_overview(self, varname, factor, xdim="longitude", ydim="latitude", output="list", **extradims):
+        """
+        Extracts a decimated 2-dimensional grid with only every factor'th row and column,
+        for quick previews of large grids, otherwise the same as read_2d_data. 
+        Uses the overview stored by build_overviews if there is one, otherwise only the
+        needed values are read from the file using strided offsets. 
+        """
+        key = self.calc_overview_key(varname, factor, xdim, ydim, extradims)
+        stored = self.load_overviews().get(key) if output != "packed" else None
+        if stored is not None:
+            xcount, ycount, values = stored
+            if output == "numpy":
+                if numpy is None:
+                    raise Exception("Reading data as numpy arrays requires the numpy package")
+                values = numpy.frombuffer(values, dtype=values.typecode).reshape((ycount, xcount))
+                return numpy.ma.masked_invalid(values) if self.mask is True else values
+            elif output == "array":
+                values = GridArray(values.typecode, values)
+                values.shape = (ycount, xcount)
+                return values
+            rows = [values[y*xcount:(y+1)*xcount].tolist() for y in range(ycount)]
+            layout = self.get_layout(varname)
+            if layout.dtype not in ("NC_FLOAT", "NC_DOUBLE") and layout.scale_factor is None and layout.add_offset is None:
+                # unscaled integers are stored as floats, but read as integers
+                rows = [[int(value) if value == value else value for value in row] for row in rows]
+            if self.mask is True:
+                # masked values are stored as nan
+                rows = [[value if value == value else None for value in row] for row in rows]
+            return rows
+
+        layout = self.get_layout(varname)
+        xdimlength = layout.shape[layout.dimnames.index(xdim)]
+        ydimlength = layout.shape[layout.dimnames.index(ydim)]
+        rows = self.read_2d_window(varname, xdim, ydim,
+                                   0, (xdimlength + factor - 1) // factor,
+                                   0, (ydimlength + factor - 1) // factor,
+                                   output, extradims, factor, factor)
+        return rows
 
-        recvar = self.header["dim_list"][varinfo["dimids"][0]]["dim_length"] == 0
-        if recvar:
-            product_vector[0] = 0
+    def build_overviews(self, varname, factors=(2,4,8,16,32), xdim="longitude", ydim="latitude", **extradims):
+        """
+        Builds a pyramid of decimated overviews of a 2-dimensional grid (see read_overview) for each
+        of the given decimation factors, and stores them in an overview file next to the NetCDF file,
+        so that later overview reads of the same grid do not touch the data at all. 
+        The overview file is ignored if the NetCDF file has changed since it was built. 
+        """
+        overviews = self.load_overviews()
+        factors = sorted(factors)
+        rows = None
+        prevfactor = None
+        for factor in factors:
+            if rows is not None and factor % prevfactor == 0:
+                # decimate the previous level further
+                step = factor // prevfactor
+                rows = [row[::step] for row in rows[::step]]
+            else:
+                rows = self.read_overview(varname, factor, xdim, ydim, **extradims)
+            prevfactor = factor
+
+            key = self.calc_overview_key(varname, factor, xdim, ydim, extradims)
+            nan = float("nan")
+            values = array.array("d", (value if value is not None else nan for row in rows for value in row))
+            overviews[key] = (len(rows[0]) if rows else 0, len(rows), values)
+
+        self.save_overviews(overviews)
+
+    def calc_overview_key(self, varname, factor, xdim, ydim, extradims):
+        # overviews are stored with the masking they were built with, and names as text so they can be stored as json
+        def text(name):
+            return name.decode("utf8") if isinstance(name, bytes) else name
+        extradims = tuple(sorted((text(dimname), index) for dimname,index in extradims.items()))
+        return (text(varname), factor, text(xdim), text(ydim), extradims, self.mask)
+
+    def load_overviews(self):
+        """
+        Returns the dictionary of overviews stored next to the NetCDF file, or an empty one
+        if there is no overview file, it was built for an earlier version of the file, or it cannot be read. 
+        The file is a json header describing each overview, followed by their values as big endian doubles,
+        so that reading it never runs any code. 
+        """
+        if self.overviews is None:
+            self.overviews = dict()
+            path = self.filepath + ".ovr"
+            if os.path.exists(path):
+                try:
+                    self.overviews = self.parse_overviews(path)
+                except Exception:
+                    pass # a truncated, corrupt or unrecognized overview file is the same as none
+        return self.overviews
+
+    def parse_overviews(self, path):
+        with open(path, "rb") as fileobj:
+            data = fileobj.read()
+        pos = len(self.OVERVIEW_MAGIC)
+        if data[:pos] != self.OVERVIEW_MAGIC:
+            raise Exception("Not an overview file")
+        headersize, = self.overview_header_struct.unpack_from(data, pos)
+        pos += self.overview_header_struct.size
+        header = json.loads(data[pos:pos+headersize].decode("utf8"))
+        pos += headersize
+        if tuple(header["source"]) != self.calc_file_signature():
+            return dict()
+
+        overviews = dict()
+        for item in header["overviews"]:
+            key = (item["varname"], int(item["factor"]), item["xdim"], item["ydim"],
+                   tuple((dimname, index) for dimname,index in item["extradims"]), item["mask"])
+            xcount, ycount = int(item["xcount"]), int(item["ycount"])
+            size = xcount * ycount * 8
+            if xcount < 0 or ycount < 0 or pos + size > len(data):
+                raise Exception("The overview file ended before the end of the values")
+            values = array.array("d")
+            if hasattr(values, "frombytes"):
+                values.frombytes(data[pos:pos+size])
+            else:
+                values.fromstring(data[pos:pos+size]) # older name on python 2
+            if sys.byteorder == "little":
+                values.byteswap()
+            overviews[key] = (xcount, ycount, values)
+            pos += size
+        return overviews
+
+    def save_overviews(self, overviews):
+        items = []
+        pieces = []
+        for key,(xcount, ycount, values) in overviews.items():
+            varname, factor, xdim, ydim, extradims, mask = key
+            items.append(dict(varname=varname, factor=factor, xdim=xdim, ydim=ydim,
+                              extradims=extradims, mask=mask, xcount=xcount, ycount=ycount))
+            values = array.array("d", values)
+            if sys.byteorder == "little":
+                values.byteswap()
+            pieces.append(values.tobytes() if hasattr(values, "tobytes") else values.tostring())
+        header = json.dumps(dict(source=self.calc_file_signature(), overviews=items)).encode("utf8")
+
+        path = self.filepath + ".ovr"
+        with open(path + ".tmp", "wb") as fileobj:
+            fileobj.write(self.OVERVIEW_MAGIC + self.overview_header_struct.pack(len(header)) + header)
+            for piece in pieces:
+                fileobj.write(piece)
+        if os.path.exists(path):
+            os.remove(path) # cannot rename onto an existing file on windows
+        os.rename(path + ".tmp", path)
+        self.overviews = overviews
+
+    def calc_file_signature(self):
+        # the size and modification time of the file, to detect when it has changed
+        stat = os.stat(self.filepath)
+        return (stat.st_size, stat.st_mtime)
+
+    def read_slices(self, requests, max_workers=None, output="list"):
+        """
+        Reads many slices concurrently in a pool of threads, eg one for each of many timesteps.
+        Each request is either a (varname, start, count, stride) tuple or a dictionary
+        of read_slice arguments, and the results are returned in the same order. 
+        Requires python 3 or the futures backport on python 2. 
+        """
+        if futures is None:
+            raise Exception("Concurrent reads require the concurrent.futures module (pip install futures on python 2)")
 
-        return product_vector
+        def read_request(request):
+            if isinstance(request, dict):
+                kwargs = dict(output=output)
+                kwargs.update(request)
+                return self.read_slice(**kwargs)
+            else:
+                return self.read_slice(*request, output=output)
 
-    def calc_recsize(self):
-        recvars = self.get_record_variables()
-        recsize = sum((self.calc_vsize(varinfo["name"]) for varinfo in recvars))
-        recsize = self.round_nearest_4byte_boundary(recsize)
-        recsize += 4 # "it always includes padding to the next multiple of 4 bytes"
-        return recsize
+        if max_workers is None:
+            max_workers = min(32, len(requests) or 1)
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(read_request, requests))
 
-    def calc_vsize(self, varname):
-        product_vector = self.calc_product_vector(varname)
-        varinfo = self.get_varinfo(varname)
-        dtypesize = self.dtype_sizes[varinfo["nc_type"]]
-        vsize = max(product_vector) * dtypesize
-        vsize = self.round_nearest_4byte_boundary(vsize)
-        return vsize
+        return results
 
-    #############
-    # Meta utilities
-    #############
+    def read_slice(self, varname, start=None, count=None, stride=None, output="list"):
+        """
+        Extracts an N-dimensional subset of a variable as nested lists, in the style of netCDF hyperslabs.
+        Start, count and stride are sequences with one index per dimension of the variable,
+        defaulting to the first index, all remaining indexes, and every index respectively.
+        The record dimension can be sliced like any other dimension. 
+        If output is "numpy", returns a numpy array instead (requires numpy), if "array" a GridArray,
+        or if "packed" a PackedArray of the raw undecoded values. 
+        """
+        dimlengths = self.get_layout(varname).shape
+
+        if start is None:
+            start = [0 for _ in dimlengths]
+        if stride is None:
+            stride = [1 for _ in dimlengths]
+        if count is None:
+            count = [(dimlength - index + step - 1) // step for dimlength,index,step in zip(dimlengths,start,stride)]
+
+        if not len(start) == len(count) == len(stride) == len(dimlengths):
+            raise Exception("Start, count and stride must have one item for each of the variable's %s dimensions" % len(dimlengths))
+        for dimlength,index,n,step in zip(dimlengths, start, count, stride):
+            if step < 1:
+                raise Exception("Stride values must be positive integers")
+            if index < 0 or (n and index + (n-1)*step >= dimlength):
+                raise Exception("Slice is outside the bounds of the variable's dimensions")
+
+        values = self.read_hyperslab(varname, start, count, stride, output)
+        if output in ("numpy", "array", "packed"):
+            return values
+        if not count:
+            return values[0] # scalar variable
+        return self.nest_values(values, count)
+
+    def read_point_series(self, varname, output="list", **fixed_indexes):
+        """
+        Extracts all the values of a record variable along the record dimension (usually time)
+        at a single point, given by fixing the indexes of all other dimensions as keywords. 
+        Only the single value in each record is read, with nearby records read together. 
+        Returns a list, or if output is "numpy" a numpy array. 
+        """
+        layout = self.get_layout(varname)
+        if not layout.recvar:
+            raise Exception("Point series can only be extracted from record variables")
+
+        start = [0]
+        count = [layout.shape[0]]
+        for dimname in layout.dimnames[1:]:
+            if dimname not in fixed_indexes:
+                raise Exception("Must fix the index of the %r dimension" % dimname)
+            start.append(fixed_indexes[dimname])
+            count.append(1)
+
+        values = self.read_hyperslab(varname, start, count, output=output)
+        if output == "numpy":
+            values = values.reshape(count[0])
+        elif output in ("array", "packed"):
+            values.shape = (count[0],)
+        return values
 
-    def get_varinfo(self, varname):
-        for vardict in self.header["var_list"]:
-            if varname == vardict["name"]:
-                return vardict
+    def read_points(self, varname, points, labels=False, method="exact", output="list"):
+        """
+        Samples a variable's values at a batch of points, where each point is either a sequence with one
+        index per dimension of the variable, or a dictionary of dimension names and indexes.
+        If labels is True, the points are given as coordinate values instead of indexes, which
+        are looked up in the coordinate variable of each dimension using either the "exact" or "nearest" method. 
+        The points are converted to byte offsets, and read in sorted order with nearby points read together. 
+        Returns the values in the same order as the points, as a list or if output is "numpy" a numpy array. 
+        """
+        layout = self.get_layout(varname)
+
+        # convert each point to a byte offset
+        offsets = []
+        for point in points:
+            if isinstance(point, dict):
+                point = [point[dimname] for dimname in layout.dimnames]
+            if len(point) != len(layout.dimnames):
+                raise Exception("Each point must have one index for each of the variable's %s dimensions" % len(layout.dimnames))
+            if labels:
+                point = [self.get_label_index(dimname, label, method) for dimname,label in zip(layout.dimnames, point)]
+            offset = layout.begin
+            for index,dimlength,bytestride in zip(point, layout.shape, layout.byte_strides):
+                if not 0 <= index < dimlength:
+                    raise Exception("Point %s is outside the bounds of the variable's dimensions" % (point,))
+                offset += index * bytestride
+            offsets.append(offset)
+
+        # read each unique offset once in sorted order
+        values = []
+        if offsets:
+            unique = sorted(set(offsets))
+            base = unique[0]
+            runoffsets = [offset - base for offset in unique]
+            runstruct = struct.Struct("%s%s" % (self.endian, layout.struct_code))
+            decoded = dict((base + runoffset, runstruct.unpack_from(buf, pos)[0])
+                           for runoffset,(buf,pos) in zip(runoffsets, self.read_runs(base, runoffsets, layout.itemsize)))
+            values = [decoded[offset] for offset in offsets]
+
+        if output == "numpy":
+            if numpy is None:
+                raise Exception("Reading data as numpy arrays requires the numpy package")
+            values = numpy.array(values, dtype=self.numpy_dtypes[layout.dtype])
+        elif output == "array":
+            values = GridArray("d", self.decode_values(layout, values, output))
+            values.shape = (len(values),)
+            return values
+        elif output == "packed":
+            values = PackedArray(self.array_typecodes[layout.dtype], values)
+            self.set_array_shape(values, layout, [len(values)])
+            return values
+
+        return self.decode_values(layout, values, output)
+
+    def sel(self, varname, method="exact", **labels):
+        """
+        Selects values of a variable by the values of its dimensions' coordinate variables instead of indexes,
+        looked up with a binary search. Each keyword is a dimension name, set to either a single value,
+        which is matched with the "exact" or "nearest" method and drops that dimension, or a (min, max)
+        tuple or slice selecting the range of values between them (inclusive, in either order). 
+        Dimensions that are not given are included in full.
+        Returns nested lists, like indexing a Variable. 
+        """
+        layout = self.get_layout(varname)
+        for dimname in labels:
+            if dimname not in layout.dimnames:
+                raise Exception("The %r variable has no %r dimension" % (varname, dimname))
+
+        key = []
+        for dimname in layout.dimnames:
+            label = labels.get(dimname)
+            if label is None:
+                key.append(slice(None))
+            elif isinstance(label, slice):
+                key.append(slice(*self.get_label_range(dimname, label.start, label.stop)))
+            elif isinstance(label, tuple):
+                key.append(slice(*self.get_label_range(dimname, *label)))
+            else:
+                key.append(self.get_label_index(dimname, label, method))
+
+        return Variable(self, varname)[tuple(key)]
+
+    def nest_values(self, values, shape):
+        """
+        Splits a flat list of values into nested lists of the given shape. 
+        """
+        for dim in reversed(range(1, len(shape))):
+            length = shape[dim]
+            n = 1
+            for outerlength in shape[:dim]:
+                n *= outerlength
+            values = [values[i*length:(i+1)*length] for i in range(n)]
+        return values
 
-    def get_varattr(self, varname, attr):
-        for attrdict in self.get_varinfo(varname)["vatt_list"]:
-            if attr == attrdict["name"]:
-                return attrdict["values"]
+    def iter_records(self, varnames=None, start=0, stop=None, output="list"):
+        """
+        Iterates over the records of the file, yielding the record index and an ordered dictionary
+        of the decoded values of each of the given record variables in that record (defaults to all of them),
+        as nested lists or if output is "numpy" numpy arrays. 
+        Since record variables are interleaved per record, each record is read only once in a single
+        contiguous read covering all the variables, so only one record is held in memory at a time. 
+        """
+        if varnames is None:
+            varnames = [var["name"] for var in self.header["var_list"] if self.get_layout(var["name"]).recvar]
+        layouts = [self.get_layout(varname) for varname in varnames]
+        for layout in layouts:
+            if not layout.recvar:
+                raise Exception("Can only iterate the records of record variables, not %r" % layout.name)
+        if output not in ("list", "numpy", "array", "packed"):
+            raise Exception("Output must be either 'list', 'numpy', 'array' or 'packed', not %r" % output)
+
+        # the part of each record that covers all the requested variables
+        sizes = []
+        for layout in layouts:
+            size = layout.itemsize
+            for dimlength in layout.shape[1:]:
+                size *= dimlength
+            sizes.append(size)
+        recstart = min(layout.begin for layout in layouts) if layouts else 0
+        recend = max(layout.begin + size for layout,size in zip(layouts,sizes)) if layouts else 0
+        varstructs = [struct.Struct("%s%i%s" % (self.endian, size // layout.itemsize, layout.struct_code))
+                      for layout,size in zip(layouts,sizes)]
+
+        if stop is None:
+            stop = self.numrecs
+        for index in range(start, stop):
+            raw = self.read_at(recstart + index * self.recsize, recend - recstart)
+            record = collections.OrderedDict()
+            for layout,size,varstruct in zip(layouts,sizes,varstructs):
+                pos = layout.begin - recstart
+                if output == "numpy":
+                    values = numpy.frombuffer(raw, self.numpy_dtypes[layout.dtype], size // layout.itemsize, pos)
+                    values = self.decode_values(layout, values, output).reshape(layout.shape[1:])
+                elif output == "array":
+                    values = GridArray("d", self.decode_values(layout, list(varstruct.unpack_from(raw, pos)), output))
+                    values.shape = layout.shape[1:]
+                elif output == "packed":
+                    values = self.unpack_packed(layout.dtype, [raw[pos:pos+size]])
+                    self.set_array_shape(values, layout, layout.shape[1:])
+                else:
+                    values = self.decode_values(layout, list(varstruct.unpack_from(raw, pos)))
+                    values = self.nest_values(values, layout.shape[1:]) if len(layout.shape) > 1 else values[0]
+                record[layout.name] = values
+            yield index, record
+
+    def read_data_buffer(self, varname):
+        """
+        Returns the undecoded big endian bytes of a non-record variable's data, as stored in the file.
+        When memory mapped this is a zero-copy memoryview window over the mapped file. 
+        """
+        layout = self.get_layout(varname)
+        if layout.recvar:
+            raise Exception("The data of record variables are interleaved between records and cannot be returned as a single buffer")
+
+        size = layout.itemsize
+        for dimlength in layout.shape:
+            size *= dimlength
+
+        return self.read_at(layout.begin, size)
+
+    def get_memmap(self, varname):
+        """
+        Returns a read-only numpy memmap of a non-record variable's data, with the variable's shape
+        and big endian dtype, so that data is only read from disk when accessed (requires numpy).
+        Note that scale_factor and add_offset are not applied. 
+        """
+        if numpy is None:
+            raise Exception("Memory mapping data as numpy arrays requires the numpy package")
+
+        layout = self.get_layout(varname)
+        if layout.recvar:
+            raise Exception("The data of record variables are interleaved between records and cannot be memory mapped as a single array")
+
+        return numpy.memmap(self.filepath, dtype=self.numpy_dtypes[layout.dtype], mode="r",
+                            offset=layout.begin, shape=layout.shape)
+
+    def read_hyperslab(self, varname, start, count, stride=None, output="list"):
+        """
+        Reads a strided block of a variable's values given the start index, count and index stride
+        along each of its dimensions, with scale_factor and add_offset applied.
+        Returns a flat list of values in the order they are stored, or if output is "numpy"
+        a numpy array with count as its shape, or if output is "array" a GridArray with count as its shape,
+        or if output is "packed" a PackedArray of the undecoded values with count as its shape. 
+        """
+        layout = self.get_layout(varname)
+        dtype = layout.dtype
+        if stride is None:
+            stride = [1 for _ in start]
+
+        # locate the first value and the byte distance between values along each dimension
+        offset = layout.begin + sum(( index*bytestride for index,bytestride in zip(start,layout.byte_strides) ))
+        strides = [step*bytestride for step,bytestride in zip(stride,layout.byte_strides)]
+
+        # fetch the data
+        if output == "numpy":
+            values = self.read_strided_array(offset, dtype, count, strides)
+        elif output == "list":
+            values = self.read_strided(offset, dtype, count, strides)
+        elif output == "array":
+            values = self.read_strided(offset, dtype, count, strides)
+            values = GridArray("d", self.decode_values(layout, values, output))
+            self.set_array_shape(values, layout, count)
+            return values
+        elif output == "packed":
+            # leave the values as they are
+            values = self.read_strided_packed(offset, dtype, count, strides)
+            self.set_array_shape(values, layout, count)
+            return values
+        else:
+            raise Exception("Output must be either 'list', 'numpy', 'array' or 'packed', not %r" % output)
+
+        return self.decode_values(layout, values, output)
+
+    def decode_values(self, layout, values, output="list"):
+        """
+        Masks the invalid values in a flat list or numpy array of a variable's raw values (see NetCDF),
+        and applies the variable's scale_factor and add_offset attributes to the rest. 
+        If output is "array" the values are a list, but masked values are always NaN. 
+        """
+        scale_factor = layout.scale_factor
+        add_offset = layout.add_offset
+        missing_values = layout.missing_values
+        valid_min = layout.valid_min
+        valid_max = layout.valid_max
+        checkmask = self.mask and (missing_values or valid_min is not None or valid_max is not None)
+
+        if output == "numpy":
+            # vectorized over the whole array
+            if checkmask:
+                invalid = numpy.zeros(values.shape, dtype=bool)
+                for missing_value in missing_values:
+                    invalid |= values == missing_value
+                if valid_min is not None:
+                    invalid |= values < valid_min
+                if valid_max is not None:
+                    invalid |= values > valid_max
+            if scale_factor is not None:
+                values = values * scale_factor
+            if add_offset is not None:
+                values = values + add_offset
+            if self.mask == "nan":
+                if checkmask and invalid.any():
+                    values = values.astype(float)
+                    values[invalid] = numpy.nan
+            elif self.mask:
+                values = numpy.ma.masked_array(values, invalid if checkmask else False)
+            return values
+
+        # masked values are usually rare, so first check the whole list at once for any
+        masked = False
+        if checkmask and values:
+            if ((missing_values and not missing_values.isdisjoint(values))
+                or (valid_min is not None and min(values) < valid_min)
+                or (valid_max is not None and max(values) > valid_max)):
+                masked = True
+                replacement = float("nan") if self.mask == "nan" or output == "array" else None
+                values = [replacement if value in missing_values
+                          or (valid_min is not None and value < valid_min)
+                          or (valid_max is not None and value > valid_max)
+                          else value
+                          for value in values]
+
+        # apply transformations to values if given in attributes
+        if masked and replacement is None:
+            # leave the None values as they are
+            if scale_factor is not None and add_offset is not None:
+                values = [value*scale_factor + add_offset if value is not None else None for value in values]
+            elif scale_factor is not None:
+                values = [value*scale_factor if value is not None else None for value in values]
+            elif add_offset is not None:
+                values = [value + add_offset if value is not None else None for value in values]
+        elif scale_factor is not None and add_offset is not None:
+            values = [value*scale_factor + add_offset for value in values]
+        elif scale_factor is not None:
+            values = [value*scale_factor for value in values]
+        elif add_offset is not None:
+            values = [value + add_offset for value in values]
+
+        return values
+
+    def read_strided(self, offset, dtype, counts, strides):
+        """
+        Reads and decodes a strided block of values of the same dtype starting at a byte offset,
+        where counts and strides give the number of values and the byte distance between them
+        along each dimension. 
+        Contiguous inner dimensions are collapsed into runs that are each read and unpacked in one go,
+        and if the runs lie close enough together their whole covering span is read at once instead. 
+        Returns a flat list of values. 
+        """
+        itemsize = self.dtype_sizes[dtype]
+        code = self.struct_codes[dtype]
+
+        runlength, runoffsets, strides = self.calc_runs(counts, strides, itemsize)
+        if not runoffsets:
+            return []
+        runsize = runlength * itemsize
+
+        spansize = runoffsets[-1] + runsize
+        if spansize <= len(runoffsets) * runsize * self.span_read_ratio:
+            # read the covering span once
+            raw = self.read_at(offset, spansize)
+            if all(( stride % itemsize == 0 for stride in strides )):
+                # decode the whole span with a single unpack and pick out the runs
+                spanvalues = struct.unpack("%s%i%s" % (self.endian, spansize // itemsize, code), raw)
+                if len(runoffsets) == 1:
+                    values = list(spanvalues)
+                elif runlength == 1:
+                    values = [spanvalues[runoffset // itemsize] for runoffset in runoffsets]
+                else:
+                    values = []
+                    for runoffset in runoffsets:
+                        i = runoffset // itemsize
+                        values.extend(spanvalues[i:i+runlength])
+            else:
+                # runs are not aligned with each other, eg when interleaved in records
+                runstruct = struct.Struct("%s%i%s" % (self.endian, runlength, code))
+                values = []
+                for runoffset in runoffsets:
+                    values.extend(runstruct.unpack_from(raw, runoffset))
+        else:
+            # too sparse, read each run or group of nearby runs separately
+            runstruct = struct.Struct("%s%i%s" % (self.endian, runlength, code))
+            values = []
+            for buf,pos in self.read_runs(offset, runoffsets, runsize):
+                values.extend(runstruct.unpack_from(buf, pos))
+
+        return values
+
+    def read_strided_packed(self, offset, dtype, counts, strides):
+        """
+        Same as read_strided, but returns the raw values as a PackedArray in native byte order,
+        copying the bytes of each run directly into the array without unpacking each value. 
+        """
+        itemsize = self.dtype_sizes[dtype]
+        runlength, runoffsets, strides = self.calc_runs(counts, strides, itemsize)
+        runsize = runlength * itemsize
+        runs = self.read_runs(offset, runoffsets, runsize) if runoffsets else []
+        return self.unpack_packed(dtype, (buf[pos:pos+runsize] for buf,pos in runs))
+
+    def unpack_packed(self, dtype, chunks):
+        """
+        Copies chunks of big endian bytes of values of the same dtype into a PackedArray in native byte order. 
+        """
+        typecode = self.array_typecodes.get(dtype)
+        if typecode is None:
+            raise Exception("Values of type %s cannot be read as packed arrays" % dtype)
+        values = PackedArray(typecode)
+        frombytes = values.frombytes if hasattr(values, "frombytes") else values.fromstring
+        for chunk in chunks:
+            frombytes(chunk)
+        if sys.byteorder == "little":
+            values.byteswap()
+        return values
+
+    def set_array_shape(self, values, layout, shape):
+        values.shape = tuple(shape)
+        if isinstance(values, PackedArray):
+            values._backend = self
+            values._layout = layout
+
+    def read_strided_array(self, offset, dtype, counts, strides):
+        """
+        Same as read_strided, but returns a big endian numpy array with counts as its shape.
+        The covering span is wrapped as a strided view when dense enough, otherwise each run
+        is read separately and concatenated. 
+        """
+        if numpy is None:
+            raise Exception("Reading data as numpy arrays requires the numpy package")
+
+        numpy_dtype = numpy.dtype(self.numpy_dtypes[dtype])
+        itemsize = self.dtype_sizes[dtype]
+
+        runlength, runoffsets, _ = self.calc_runs(counts, strides, itemsize)
+        if not runoffsets:
+            return numpy.empty(counts, dtype=numpy_dtype)
+        runsize = runlength * itemsize
+
+        spansize = runoffsets[-1] + runsize
+        if spansize <= len(runoffsets) * runsize * self.span_read_ratio:
+            # view the covering span with the byte strides of the selection
+            raw = self.read_at(offset, spansize)
+            values = numpy.ndarray(shape=counts, dtype=numpy_dtype, buffer=raw, strides=strides)
+        else:
+            # too sparse, read each run or group of nearby runs separately
+            runs = [numpy.frombuffer(buf, dtype=numpy_dtype, count=runlength, offset=pos)
+                    for buf,pos in self.read_runs(offset, runoffsets, runsize)]
+            values = numpy.concatenate(runs).reshape(counts)
+
+        return values
+
+    def read_runs(self, offset, runoffsets, runsize):
+        """
+        Reads runs of bytes of the same size at the given ascending offsets relative to a byte offset,
+        merging runs that are no more than coalesce_gap bytes apart into a single read. 
+        Returns a list of (buffer, position) pairs, one for each run. 
+        """
+        runs = []
+        i = 0
+        while i < len(runoffsets):
+            # extend the group for as long as the next run is close enough
+            j = i
+            while j + 1 < len(runoffsets) and runoffsets[j+1] - runoffsets[j] - runsize <= self.coalesce_gap:
+                j += 1
+            groupstart = runoffsets[i]
+            buf = self.read_at(offset + groupstart, runoffsets[j] + runsize - groupstart)
+            runs.extend(( (buf, runoffset - groupstart) for runoffset in runoffsets[i:j+1] ))
+            i = j + 1
+        return runs
+
+    def calc_runs(self, counts, strides, itemsize):
+        """
+        Collapses the contiguous inner dimensions of a strided selection into runs of consecutive values.
+        Returns the number of values in each run, the byte offset of each run relative to the first one,
+        and the byte strides of the remaining outer dimensions. 
+        """
+        counts = list(counts)
+        strides = list(strides)
+        runlength = 1
+        while counts and (counts[-1] == 1 or strides[-1] == runlength * itemsize):
+            runlength *= counts.pop()
+            strides.pop()
+        if runlength == 0 or 0 in counts:
+            return runlength, [], strides
+
+        runoffsets = [0]
+        for count,stride in zip(counts, strides):
+            runoffsets = [runoffset + i*stride for runoffset in runoffsets for i in range(count)]
+
+        return runlength, runoffsets, strides
+
+    def calc_layout(self, varname):
+        """
+        Computes everything needed to locate and decode a variable's values. 
+        """
+        varinfo = self.get_varinfo(varname)
+        if varinfo is None:
+            raise Exception("Could not find a variable named %r" % varname)
+
+        dtype = varinfo["nc_type"]
+        itemsize = self.dtype_sizes[dtype]
+        dims = [self.header["dim_list"][dimid] for dimid in varinfo["dimids"]]
+        recvar = bool(dims) and dims[0]["dim_length"] == 0
+        product_vector = self.calc_product_vector(varname)
+
+        # skew the product vector one to the left, so each dimension gets the product of all later dimensions,
+        # except the record dimension where consecutive indexes are one record apart
+        byte_strides = [prodvec * itemsize for prodvec in product_vector[1:] + [1]]
+        if recvar:
+            byte_strides[0] = self.recsize
+
+        attrs = self.varattr_index[varname]
+        missing_values, valid_min, valid_max = self.calc_invalid_values(dtype, attrs)
+        layout = _VariableLayout(name = varname,
+                                 dtype = dtype,
+                                 struct_code = self.struct_codes[dtype],
+                                 itemsize = itemsize,
+                                 dimnames = tuple(dim["name"] for dim in dims),
+                                 shape = tuple(dim["dim_length"] or self.numrecs for dim in dims), # record dimensions have length 0, so must use number of records
+                                 product_vector = tuple(product_vector),
+                                 recvar = recvar,
+                                 recsize = self.recsize if recvar else 0,
+                                 begin = varinfo["begin"],
+                                 byte_strides = tuple(byte_strides),
+                                 scale_factor = attrs.get("scale_factor"),
+                                 add_offset = attrs.get("add_offset"),
+                                 fill_value = attrs.get("_FillValue"),
+                                 missing_values = missing_values,
+                                 valid_min = valid_min,
+                                 valid_max = valid_max,
+                                 )
+        return layout
+
+    def calc_invalid_values(self, dtype, attrs):
+        """
+        Determines which raw values of a variable should be masked, from its _FillValue (or the default
+        fill value of its type) and missing_value attributes, and its valid_min, valid_max or valid_range. 
+        Text variables are never masked. 
+        Returns the set of missing values, and the valid minimum and maximum or None if unbounded. 
+        """
+        if dtype == "NC_CHAR":
+            return frozenset(), None, None
+
+        fill_value = attrs.get("_FillValue", self.default_fill_values[dtype])
+        missing_value = attrs.get("missing_value")
+        missing_values = set(self.as_list(fill_value))
+        if missing_value is not None:
+            missing_values.update(self.as_list(missing_value))
+
+        valid_min = attrs.get("valid_min")
+        valid_max = attrs.get("valid_max")
+        if "valid_range" in attrs:
+            valid_min, valid_max = self.as_list(attrs["valid_range"])[:2]
+
+        return frozenset(missing_values), valid_min, valid_max
+
+    def as_list(self, values):
+        if isinstance(values, (list, tuple)):
+            return list(values)
+        return [values]
+
+    def calc_product_vector(self, varname):
+        varinfo = self.get_varinfo(varname)
+        dimidlengths = [self.header["dim_list"][dimid]["dim_length"] for dimid in varinfo["dimids"]]
+        product_vector = []
+        prevlength = 1
+        for dimidlength in reversed(dimidlengths):
+            cumulprod = prevlength * dimidlength
+            product_vector.append(cumulprod)
+            prevlength = cumulprod
+        product_vector = list(reversed(product_vector))
+
+        recvar = bool(dimidlengths) and dimidlengths[0] == 0
+        if recvar:
+            product_vector[0] = 0
+
+        return product_vector
+
+    def calc_recsize(self):
+        """
+        The size of each record, ie the sum of the sizes of all variables along the record dimension,
+        including any coordinate variable of the record dimension. 
+        """
+        recvars = [vardict for vardict in self.header["var_list"]
+                   if vardict["dimids"] and self.header["dim_list"][vardict["dimids"][0]]["dim_length"] == 0]
+        if len(recvars) == 1:
+            # a single record variable is not padded
+            varinfo = recvars[0]
+            recsize = self.calc_nvalues(varinfo["name"]) * self.dtype_sizes[varinfo["nc_type"]]
+        else:
+            recsize = sum((self.calc_vsize(varinfo["name"]) for varinfo in recvars))
+        return recsize
+
+    def calc_numrecs(self):
+        """
+        The number of records, which if the header says STREAMING is computed from the file size. 
+        """
+        numrecs = self.header["numrecs"]
+        if numrecs == "STREAMING":
+            recbegins = [vardict["begin"] for vardict in self.header["var_list"]
+                         if vardict["dimids"] and self.header["dim_list"][vardict["dimids"][0]]["dim_length"] == 0]
+            if recbegins and self.recsize:
+                numrecs = (os.path.getsize(self.filepath) - min(recbegins)) // self.recsize
+            else:
+                numrecs = 0
+        return numrecs
+
+    def calc_vsize(self, varname):
+        varinfo = self.get_varinfo(varname)
+        dtypesize = self.dtype_sizes[varinfo["nc_type"]]
+        vsize = self.calc_nvalues(varname) * dtypesize
+        vsize = self.round_nearest_4byte_boundary(vsize)
+        return vsize
+
+    def calc_nvalues(self, varname):
+        """
+        The number of values in a variable, or in each record for record variables. 
+        """
+        varinfo = self.get_varinfo(varname)
+        nvalues = 1
+        for i,dimid in enumerate(varinfo["dimids"]):
+            dim_length = self.header["dim_list"][dimid]["dim_length"]
+            if i == 0 and dim_length == 0:
+                continue # record dimension
+            nvalues *= dim_length
+        return nvalues
+
+    #############
+    # Statistics
+    #############
+
+    def calc_statistics(self, varname, bins=None, hist_range=None, packed=False, **fixed_indexes):
+        """
+        Computes the count, minimum, maximum, mean and (population) standard deviation of a variable's values,
+        optionally only where some dimensions are fixed at an index given as keywords, eg a single timestep. 
+        Masked values are skipped (see NetCDF). The values are read in chunks of at most stats_chunk_size values,
+        each combined into running totals with Welford's method, so only one pass and bounded memory is needed. 
+        If bins is given, also counts a histogram of that many equal width bins between hist_range as (min, max),
+        which if not given is found with an extra pass. If packed is True, the statistics are of the raw
+        values before scale_factor and add_offset are applied, as in GDAL. 
+        Returns a dictionary of count, minimum, maximum, mean and stddev, and if bins is given
+        histogram as a dictionary of min, max and counts. 
+        """
+        layout = self.get_layout(varname)
+        for dimname in fixed_indexes:
+            if dimname not in layout.dimnames:
+                raise Exception("The variable has no dimension named %r" % dimname)
+        if bins and hist_range is None:
+            stats = self.calc_statistics(varname, packed=packed, **fixed_indexes)
+            hist_range = (stats["minimum"], stats["maximum"])
+        decodelayout = layout._replace(scale_factor=None, add_offset=None) if packed else layout
+
+        # the fixed indexes and the full length of all other dimensions
+        start = []
+        count = []
+        for dimname,dimlength in zip(layout.dimnames, layout.shape):
+            if dimname in fixed_indexes:
+                start.append(fixed_indexes[dimname])
+                count.append(1)
+            else:
+                start.append(0)
+                count.append(dimlength)
+
+        # split into chunks along the outermost dimension that is not fixed
+        chunks = [(start, count)]
+        free = [i for i,dimname in enumerate(layout.dimnames) if dimname not in fixed_indexes]
+        if free:
+            chunkdim = free[0]
+            size = 1
+            for dimlength in count[chunkdim+1:]:
+                size *= dimlength
+            step = max(1, self.stats_chunk_size // max(size, 1))
+            chunks = []
+            for i in range(0, count[chunkdim], step):
+                chunkstart = list(start)
+                chunkstart[chunkdim] = i
+                chunkcount = list(count)
+                chunkcount[chunkdim] = min(step, count[chunkdim] - i)
+                chunks.append((chunkstart, chunkcount))
+
+        n = 0
+        mean = 0.0
+        m2 = 0.0
+        minimum = maximum = None
+        if bins:
+            histmin, histmax = hist_range
+            histcounts = [0] * bins
+            histscale = bins / float(histmax - histmin) if histmax > histmin else 0
+
+        for chunkstart,chunkcount in chunks:
+            raw = self.read_hyperslab(varname, chunkstart, chunkcount, output="packed")
+            values = self.decode_values(decodelayout, raw.tolist())
+            if None in values or self.mask == "nan":
+                values = [value for value in values if value is not None and value == value]
+            if not values:
+                continue
+
+            # combine the chunk's mean and sum of squared differences with the running ones
+            chunkn = len(values)
+            chunkmean = math.fsum(values) / chunkn
+            chunkm2 = math.fsum([(value - chunkmean)**2 for value in values])
+            total = n + chunkn
+            delta = chunkmean - mean
+            mean += delta * chunkn / total
+            m2 += chunkm2 + delta**2 * n * chunkn / total
+            n = total
+            chunkmin, chunkmax = min(values), max(values)
+            minimum = chunkmin if minimum is None else min(minimum, chunkmin)
+            maximum = chunkmax if maximum is None else max(maximum, chunkmax)
+
+            if bins:
+                for value in values:
+                    if histmin <= value <= histmax:
+                        i = int((value - histmin) * histscale)
+                        histcounts[i if i < bins else bins - 1] += 1
+
+        stats = dict(count = n,
+                     minimum = minimum,
+                     maximum = maximum,
+                     mean = mean if n else None,
+                     stddev = math.sqrt(m2 / n) if n else None,
+                     )
+        if bins:
+            stats["histogram"] = dict(min = histmin,
+                                      max = histmax,
+                                      counts = histcounts,
+                                      )
+        return stats
+
+    def get_band_statistics(self, varname, band=1, xdim="longitude", ydim="latitude", bins=None, cache=True, save=False):
+        """
+        Returns the statistics of the raw values of a 2-dimensional grid of a variable, identified
+        by a GDAL band number (see calc_band_indexes), as a dictionary like calc_statistics. 
+        If cache is True, the statistics are first looked up in the GDAL PAM .aux.xml file next to the NetCDF file.
+        If save is True, statistics that had to be computed are written to that file for next time,
+        unless it cannot be written, eg in a read-only archive. 
+        """
+        if cache:
+            stats = self.read_pam_statistics(varname, band, xdim, ydim)
+            if stats is not None and None not in (stats["minimum"], stats["maximum"], stats["mean"], stats["stddev"]):
+                histogram = stats.get("histogram")
+                if not bins or (histogram and len(histogram["counts"]) == bins):
+                    return stats
+
+        fixed_indexes = self.calc_band_indexes(varname, band, xdim, ydim)
+        stats = self.calc_statistics(varname, bins=bins, packed=True, **fixed_indexes)
+        if save and stats["count"]:
+            try:
+                self.write_pam_statistics(varname, band, stats, xdim, ydim)
+            except (IOError, OSError, ElementTree.ParseError):
+                pass # eg a read-only archive, or an unreadable file that should not be replaced
+        return stats
+
+    def calc_band_indexes(self, varname, band, xdim="longitude", ydim="latitude"):
+        """
+        Converts a GDAL band number to the indexes of a variable's dimensions other than xdim and ydim,
+        where band 1 is the first index of all of them, and the last dimension varies fastest. 
+        """
+        layout = self.get_layout(varname)
+        otherdims = [(dimname,dimlength) for dimname,dimlength in zip(layout.dimnames, layout.shape)
+                     if dimname not in (xdim, ydim)]
+        nbands = 1
+        for _,dimlength in otherdims:
+            nbands *= dimlength
+        if not 1 <= band <= nbands:
+            raise Exception("Band must be between 1 and %s, not %s" % (nbands, band))
+
+        fixed_indexes = dict()
+        remainder = band - 1
+        for dimname,dimlength in reversed(otherdims):
+            remainder, fixed_indexes[dimname] = divmod(remainder, dimlength)
+        return fixed_indexes
+
+    def calc_band_size(self, varname, xdim="longitude", ydim="latitude"):
+        """
+        Returns the number of values in one band of a variable, along xdim and ydim. 
+        """
+        layout = self.get_layout(varname)
+        size = 1
+        for dimname,dimlength in zip(layout.dimnames, layout.shape):
+            if dimname in (xdim, ydim):
+                size *= dimlength
+        return size
+
+    def read_pam_statistics(self, varname, band=1, xdim="longitude", ydim="latitude"):
+        """
+        Reads the statistics of a band of a variable stored in the GDAL PAM .aux.xml file next to the NetCDF file,
+        as a dictionary with the same keys as calc_statistics, where values not in the file are None,
+        or None if there are no statistics or the file cannot be parsed. 
+        The count is derived from the percentage of valid values in the band, which GDAL stores instead. 
+        """
+        try:
+            root = self.load_pam()
+        except ElementTree.ParseError:
+            return None
+        bandelem = self.find_pam_band(root, varname, band) if root is not None else None
+        if bandelem is None:
+            return None
+
+        metadata = dict((mdi.get("key"), mdi.text) for mdi in bandelem.findall("Metadata/MDI"))
+        stats = dict()
+        for key in ("minimum", "maximum", "mean", "stddev"):
+            stats[key] = self.parse_pam_number(metadata.get("STATISTICS_" + key.upper()))
+        percent = self.parse_pam_number(metadata.get("STATISTICS_VALID_PERCENT"))
+        stats["count"] = None
+        if percent is not None and percent == percent:
+            stats["count"] = int(round(percent * self.calc_band_size(varname, xdim, ydim) / 100.0))
+        histitem = bandelem.find("Histograms/HistItem")
+        if histitem is not None:
+            try:
+                histogram = dict(min = self.parse_pam_number(histitem.findtext("HistMin")),
+                                 max = self.parse_pam_number(histitem.findtext("HistMax")),
+                                 counts = [int(count) for count in histitem.findtext("HistCounts").split("|")],
+                                 )
+            except (AttributeError, ValueError):
+                pass # a histogram that is incomplete
+            else:
+                if histogram["min"] is not None and histogram["max"] is not None:
+                    stats["histogram"] = histogram
+        if all((value is None for value in stats.values())):
+            return None
+        return stats
+
+    def parse_pam_number(self, text):
+        """
+        Parses a number written by GDAL, including the infinities and NaNs written by the
+        Windows C runtime, eg "1.#INF" or "-1.#IND", or returns None if it is missing or not a number. 
+        """
+        if text is None:
+            return None
+        text = text.strip()
+        if "#" in text:
+            if "#INF" in text.upper():
+                return float("-inf") if text.startswith("-") else float("inf")
+            return float("nan") # 1.#QNAN, 1.#SNAN and -1.#IND
+        try:
+            return float(text)
+        except ValueError:
+            return None
+
+    def write_pam_statistics(self, varname, band, stats, xdim="longitude", ydim="latitude"):
+        """
+        Writes the statistics of a band of a variable, as returned by calc_statistics, to the GDAL PAM
+        .aux.xml file next to the NetCDF file, replacing any earlier statistics for that band
+        and keeping everything else in the file. Only the keys that GDAL writes are used, so the
+        count is stored as the percentage of valid values in the band. 
+        """
+        root = self.load_pam()
+        if root is None:
+            root = ElementTree.Element("PAMDataset")
+        bandelem = self.find_pam_band(root, varname, band, create=True)
+
+        # histogram comes before metadata
+        for histograms in bandelem.findall("Histograms"):
+            bandelem.remove(histograms)
+        histogram = stats.get("histogram")
+        if histogram:
+            histograms = ElementTree.Element("Histograms")
+            histitem = ElementTree.SubElement(histograms, "HistItem")
+            for tag,text in (("HistMin", repr(float(histogram["min"]))),
+                             ("HistMax", repr(float(histogram["max"]))),
+                             ("BucketCount", str(len(histogram["counts"]))),
+                             ("IncludeOutOfRange", "0"),
+                             ("Approximate", "0"),
+                             ("HistCounts", "|".join(map(str, histogram["counts"])))):
+                ElementTree.SubElement(histitem, tag).text = text
+            bandelem.insert(0, histograms)
+
+        metadata = bandelem.find("Metadata")
+        if metadata is None:
+            metadata = ElementTree.SubElement(bandelem, "Metadata")
+        values = dict(("STATISTICS_" + key.upper(), stats.get(key)) for key in ("maximum", "mean", "minimum", "stddev"))
+        if stats.get("count") is not None:
+            values["STATISTICS_VALID_PERCENT"] = 100.0 * stats["count"] / self.calc_band_size(varname, xdim, ydim)
+        for mdikey,value in sorted(values.items()):
+            for mdi in metadata.findall("MDI"):
+                if mdi.get("key") == mdikey:
+                    metadata.remove(mdi)
+            if value is not None:
+                ElementTree.SubElement(metadata, "MDI", key=mdikey).text = "%.14g" % value
+        metadata[:] = sorted(metadata, key=lambda mdi: mdi.get("key"))
+
+        self.indent_pam(root)
+        path = self.filepath + ".aux.xml"
+        with open(path + ".tmp", "wb") as fileobj:
+            ElementTree.ElementTree(root).write(fileobj)
+        if os.path.exists(path):
+            os.remove(path) # cannot rename onto an existing file on windows
+        os.rename(path + ".tmp", path)
+
+    def load_pam(self):
+        path = self.filepath + ".aux.xml"
+        if not os.path.exists(path):
+            return None
+        return ElementTree.parse(path).getroot()
+
+    def find_pam_band(self, root, varname, band, create=False):
+        """
+        Finds the element of a band of a variable in a PAM file, as stored by GDAL for subdatasets,
+        optionally creating it if it does not exist. 
+        """
+        if isinstance(varname, bytes) and not isinstance(varname, str):
+            varname = varname.decode("utf8")
+        for subdataset in root.findall("Subdataset"):
+            if subdataset.get("name") == varname:
+                break
+        else:
+            if not create:
+                return None
+            subdataset = ElementTree.SubElement(root, "Subdataset", name=varname)
+        dataset = subdataset.find("PAMDataset")
+        if dataset is None:
+            if not create:
+                return None
+            dataset = ElementTree.SubElement(subdataset, "PAMDataset")
+        for bandelem in dataset.findall("PAMRasterBand"):
+            if bandelem.get("band") == str(band):
+                return bandelem
+        if not create:
+            return None
+        return ElementTree.SubElement(dataset, "PAMRasterBand", band=str(band))
+
+    def indent_pam(self, elem, level=0):
+        # indent nested elements by two spaces, as written by GDAL
+        indent = "\n" + "  " * level
+        if len(elem):
+            elem.text = indent + "  "
+            for child in elem:
+                self.indent_pam(child, level + 1)
+                child.tail = indent + "  "
+            child.tail = indent
+        if level and not elem.tail:
+            elem.tail = indent
+
+    #############
+    # Meta utilities
+    #############
+
+    def build_indexes(self, derived=None):
+        """
+        Indexes dimensions, variables and variable attributes by name, and finds the record
+        and coordinate variables and record layout once, so later lookups need no scanning. 
+        These can also be given as a dictionary of already derived values (see get_derived). 
+        """
+        self.dim_index = dict((dimdict["name"], dimdict) for dimdict in self.header["dim_list"])
+        self.var_index = dict((vardict["name"], vardict) for vardict in self.header["var_list"])
+        self.varattr_index = dict((vardict["name"], dict((attrdict["name"], attrdict["values"]) for attrdict in vardict["vatt_list"]))
+                                  for vardict in self.header["var_list"])
+
+        if derived is not None:
+            self.__dict__.update(derived)
+        else:
+            self.coordinate_variables = self.find_coordinate_variables()
+            self.record_variables = self.find_record_variables()
+            self.recsize = self.calc_recsize()
+            self.numrecs = self.calc_numrecs()
+
+        # variable layouts and coordinate lookups are computed as needed
+        self.layouts = dict()
+        self.coordinate_indexes = dict()
+
+        # overviews are loaded when first needed
+        self.overviews = None
+
+    def get_derived(self):
+        return dict(coordinate_variables = self.coordinate_variables,
+                    record_variables = self.record_variables,
+                    recsize = self.recsize,
+                    numrecs = self.numrecs,
+                    )
+
+    def get_coordinate_index(self, dimname):
+        """
+        Returns the sorted index of the values in the coordinate variable of a dimension,
+        which is read the first time it is needed. 
+        """
+        coordindex = self.coordinate_indexes.get(dimname)
+        if coordindex is None:
+            if self.get_varinfo(dimname) is None:
+                raise Exception("The %r dimension has no coordinate variable to look up values in" % dimname)
+            coordindex = self.coordinate_indexes[dimname] = _CoordinateIndex(dimname, self.read_dimension_values(dimname))
+        return coordindex
+
+    def get_label_index(self, dimname, label, method="exact"):
+        """
+        Finds the index of a value in the coordinate variable of a dimension,
+        either an exact match or if method is "nearest" the closest value. 
+        """
+        coordindex = self.get_coordinate_index(dimname)
+        if method == "exact":
+            return coordindex.exact(label)
+        elif method == "nearest":
+            return coordindex.nearest(label)
+        else:
+            raise Exception("Method must be either 'exact' or 'nearest', not %r" % method)
+
+    def get_label_range(self, dimname, minlabel, maxlabel):
+        """
+        Finds the index range of all values in the coordinate variable of a dimension that are
+        between a min and max value (inclusive), as a start index and a stop index one past the end. 
+        The two values can be given in either order, eg north to south for descending latitudes. 
+        """
+        if minlabel is not None and maxlabel is not None and minlabel > maxlabel:
+            minlabel, maxlabel = maxlabel, minlabel
+        return self.get_coordinate_index(dimname).range(minlabel, maxlabel)
+
+    def calc_wrapped_label_ranges(self, dimname, minlabel, maxlabel):
+        """
+        Finds the index ranges of a longitude coordinate variable between a min and max longitude,
+        wrapping around the globe. Returns one range, or two if crossing the seam of the coordinates,
+        ordered from west to east. 
+        """
+        coordindex = self.get_coordinate_index(dimname)
+        if not coordindex.keys or maxlabel - minlabel >= 360:
+            return [(0, len(coordindex.keys))]
+
+        # shift both longitudes into the 360 degrees starting at the westernmost coordinate
+        west = coordindex.keys[0]
+        minlabel = west + (minlabel - west) % 360
+        maxlabel = west + (maxlabel - west) % 360
+
+        if minlabel <= maxlabel:
+            ranges = [coordindex.range(minlabel, maxlabel)]
+        else:
+            ranges = [coordindex.range(minlabel, None), coordindex.range(None, maxlabel)]
+            if coordindex.descending:
+                ranges.reverse()
+        return ranges
+
+    def is_longitude(self, dimname):
+        units = self.varattr_index.get(dimname, dict()).get("units") or b""
+        units = units.rstrip(b"\x00")
+        return dimname.lower() in ("lon", "longitude") or (units.startswith(b"degree") and units.endswith((b"east", b"E")))
+
+    def get_layout(self, varname):
+        layout = self.layouts.get(varname)
+        if layout is None:
+            layout = self.layouts[varname] = self.calc_layout(varname)
+        return layout
+
+    def get_varinfo(self, varname):
+        return self.var_index.get(varname)
+
+    def get_varattr(self, varname, attr):
+        return self.varattr_index[varname].get(attr)
 
     def get_diminfo(self, dimname):
-        for dimdict in self.header["dim_list"]:
-            if dimname == dimdict["name"]:
-                return dimdict
+        return self.dim_index.get(dimname)
 
     ########
 
@@ -734,26 +2763,34 @@ class _NetCDFClassicBackend(object):
                 return dimdict
 
     def get_nonrecord_variables(self):
-        record_vars = self.get_record_variables()
-        nonrecord_vars = [var for var in self.header["var_list"] if var not in record_vars]
+        record_names = set(vardict["name"] for vardict in self.record_variables)
+        nonrecord_vars = [var for var in self.header["var_list"] if var["name"] not in record_names]
         return nonrecord_vars
 
     def get_record_variables(self):
+        return list(self.record_variables)
+
+    def get_coordinate_variables(self):
+        return list(self.coordinate_variables)
+
+    def find_record_variables(self):
         record_vars = []
-        coord_vars = self.get_coordinate_variables()
+        coord_names = set(v["name"] for v in self.coordinate_variables)
         
         for vardict in self.header["var_list"]:
             dimids = vardict["dimids"]
+            if not dimids:
+                continue # scalar variable
             dimid = dimids[0] # must be first dimension 
             diminfo = self.header["dim_list"][dimid]
-            if diminfo["dim_length"] == 0 and vardict["name"] not in (v["name"] for v in coord_vars): 
+            if diminfo["dim_length"] == 0 and vardict["name"] not in coord_names: 
                 # record variables are those whose first dimension has a length of 0, ie unlimited
                 # and that are not a coordinate variable
                 record_vars.append(vardict)
 
         return record_vars
 
-    def get_coordinate_variables(self):
+    def find_coordinate_variables(self):
         coord_vars = []
         
         for vardict in self.header["var_list"]:
@@ -768,6 +2805,1892 @@ class _NetCDFClassicBackend(object):
         return coord_vars
 
 
+
+class _NetCDF5Backend(_NetCDFClassicBackend):
+    """
+    The 64-bit data format, also known as CDF-5, which is the same as the 64-bit offset format,
+    except that dimension lengths, element counts and sizes in the header are 64-bit integers,
+    so that variables can be larger than 4 GiB, and it adds unsigned and 64-bit integer types. 
+    All reading is shared with the classic backend. 
+    """
+
+    # header integers
+    non_neg_struct = struct.Struct(">Q")
+    att_type_struct = struct.Struct(">4sQ")
+    offset_struct = struct.Struct(">q")
+
+    STREAMING = b"\xFF" * 8
+
+    formatcodes = {b"\x05": "64-bit data format"}
+
+    dtypecodes = dict(list(_NetCDFClassicBackend.dtypecodes.items())
+                      + [(b"\x00\x00\x00\x07", "NC_UBYTE"),
+                         (b"\x00\x00\x00\x08", "NC_USHORT"),
+                         (b"\x00\x00\x00\x09", "NC_UINT"),
+                         (b"\x00\x00\x00\x0A", "NC_INT64"),
+                         (b"\x00\x00\x00\x0B", "NC_UINT64"),
+                         ])
+
+    dtype_sizes = dict(_NetCDFClassicBackend.dtype_sizes,
+                       NC_UBYTE = 1,
+                       NC_USHORT = 2,
+                       NC_UINT = 4,
+                       NC_INT64 = 8,
+                       NC_UINT64 = 8,
+                       )
+
+    struct_codes = dict(_NetCDFClassicBackend.struct_codes,
+                        NC_UBYTE = "B",
+                        NC_USHORT = "H",
+                        NC_UINT = "I",
+                        NC_INT64 = "q",
+                        NC_UINT64 = "Q",
+                        )
+
+    numpy_dtypes = dict(_NetCDFClassicBackend.numpy_dtypes,
+                        NC_UBYTE = ">u1",
+                        NC_USHORT = ">u2",
+                        NC_UINT = ">u4",
+                        NC_INT64 = ">i8",
+                        NC_UINT64 = ">u8",
+                        )
+
+    array_typecodes = dict(_NetCDFClassicBackend.array_typecodes,
+                           NC_UBYTE = "B",
+                           NC_USHORT = "H",
+                           NC_UINT = _find_array_typecode("IL", 4),
+                           NC_INT64 = _find_array_typecode("lq", 8),
+                           NC_UINT64 = _find_array_typecode("LQ", 8),
+                           )
+
+    default_fill_values = dict(_NetCDFClassicBackend.default_fill_values,
+                               NC_UBYTE = 255,
+                               NC_USHORT = 65535,
+                               NC_UINT = 4294967295,
+                               NC_INT64 = -9223372036854775806,
+                               NC_UINT64 = 18446744073709551614,
+                               )
+
+    def parse_offset(self, buf, pos):
+        return self.offset_struct.unpack_from(buf, pos)[0], pos + 8
+
+
+class _NetCDF4Backend(_NetCDF5Backend):
+    """
+    The NetCDF-4 format, which stores the same data model in an HDF5 file, with the same types as the
+    64-bit data format. The HDF5 objects of the root group are parsed into a header with the same structure
+    as the other formats, where dimensions are the HDF5 dimension scales of the NetCDF-4 conventions,
+    so that all the metadata and reading methods work the same. 
+    Variables are stored either contiguously or in chunks, optionally compressed with the deflate, shuffle
+    and fletcher32 filters. The chunk index of each variable is resolved once, only the chunks intersecting
+    a read are fetched, those not already in a least recently used cache of decompressed chunks are
+    decompressed in a pool of threads (zlib releases the GIL), and the selected values are copied out of them. 
+    Only the root group is read, and variables of strings or user defined types are left out. 
+    """
+
+    # the maximum number of bytes of decompressed chunks to keep in the chunk cache
+    chunk_cache_size = 64*1024*1024
+
+
+    # Constants
+
+    SIGNATURE = b"\x89HDF\r\n\x1a\n"
+    DIMENSION_SCALE = b"DIMENSION_SCALE"
+    DIMENSION_ONLY = b"This is a netCDF dimension but not a netCDF variable"
+
+    # attributes of the dimension scale and NetCDF-4 conventions, which are not shown as attributes
+    hidden_attributes = frozenset([b"CLASS", b"NAME", b"REFERENCE_LIST", b"DIMENSION_LIST",
+                                   b"_Netcdf4Dimid", b"_Netcdf4Coordinates", b"_nc3_strict",
+                                   b"_NCProperties", b"_SuperblockVersion", b"_IsNetcdf4"])
+
+
+    # Dictionary lookups
+
+    message_types = {0x0001: "DATASPACE",
+                     0x0002: "LINK_INFO",
+                     0x0003: "DATATYPE",
+                     0x0004: "FILL_VALUE_OLD",
+                     0x0005: "FILL_VALUE",
+                     0x0006: "LINK",
+                     0x0008: "DATA_LAYOUT",
+                     0x000B: "FILTER_PIPELINE",
+                     0x000C: "ATTRIBUTE",
+                     0x0010: "CONTINUATION",
+                     0x0011: "SYMBOL_TABLE",
+                     0x0015: "ATTRIBUTE_INFO",
+                     }
+
+    chunk_index_types = {1: "single",
+                         2: "implicit",
+                         3: "fixedarray",
+                         4: "extensiblearray",
+                         5: "btree2",
+                         }
+
+    integer_types = {(1, True): "NC_BYTE",
+                     (1, False): "NC_UBYTE",
+                     (2, True): "NC_SHORT",
+                     (2, False): "NC_USHORT",
+                     (4, True): "NC_INT",
+                     (4, False): "NC_UINT",
+                     (8, True): "NC_INT64",
+                     (8, False): "NC_UINT64",
+                     }
+
+    float_types = {4: "NC_FLOAT",
+                   8: "NC_DOUBLE",
+                   }
+
+    # little endian integers of each size, and array.array typecodes of each size for swapping byte order
+    uint_structs = {1: struct.Struct("<B"),
+                    2: struct.Struct("<H"),
+                    4: struct.Struct("<I"),
+                    8: struct.Struct("<Q"),
+                    }
+    swap_typecodes = {2: "h",
+                      4: "f",
+                      8: "d",
+                      }
+
+
+    ##########
+    # Header
+    ##########
+
+    # The superblock and object headers are parsed with the same kind of methods as the classic header,
+    # taking a buffer and a position and returning the parsed value along with the position right after it,
+    # while read methods read and parse a whole structure at an address in the file.
+
+    def read_header(self, strict=True):
+        """
+        Reads the HDF5 superblock and the objects of the root group, and builds a header
+        with the same structure as the other formats. 
+        """
+        self.strict = strict
+        superblock, rootaddress = self.read_superblock()
+        self.global_heaps = dict()
+        self.header = self.read_root_group(rootaddress)
+        self.header.update( superblock = superblock )
+        self.build_indexes()
+        return self.header
+
+    def load_header(self, header, layouts, derived=None):
+        self.set_superblock(header["superblock"])
+        return _NetCDFClassicBackend.load_header(self, header, layouts, derived)
+
+    def build_indexes(self, derived=None):
+        _NetCDFClassicBackend.build_indexes(self, derived)
+
+        # chunk indexes and decompressed chunks are read as needed
+        self.chunk_indexes = dict()
+        self.chunk_cache = collections.OrderedDict()
+        self.chunk_cache_used = 0
+        self.chunk_lock = threading.Lock()
+        self.global_heaps = dict()
+
+    def read_superblock(self):
+        buf = self.read_bytes_at(0, 256)
+        signature, version = struct.unpack_from("<8sB", buf, 0)
+        if signature != self.SIGNATURE:
+            raise Exception("Not an HDF5 file")
+        if version in (0, 1):
+            offset_size, length_size = struct.unpack_from("<BB", buf, 13)
+            pos = 24 if version == 0 else 28
+        elif version in (2, 3):
+            offset_size, length_size = struct.unpack_from("<BB", buf, 9)
+            pos = 12
+        else:
+            raise Exception("HDF5 superblock version %s is not supported" % version)
+        base_address = self.uint_structs[offset_size].unpack_from(buf, pos)[0]
+        superblock = dict(version = version,
+                          offset_size = offset_size,
+                          length_size = length_size,
+                          base_address = base_address,
+                          )
+        self.set_superblock(superblock)
+
+        # the root group object header, given in a symbol table entry in older versions
+        if version in (0, 1):
+            rootaddress, _ = self.parse_address(buf, pos + 5*offset_size)
+        else:
+            rootaddress, _ = self.parse_address(buf, pos + 3*offset_size)
+        return superblock, rootaddress
+
+    def set_superblock(self, superblock):
+        self.offset_size = superblock["offset_size"]
+        self.length_size = superblock["length_size"]
+        self.base_address = superblock["base_address"]
+        self.undefined_address = 2**(8*self.offset_size) - 1
+        self.unlimited_length = 2**(8*self.length_size) - 1
+
+    def read_root_group(self, address):
+        """
+        Reads the datasets of the root group, and converts them to the dimensions and variables
+        of the classic header structure, along with the attributes of the root group. 
+        """
+        group = self.read_object(address)
+        datasets = []
+        for name,linkaddress,_ in group["links"]:
+            obj = self.read_object(linkaddress)
+            if obj["layout"] is not None and obj["dataspace"] is not None and obj["datatype"] is not None:
+                attrs = collections.OrderedDict()
+                for attname,datatype,n,raw in obj["attributes"]:
+                    converted = self.calc_attribute_values(datatype, n, raw)
+                    if converted is not None:
+                        attrs[attname] = converted
+                datasets.append((name, linkaddress, obj, attrs))
+
+        # dimensions are the dimension scales, in order of their NetCDF-4 dimension ids if given
+        scales = [(name, address, obj, attrs) for name,address,obj,attrs in datasets
+                  if self.get_attribute_value(attrs, b"CLASS", b"").rstrip(b"\x00") == self.DIMENSION_SCALE]
+        scales = [scale for _,scale in sorted(enumerate(scales), key=lambda item: (self.get_attribute_value(item[1][3], b"_Netcdf4Dimid", len(scales) + item[0]), item[0]))]
+        dim_list = []
+        dimids = dict()
+        netcdf_dimids = dict()
+        unlimited = []
+        for name,address,obj,attrs in scales:
+            shape, maxshape = obj["dataspace"]
+            dimids[address] = len(dim_list)
+            netcdf_dimids[self.get_attribute_value(attrs, b"_Netcdf4Dimid", len(dim_list))] = len(dim_list)
+            if maxshape and maxshape[0] == self.unlimited_length:
+                unlimited.append(len(dim_list))
+            dim_list.append(dict( name = name,
+                                  dim_length = shape[0] if shape else 0,
+                                  ))
+
+        # variables are all other datasets of supported types
+        var_list = []
+        phony_dims = []
+        for name,address,obj,attrs in datasets:
+            if self.get_attribute_value(attrs, b"NAME", b"").startswith(self.DIMENSION_ONLY):
+                continue
+            datatype = obj["datatype"]
+            if datatype["nc_type"] not in self.dtype_sizes or (datatype["nc_type"] == "NC_CHAR" and datatype["size"] != 1):
+                continue
+            shape, maxshape = obj["dataspace"]
+            shape = shape or ()
+
+            # the dimension of a coordinate variable is itself, otherwise the attached dimension scales
+            if address in dimids and len(shape) == 1:
+                var_dimids = [dimids[address]]
+            elif b"_Netcdf4Coordinates" in attrs:
+                var_dimids = [netcdf_dimids[dimid] for dimid in self.as_list(attrs[b"_Netcdf4Coordinates"][2])]
+            else:
+                refs = attrs[b"DIMENSION_LIST"][2] if b"DIMENSION_LIST" in attrs else [()] * len(shape)
+                var_dimids = [dimids.get(dimrefs[0]) if dimrefs else None for dimrefs in refs]
+
+            # like the netCDF library, dimensions without a dimension scale become phony dimensions,
+            # shared by all variables with a dimension of the same length
+            for i,dimid in enumerate(var_dimids):
+                if dimid is None:
+                    for phony_dimid in phony_dims:
+                        if dim_list[phony_dimid]["dim_length"] == shape[i] and phony_dimid not in var_dimids:
+                            var_dimids[i] = phony_dimid
+                            break
+                    else:
+                        var_dimids[i] = len(dim_list)
+                        phony_dims.append(len(dim_list))
+                        dim_list.append(dict( name = ("phony_dim_%i" % (len(phony_dims) - 1)).encode("ascii"),
+                                              dim_length = shape[i],
+                                              ))
+
+            # unlimited dimensions are as long as the longest variable along them
+            for dimid,length in zip(var_dimids, shape):
+                if dimid in unlimited and length > dim_list[dimid]["dim_length"]:
+                    dim_list[dimid]["dim_length"] = length
+
+            storage = dict(obj["layout"])
+            storage.update( byteorder = datatype["byteorder"],
+                            itemsize = datatype["size"],
+                            shape = shape,
+                            maxshape = maxshape,
+                            filters = obj["filters"],
+                            fill = self.to_big_endian(obj["fill"] or b"\x00" * datatype["size"], datatype["byteorder"], datatype["size"]),
+                            )
+            var_list.append(dict( name = name,
+                                  nelems = len(var_dimids),
+                                  dimids = var_dimids,
+                                  vatt_list = self.calc_attribute_list(attrs),
+                                  nc_type = datatype["nc_type"],
+                                  begin = storage["address"] if storage["layout"] == "contiguous" else None,
+                                  storage = storage,
+                                  ))
+
+        # the first unlimited dimension is the record dimension
+        numrecs = 0
+        if unlimited:
+            recdim = dim_list[unlimited[0]]
+            numrecs = recdim["dim_length"]
+            recdim["dim_length"] = 0
+        for vardict in var_list:
+            nvalues = 1
+            for i,dimid in enumerate(vardict["dimids"]):
+                if not (i == 0 and dim_list[dimid]["dim_length"] == 0):
+                    nvalues *= dim_list[dimid]["dim_length"]
+            vardict["vsize"] = self.round_nearest_4byte_boundary(nvalues * self.dtype_sizes[vardict["nc_type"]])
+
+        header = dict(magic = (self.SIGNATURE, "NetCDF-4 format"),
+                      numrecs = numrecs,
+                      dim_list = dim_list,
+                      gatt_list = self.calc_attribute_list(self.calc_group_attributes(group)),
+                      var_list = var_list,
+                      )
+        return header
+
+    def calc_group_attributes(self, group):
+        attrs = collections.OrderedDict()
+        for attname,datatype,n,raw in group["attributes"]:
+            converted = self.calc_attribute_values(datatype, n, raw)
+            if converted is not None:
+                attrs[attname] = converted
+        return attrs
+
+    def calc_attribute_list(self, attrs):
+        return [dict( name = name,
+                      nc_type = nc_type,
+                      nelems = nelems,
+                      values = values,
+                      )
+                for name,(nc_type,nelems,values) in attrs.items()
+                if name not in self.hidden_attributes and nc_type != "VLEN"]
+
+    def get_attribute_value(self, attrs, name, default=None):
+        if name in attrs:
+            return attrs[name][2]
+        return default
+
+    def calc_attribute_values(self, datatype, n, raw):
+        """
+        Converts the raw bytes of an attribute's values to the same values as the classic header,
+        returning the nc_type, number of values and values, or None if of an unsupported type. 
+        Variable length strings are returned as a string, or a tuple of strings if there are more than one,
+        and variable length sequences of object references (used to attach dimension scales)
+        as a list of tuples of addresses. 
+        """
+        nc_type = datatype["nc_type"]
+        size = datatype["size"]
+        if nc_type == "NC_CHAR":
+            values = bytes(raw[:n*size])
+            return nc_type, len(values), values
+        elif nc_type == "NC_STRING":
+            strings = self.read_vlen_values(raw, n)
+            return nc_type, n, strings[0] if n == 1 else tuple(strings)
+        elif nc_type == "VLEN":
+            if datatype["base"]["nc_type"] != "REFERENCE":
+                return None
+            sequences = [tuple(self.parse_address(sequence, pos)[0] for pos in range(0, len(sequence), self.offset_size))
+                         for sequence in self.read_vlen_values(raw, n)]
+            return nc_type, n, sequences
+        elif nc_type in self.dtype_sizes:
+            buf = self.to_big_endian(raw[:n*size], datatype["byteorder"], size)
+            values, _ = self.parse_values(buf + b"\x00" * (-len(buf) % 4), 0, nc_type, n)
+            return nc_type, n, values
+        return None
+
+    def read_vlen_values(self, raw, n):
+        # each value is a length, followed by the global heap collection and index of the object holding it
+        values = []
+        for i in range(n):
+            pos = i * (8 + self.offset_size)
+            length = self.uint_structs[4].unpack_from(raw, pos)[0]
+            collection, pos = self.parse_address(raw, pos + 4)
+            index = self.uint_structs[4].unpack_from(raw, pos)[0]
+            values.append(self.read_global_heap_object(collection, index) if length and collection is not None else b"")
+        return values
+
+    def read_global_heap_object(self, address, index):
+        """
+        Returns an object from a global heap collection, which is read and split into objects
+        the first time it is needed. 
+        """
+        collection = self.global_heaps.get(address)
+        if collection is None:
+            head = self.read_bytes_at(address, 8 + self.length_size)
+            if struct.unpack_from("4s", head)[0] != b"GCOL":
+                raise Exception("Expected a global heap collection at address %s" % address)
+            size, _ = self.parse_uint(head, 8, self.length_size)
+            buf = bytes(self.read_bytes_at(address, size))
+            collection = dict()
+            pos = 8 + self.length_size
+            while pos + 8 + self.length_size <= size:
+                objindex = self.uint_structs[2].unpack_from(buf, pos)[0]
+                if objindex == 0:
+                    break # the rest is free space
+                objsize, pos = self.parse_uint(buf, pos + 8, self.length_size)
+                collection[objindex] = buf[pos:pos+objsize]
+                pos += objsize + (-objsize % 8)
+            self.global_heaps[address] = collection
+        return collection[index]
+
+
+    # OBJECT HEADERS
+
+    def read_object(self, address):
+        """
+        Reads the object header of a group or dataset, and returns a dictionary of the parts needed:
+        the links to its members if a group, the dataspace, datatype, data layout, filters and fill value
+        if a dataset, and its attributes as (name, datatype, number of values, raw values) tuples. 
+        """
+        obj = dict(links = [],
+                   attributes = [],
+                   dataspace = None,
+                   datatype = None,
+                   layout = None,
+                   filters = [],
+                   fill = None,
+                   )
+        for msgtype,msgflags,data in self.read_object_header(address):
+            name = self.message_types.get(msgtype)
+            if name == "DATASPACE":
+                obj["dataspace"] = self.parse_dataspace(data, 0)
+            elif name == "DATATYPE":
+                if msgflags & 0x02:
+                    obj["datatype"] = dict(nc_type=None, size=0, byteorder=">") # a shared, ie user defined type
+                else:
+                    obj["datatype"] = self.parse_datatype(data, 0)
+            elif name == "FILL_VALUE":
+                obj["fill"] = self.parse_fill_value(data)
+            elif name == "FILL_VALUE_OLD" and obj["fill"] is None:
+                size = self.uint_structs[4].unpack_from(data, 0)[0]
+                obj["fill"] = data[4:4+size] or None
+            elif name == "DATA_LAYOUT":
+                obj["layout"] = self.parse_data_layout(data)
+            elif name == "FILTER_PIPELINE":
+                obj["filters"] = self.parse_filter_pipeline(data)
+            elif name == "ATTRIBUTE":
+                obj["attributes"].append(self.parse_attribute(data))
+            elif name == "ATTRIBUTE_INFO":
+                obj["attributes"].extend(self.read_dense_attributes(data))
+            elif name == "LINK":
+                link = self.parse_link(data)
+                if link is not None:
+                    obj["links"].append(link)
+            elif name == "LINK_INFO":
+                obj["links"].extend(self.read_dense_links(data))
+            elif name == "SYMBOL_TABLE":
+                obj["links"].extend(self.read_symbol_table(data))
+
+        # links in the order they were created if tracked, otherwise by name
+        if obj["links"] and all(( corder is not None for _,_,corder in obj["links"] )):
+            obj["links"].sort(key=lambda link: link[2])
+        else:
+            obj["links"].sort()
+        return obj
+
+    def read_object_header(self, address):
+        """
+        Reads the messages of a version 1 or 2 object header, following any continuation blocks. 
+        Returns a list of (message type, message flags, message data) tuples. 
+        """
+        prefix = self.read_bytes_at(address, 48)
+        if struct.unpack_from("4s", prefix)[0] == b"OHDR":
+            version, flags = struct.unpack_from("<BB", prefix, 4)
+            pos = 6
+            if flags & 0x20:
+                pos += 16 # access, modification, change and birth times
+            if flags & 0x10:
+                pos += 4 # attribute storage phase change values
+            size, pos = self.parse_uint(prefix, pos, 1 << (flags & 0x03))
+            headersize = 6 if flags & 0x04 else 4 # with the creation order of each message if tracked
+            blocks = [(address + pos, size, 0)]
+        else:
+            version = struct.unpack_from("<B", prefix, 0)[0]
+            if version != 1:
+                raise Exception("Object header version %s is not supported" % version)
+            size = self.uint_structs[4].unpack_from(prefix, 8)[0]
+            headersize = 8
+            blocks = [(address + 16, size, 0)]
+
+        messages = []
+        while blocks:
+            blockaddress, blocksize, pos = blocks.pop(0)
+            buf = self.read_bytes_at(blockaddress, blocksize)
+            end = blocksize - 4 if pos else blocksize # continuation blocks of version 2 end with a checksum
+            while pos + headersize <= end:
+                if version == 1:
+                    msgtype, msgsize, msgflags = struct.unpack_from("<HHB", buf, pos)
+                else:
+                    msgtype, msgsize, msgflags = struct.unpack_from("<BHB", buf, pos)
+                pos += headersize
+                data = bytes(buf[pos:pos+msgsize])
+                pos += msgsize
+                if msgtype == 0x10:
+                    # continue in another block, which in version 2 starts with a signature
+                    contaddress, contpos = self.parse_address(data, 0)
+                    contsize, _ = self.parse_uint(data, contpos, self.length_size)
+                    blocks.append((contaddress, contsize, 4 if version == 2 else 0))
+                elif msgtype != 0:
+                    messages.append((msgtype, msgflags, data))
+        return messages
+
+    def parse_dataspace(self, buf, pos):
+        """
+        Returns the shape of a dataspace, and its maximum shape if given, with None as the shape
+        if it has no values at all. 
+        """
+        version, rank, flags = struct.unpack_from("<BBB", buf, pos)
+        if version == 1:
+            pos += 8
+        else:
+            if struct.unpack_from("<B", buf, pos + 3)[0] == 2:
+                return None, None # null dataspace
+            pos += 4
+        shape = []
+        for _ in range(rank):
+            length, pos = self.parse_uint(buf, pos, self.length_size)
+            shape.append(length)
+        maxshape = None
+        if flags & 0x01:
+            maxshape = []
+            for _ in range(rank):
+                length, pos = self.parse_uint(buf, pos, self.length_size)
+                maxshape.append(length)
+            maxshape = tuple(maxshape)
+        return tuple(shape), maxshape
+
+    def parse_datatype(self, buf, pos):
+        """
+        Returns the nc_type, size and byte order of a datatype, where the nc_type is None if not supported. 
+        """
+        classversion, bits0, bits1, bits2, size = struct.unpack_from("<BBBBI", buf, pos)
+        typeclass = classversion & 0x0F
+        datatype = dict(nc_type = None,
+                        size = size,
+                        byteorder = ">" if bits0 & 0x01 else "<",
+                        )
+        if typeclass == 0:
+            datatype["nc_type"] = self.integer_types.get((size, bool(bits0 & 0x08)))
+        elif typeclass == 1:
+            datatype["nc_type"] = self.float_types.get(size)
+        elif typeclass == 3:
+            datatype.update( nc_type = "NC_CHAR", byteorder = ">" )
+        elif typeclass == 7:
+            datatype["nc_type"] = "REFERENCE"
+        elif typeclass == 9:
+            if bits0 & 0x0F == 1:
+                datatype["nc_type"] = "NC_STRING"
+            else:
+                datatype.update( nc_type = "VLEN", base = self.parse_datatype(buf, pos + 8) )
+        return datatype
+
+    def parse_fill_value(self, data):
+        version = struct.unpack_from("<B", data, 0)[0]
+        if version in (1, 2):
+            defined = struct.unpack_from("<B", data, 3)[0]
+            if version == 1 or defined:
+                size = self.uint_structs[4].unpack_from(data, 4)[0]
+                return data[8:8+size] or None
+        elif version == 3:
+            flags = struct.unpack_from("<B", data, 1)[0]
+            if flags & 0x20:
+                size = self.uint_structs[4].unpack_from(data, 2)[0]
+                return data[6:6+size] or None
+        return None
+
+    def parse_data_layout(self, data):
+        """
+        Returns how a dataset's values are stored, either "compact" in the object header, "contiguous"
+        at an address, or "chunked" with a chunk shape and the type and address of the chunk index. 
+        """
+        layout = dict(layout = None,
+                      address = None,
+                      data = None,
+                      chunk_shape = None,
+                      index = None,
+                      index_address = None,
+                      )
+        version = struct.unpack_from("<B", data, 0)[0]
+        if version in (1, 2):
+            dimensionality, layoutclass = struct.unpack_from("<BB", data, 1)
+            pos = 8
+            if layoutclass != 0:
+                address, pos = self.parse_address(data, pos)
+            dims = struct.unpack_from("<%iI" % dimensionality, data, pos)
+            pos += 4 * dimensionality
+            if layoutclass == 0:
+                size = self.uint_structs[4].unpack_from(data, pos)[0]
+                layout.update( layout = "compact", data = data[pos+4:pos+4+size] )
+            elif layoutclass == 1:
+                layout.update( layout = "contiguous", address = address )
+            elif layoutclass == 2:
+                layout.update( layout = "chunked", chunk_shape = dims[:-1], index = "btree1", index_address = address )
+        elif version in (3, 4):
+            layoutclass = struct.unpack_from("<B", data, 1)[0]
+            if layoutclass == 0:
+                size = self.uint_structs[2].unpack_from(data, 2)[0]
+                layout.update( layout = "compact", data = data[4:4+size] )
+            elif layoutclass == 1:
+                address, _ = self.parse_address(data, 2)
+                layout.update( layout = "contiguous", address = address )
+            elif layoutclass == 2 and version == 3:
+                dimensionality = struct.unpack_from("<B", data, 2)[0]
+                address, pos = self.parse_address(data, 3)
+                dims = struct.unpack_from("<%iI" % dimensionality, data, pos)
+                layout.update( layout = "chunked", chunk_shape = dims[:-1], index = "btree1", index_address = address )
+            elif layoutclass == 2:
+                flags, dimensionality, encsize = struct.unpack_from("<BBB", data, 2)
+                pos = 5
+                dims = []
+                for _ in range(dimensionality):
+                    dim, pos = self.parse_uint(data, pos, encsize)
+                    dims.append(dim)
+                indextype = struct.unpack_from("<B", data, pos)[0]
+                pos += 1
+                layout.update( layout = "chunked",
+                               chunk_shape = tuple(dims[:-1]),
+                               index = self.chunk_index_types.get(indextype),
+                               unfiltered_edges = bool(flags & 0x01),
+                               )
+                if indextype == 1 and flags & 0x02:
+                    # a single filtered chunk, with its size and filter mask
+                    size, pos = self.parse_uint(data, pos, self.length_size)
+                    mask = self.uint_structs[4].unpack_from(data, pos)[0]
+                    layout.update( single_size = size, single_mask = mask )
+                    pos += 4
+                else:
+                    pos += {1: 0, 2: 0, 3: 1, 4: 5, 5: 6}.get(indextype, 0) # index parameters, read from the index itself
+                layout["index_address"], _ = self.parse_address(data, pos)
+            else:
+                layout["layout"] = "virtual"
+        else:
+            raise Exception("Data layout message version %s is not supported" % version)
+        return layout
+
+    def parse_filter_pipeline(self, data):
+        """
+        Returns the filters applied to each chunk as a list of (filter id, client values) tuples. 
+        """
+        version, nfilters = struct.unpack_from("<BB", data, 0)
+        pos = 8 if version == 1 else 2
+        filters = []
+        for _ in range(nfilters):
+            filterid = self.uint_structs[2].unpack_from(data, pos)[0]
+            pos += 2
+            namelength = 0
+            if version == 1 or filterid >= 256:
+                namelength = self.uint_structs[2].unpack_from(data, pos)[0]
+                pos += 2
+            flags, nvalues = struct.unpack_from("<HH", data, pos)
+            pos += 4
+            pos += namelength + (-namelength % 8 if version == 1 else 0)
+            values = struct.unpack_from("<%iI" % nvalues, data, pos)
+            pos += 4 * nvalues
+            if version == 1 and nvalues % 2:
+                pos += 4 # padding
+            filters.append((filterid, values))
+        return filters
+
+    def parse_attribute(self, data):
+        """
+        Returns the name, datatype, number of values and raw values of an attribute message. 
+        """
+        version = struct.unpack_from("<B", data, 0)[0]
+        if version == 3:
+            flags, namesize, typesize, spacesize = struct.unpack_from("<BHHH", data, 1)
+            pos = 9
+        else:
+            flags, namesize, typesize, spacesize = struct.unpack_from("<BHHH", data, 1)
+            pos = 8
+        padded = (lambda size: size + (-size % 8)) if version == 1 else (lambda size: size)
+
+        name = data[pos:pos+namesize].rstrip(b"\x00")
+        pos += padded(namesize)
+        if flags & 0x01:
+            datatype = dict(nc_type=None, size=0, byteorder=">") # a shared, ie user defined type
+        else:
+            datatype = self.parse_datatype(data, pos)
+        pos += padded(typesize)
+        shape, _ = self.parse_dataspace(data, pos)
+        pos += padded(spacesize)
+
+        n = 0
+        if shape is not None:
+            n = 1
+            for length in shape:
+                n *= length
+        return name, datatype, n, data[pos:]
+
+
+    # GROUP MEMBERS
+
+    def parse_link(self, data):
+        """
+        Returns the name, object address and creation order (or None) of a hard link,
+        or None for soft and external links. 
+        """
+        version, flags = struct.unpack_from("<BB", data, 0)
+        pos = 2
+        linktype = 0
+        if flags & 0x08:
+            linktype = struct.unpack_from("<B", data, pos)[0]
+            pos += 1
+        corder = None
+        if flags & 0x04:
+            corder = self.uint_structs[8].unpack_from(data, pos)[0]
+            pos += 8
+        if flags & 0x10:
+            pos += 1 # character set
+        namelength, pos = self.parse_uint(data, pos, 1 << (flags & 0x03))
+        name = bytes(data[pos:pos+namelength])
+        if linktype != 0:
+            return None
+        address, _ = self.parse_address(data, pos + namelength)
+        return name, address, corder
+
+    def read_symbol_table(self, data):
+        """
+        Returns the links of an old style group, stored in a version 1 B-tree of symbol table nodes
+        with their names in a local heap. 
+        """
+        btreeaddress, pos = self.parse_address(data, 0)
+        heapaddress, _ = self.parse_address(data, pos)
+        heap = self.read_bytes_at(heapaddress, 8 + 2*self.length_size + self.offset_size)
+        if struct.unpack_from("4s", heap)[0] != b"HEAP":
+            raise Exception("Expected a local heap at address %s" % heapaddress)
+        datasize, pos = self.parse_uint(heap, 8, self.length_size)
+        dataaddress, _ = self.parse_address(heap, pos + self.length_size)
+        names = bytes(self.read_bytes_at(dataaddress, datasize))
+
+        links = []
+        entrysize = 2*self.offset_size + 24
+        for _,nodeaddress in self.read_btree_v1(btreeaddress, self.length_size):
+            nsymbols = self.uint_structs[2].unpack_from(self.read_bytes_at(nodeaddress, 8), 6)[0]
+            node = self.read_bytes_at(nodeaddress, 8 + nsymbols*entrysize)
+            for i in range(nsymbols):
+                pos = 8 + i*entrysize
+                nameoffset, pos = self.parse_uint(node, pos, self.offset_size)
+                objaddress, _ = self.parse_address(node, pos)
+                links.append((names[nameoffset:names.index(b"\x00", nameoffset)], objaddress, None))
+        return links
+
+    def read_dense_links(self, data):
+        """
+        Returns the links of a new style group with many members, stored in a fractal heap
+        and indexed by name in a version 2 B-tree. 
+        """
+        flags = struct.unpack_from("<B", data, 1)[0]
+        pos = 10 if flags & 0x01 else 2
+        heapaddress, pos = self.parse_address(data, pos)
+        nameindex, _ = self.parse_address(data, pos)
+        if heapaddress is None or nameindex is None:
+            return []
+        heap = self.read_fractal_heap(heapaddress)
+        links = []
+        for record in self.read_btree_v2(nameindex):
+            link = self.parse_link(self.read_heap_object(heap, record[4:])) # after the name hash
+            if link is not None:
+                links.append(link)
+        return links
+
+    def read_dense_attributes(self, data):
+        """
+        Returns the attributes of an object with many attributes, stored in a fractal heap
+        and indexed by name in a version 2 B-tree, in the order they were created if tracked. 
+        """
+        flags = struct.unpack_from("<B", data, 1)[0]
+        pos = 4 if flags & 0x01 else 2
+        heapaddress, pos = self.parse_address(data, pos)
+        nameindex, _ = self.parse_address(data, pos)
+        if heapaddress is None or nameindex is None:
+            return []
+        heap = self.read_fractal_heap(heapaddress)
+        attributes = [(self.uint_structs[4].unpack_from(record, 9)[0], self.parse_attribute(self.read_heap_object(heap, record[:8])))
+                      for record in self.read_btree_v2(nameindex)]
+        attributes.sort(key=lambda item: (item[0], item[1][0])) # by name if creation order is not tracked
+        return [attribute for _,attribute in attributes]
+
+
+    # B-TREES AND HEAPS
+
+    def read_bytes_at(self, offset, n):
+        # copied out of any memory map, since the structures are sliced and decompressed
+        return bytes(self.read_at(offset, n))
+
+    def parse_uint(self, buf, pos, size):
+        if size in self.uint_structs:
+            return self.uint_structs[size].unpack_from(buf, pos)[0], pos + size
+        value = 0
+        for byte in reversed(bytearray(buf[pos:pos+size])):
+            value = value << 8 | byte
+        return value, pos + size
+
+    def parse_address(self, buf, pos):
+        # addresses are relative to the base address, and undefined addresses are None
+        address, pos = self.parse_uint(buf, pos, self.offset_size)
+        if address == self.undefined_address:
+            return None, pos
+        return self.base_address + address, pos
+
+    def calc_encoded_size(self, maxvalue):
+        # the number of bytes used to store numbers up to a maximum value
+        return (max(maxvalue, 1).bit_length() - 1) // 8 + 1
+
+    def read_btree_v1(self, address, keysize):
+        """
+        Returns the key and child address of every entry in the leaf nodes of a version 1 B-tree. 
+        """
+        entries = []
+        if address is None:
+            return entries
+        headersize = 8 + 2*self.offset_size
+        nodes = [address]
+        while nodes:
+            nodeaddress = nodes.pop(0)
+            level, nentries = struct.unpack_from("<BH", self.read_bytes_at(nodeaddress, 8), 5)
+            buf = self.read_bytes_at(nodeaddress, headersize + nentries*(keysize + self.offset_size) + keysize)
+            pos = headersize
+            for _ in range(nentries):
+                key = bytes(buf[pos:pos+keysize])
+                child, pos = self.parse_address(buf, pos + keysize)
+                if level > 0:
+                    nodes.append(child)
+                else:
+                    entries.append((key, child))
+        return entries
+
+    def read_btree_v2(self, address):
+        """
+        Returns the raw records of a version 2 B-tree, in no particular order. 
+        """
+        buf = self.read_bytes_at(address, 16 + self.offset_size + 2)
+        nodesize, recordsize, depth = struct.unpack_from("<IHH", buf, 6)
+        root, pos = self.parse_address(buf, 16)
+        rootrecords = self.uint_structs[2].unpack_from(buf, pos)[0]
+        if root is None:
+            return []
+
+        # the sizes of the record counts of the children of internal nodes depend on the
+        # maximum number of records in and below a node at each depth, which depend on the node size
+        prefixsize = 10 # signature, version, type and checksum
+        maxrecords = [(nodesize - prefixsize) // recordsize]
+        cumrecords = [maxrecords[0]]
+        countsizes = [self.calc_encoded_size(maxrecords[0])]
+        cumsizes = [0]
+        for d in range(1, depth + 1):
+            pointersize = self.offset_size + countsizes[d-1] + cumsizes[d-1]
+            maxrecords.append((nodesize - prefixsize - pointersize) // (recordsize + pointersize))
+            cumrecords.append((maxrecords[d] + 1) * cumrecords[d-1] + maxrecords[d])
+            countsizes.append(self.calc_encoded_size(maxrecords[d]))
+            cumsizes.append(self.calc_encoded_size(cumrecords[d]))
+
+        records = []
+        nodes = [(root, rootrecords, depth)]
+        while nodes:
+            nodeaddress, nrecords, nodedepth = nodes.pop()
+            buf = self.read_bytes_at(nodeaddress, nodesize)
+            pos = 6
+            for _ in range(nrecords):
+                records.append(bytes(buf[pos:pos+recordsize]))
+                pos += recordsize
+            if nodedepth > 0:
+                for _ in range(nrecords + 1):
+                    child, pos = self.parse_address(buf, pos)
+                    childrecords, pos = self.parse_uint(buf, pos, countsizes[nodedepth-1])
+                    pos += cumsizes[nodedepth-1] # the total number of records below the child
+                    nodes.append((child, childrecords, nodedepth - 1))
+        return records
+
+    def read_fractal_heap(self, address):
+        """
+        Reads the header of a fractal heap and finds the heap offset, size and address of all its direct blocks,
+        so that objects can be looked up by their heap ids. 
+        """
+        O, L = self.offset_size, self.length_size
+        buf = self.read_bytes_at(address, 48 + 12*L + 3*O)
+        if struct.unpack_from("4s", buf)[0] != b"FRHP":
+            raise Exception("Expected a fractal heap at address %s" % address)
+        filterlength, flags, maxmanaged = struct.unpack_from("<HBI", buf, 7)
+        pos = 14 + 10*L + 2*O
+        width = self.uint_structs[2].unpack_from(buf, pos)[0]
+        startsize, pos = self.parse_uint(buf, pos + 2, L)
+        maxdirect, pos = self.parse_uint(buf, pos, L)
+        maxheapbits = self.uint_structs[2].unpack_from(buf, pos)[0]
+        rootaddress, pos = self.parse_address(buf, pos + 4)
+        rootrows = self.uint_structs[2].unpack_from(buf, pos)[0]
+        if filterlength:
+            raise Exception("Fractal heaps with filters are not supported")
+
+        heap = dict(width = width,
+                    start_size = startsize,
+                    max_direct_size = maxdirect,
+                    offset_size = (maxheapbits + 7) // 8,
+                    length_size = min((maxdirect.bit_length() - 1 + 7) // 8, self.calc_encoded_size(maxmanaged)),
+                    blocks = [],
+                    )
+        if rootaddress is not None:
+            if rootrows == 0:
+                heap["blocks"].append((0, startsize, rootaddress))
+            else:
+                self.read_indirect_block(heap, rootaddress, rootrows, 0)
+        heap["blocks"].sort()
+        heap["block_offsets"] = [blockoffset for blockoffset,_,_ in heap["blocks"]]
+        return heap
+
+    def read_indirect_block(self, heap, address, nrows, blockoffset):
+        # blocks double in size every row after the first two, up to the maximum direct block size,
+        # after which rows are indirect blocks of their own
+        width = heap["width"]
+        startbits = heap["start_size"].bit_length() - 1
+        maxdirectrows = (heap["max_direct_size"].bit_length() - 1) - startbits + 2
+        nentries = nrows * width
+        ndirect = min(nrows, maxdirectrows) * width
+        headersize = 5 + self.offset_size + heap["offset_size"]
+        buf = self.read_bytes_at(address, headersize + nentries*self.offset_size)
+        pos = headersize
+        for i in range(nentries):
+            row = i // width
+            size = heap["start_size"] * 2**max(0, row - 1)
+            child, pos = self.parse_address(buf, pos)
+            if child is not None:
+                if i < ndirect:
+                    heap["blocks"].append((blockoffset, size, child))
+                else:
+                    childrows = (size.bit_length() - 1) - startbits - (width.bit_length() - 1) + 1
+                    self.read_indirect_block(heap, child, childrows, blockoffset)
+            blockoffset += size
+
+    def read_heap_object(self, heap, heapid):
+        flags = bytearray(heapid[:1])[0]
+        idtype = (flags >> 4) & 0x03
+        if idtype == 0:
+            # managed objects are located by their offset in the heap
+            offset, pos = self.parse_uint(heapid, 1, heap["offset_size"])
+            length, _ = self.parse_uint(heapid, pos, heap["length_size"])
+            blockoffset, _, blockaddress = heap["blocks"][bisect.bisect_right(heap["block_offsets"], offset) - 1]
+            return self.read_bytes_at(blockaddress + offset - blockoffset, length)
+        elif idtype == 2:
+            # tiny objects are stored in the id itself
+            return heapid[1:1 + (flags & 0x0F) + 1]
+        raise Exception("Huge objects in fractal heaps are not supported")
+
+
+    ########
+    # Data
+    ########
+
+    def read_dimension_values(self, dimname):
+        """
+        Reads the values from a dimension if it has a corresponding coordinate variable. 
+        """
+        layout = self.get_layout(dimname)
+        return self.read_hyperslab(dimname, [0 for _ in layout.shape], list(layout.shape))
+
+    def read_hyperslab(self, varname, start, count, stride=None, output="list"):
+        """
+        Reads a strided block of a variable's values given the start index, count and index stride
+        along each of its dimensions, with scale_factor and add_offset applied, in the same
+        forms as the other formats. 
+        """
+        if output not in ("list", "numpy", "array", "packed"):
+            raise Exception("Output must be either 'list', 'numpy', 'array' or 'packed', not %r" % output)
+        layout = self.get_layout(varname)
+        if stride is None:
+            stride = [1 for _ in start]
+        raw = self.read_selection(layout, start, count, stride)
+        return self.decode_raw(layout, raw, count, output)
+
+    def decode_raw(self, layout, raw, shape, output="list"):
+        """
+        Decodes big endian bytes of a variable's values into the given output, with the given shape. 
+        """
+        dtype = layout.dtype
+        nvalues = len(raw) // layout.itemsize
+        if output == "numpy":
+            if numpy is None:
+                raise Exception("Reading data as numpy arrays requires the numpy package")
+            values = numpy.frombuffer(raw, dtype=self.numpy_dtypes[dtype]).reshape(shape)
+        elif output == "packed":
+            values = self.unpack_packed(dtype, [raw])
+            self.set_array_shape(values, layout, shape)
+            return values
+        else:
+            values = list(struct.unpack("%s%i%s" % (self.endian, nvalues, layout.struct_code), raw))
+            if output == "array":
+                values = GridArray("d", self.decode_values(layout, values, output))
+                self.set_array_shape(values, layout, shape)
+                return values
+        return self.decode_values(layout, values, output)
+
+    def read_selection(self, layout, start, count, stride):
+        """
+        Reads the raw values of a strided block of a variable, returned as big endian bytes with the
+        last dimension varying fastest, where values that have not been written are the fill value. 
+        Contiguous variables are read as runs of consecutive values, while chunked variables are
+        assembled from the chunks that intersect the block. 
+        """
+        storage = self.get_varinfo(layout.name)["storage"]
+        itemsize = layout.itemsize
+        nvalues = 1
+        for n in count:
+            nvalues *= n
+        if storage["layout"] == "virtual":
+            raise Exception("Virtual datasets are not supported")
+        if not nvalues:
+            return b""
+
+        if storage["layout"] == "contiguous" and storage["address"] is not None:
+            bytestrides = self.calc_byte_strides_of(storage["shape"], itemsize)
+            offset = storage["address"] + sum(( index*bytestride for index,bytestride in zip(start, bytestrides) ))
+            strides = [step*bytestride for step,bytestride in zip(stride, bytestrides)]
+            runlength, runoffsets, _ = self.calc_runs(count, strides, itemsize)
+            runsize = runlength * itemsize
+            raw = b"".join([bytes(buf[pos:pos+runsize]) for buf,pos in self.read_runs(offset, runoffsets, runsize)])
+            return self.to_big_endian(raw, storage["byteorder"], itemsize)
+
+        # the values of a compact variable, or one that is not yet written, are a single chunk
+        if storage["layout"] == "chunked":
+            chunkshape = storage["chunk_shape"]
+        else:
+            chunkshape = storage["shape"]
+
+        # the chunks intersecting the block along each dimension, as the chunk index, the first and
+        # last index of the block in that chunk, and the index in the chunk of the first value, where
+        # values beyond the dataspace (eg records that are not yet written) are left as fill values
+        dimpieces = []
+        for index,n,step,chunklength,extent in zip(start, count, stride, chunkshape, storage["shape"]):
+            pieces = []
+            i = 0
+            while i < n and index + i*step < extent:
+                chunkindex = (index + i*step) // chunklength
+                chunkend = min((chunkindex + 1) * chunklength, extent)
+                stop = min(n, (chunkend - index + step - 1) // step)
+                pieces.append((chunkindex, i, stop, index + i*step - chunkindex*chunklength))
+                i = stop
+            dimpieces.append(pieces)
+        combinations = [()]
+        for pieces in dimpieces:
+            combinations = [combination + (piece,) for combination in combinations for piece in pieces]
+
+        if storage["layout"] == "chunked":
+            chunks = self.get_chunks(layout, storage, set(( tuple(piece[0] for piece in combination) for combination in combinations )))
+        elif storage["layout"] == "compact":
+            chunks = {tuple(0 for _ in chunkshape): self.to_big_endian(storage["data"], storage["byteorder"], itemsize)}
+        else:
+            chunks = dict()
+
+        # copy the selected values of each chunk into place, one run along the last dimension at a time
+        values = bytearray(storage["fill"] * nvalues)
+        chunkstrides = self.calc_byte_strides_of(chunkshape, itemsize)
+        outstrides = self.calc_byte_strides_of(count, itemsize)
+        for combination in combinations:
+            chunk = chunks.get(tuple(piece[0] for piece in combination))
+            if chunk is None:
+                continue
+            if not combination:
+                values[:] = chunk[:itemsize] # scalar
+                continue
+            chunkoffsets = [sum(( piece[3]*chunkstride for piece,chunkstride in zip(combination, chunkstrides) ))]
+            outoffsets = [sum(( piece[1]*outstride for piece,outstride in zip(combination, outstrides) ))]
+            for piece,step,chunkstride,outstride in list(zip(combination, stride, chunkstrides, outstrides))[:-1]:
+                chunkoffsets = [offset + i*step*chunkstride for offset in chunkoffsets for i in range(piece[2] - piece[1])]
+                outoffsets = [offset + i*outstride for offset in outoffsets for i in range(piece[2] - piece[1])]
+            runlength = combination[-1][2] - combination[-1][1]
+            runsize = runlength * itemsize
+            step = stride[-1]
+            if step == 1:
+                for chunkoffset,outoffset in zip(chunkoffsets, outoffsets):
+                    values[outoffset:outoffset+runsize] = chunk[chunkoffset:chunkoffset+runsize]
+            else:
+                # every step'th value, one byte of each value at a time
+                chunkstep = step * itemsize
+                for chunkoffset,outoffset in zip(chunkoffsets, outoffsets):
+                    for b in range(itemsize):
+                        values[outoffset+b:outoffset+runsize:itemsize] = chunk[chunkoffset+b:chunkoffset+b+(runlength-1)*chunkstep+1:chunkstep]
+        return bytes(values)
+
+    def calc_byte_strides_of(self, shape, itemsize):
+        # the byte distance between consecutive indexes along each dimension of a contiguous block
+        strides = []
+        size = itemsize
+        for length in reversed(shape):
+            strides.append(size)
+            size *= length
+        return list(reversed(strides))
+
+    def get_chunks(self, layout, storage, keys):
+        """
+        Returns the decompressed big endian bytes of each of the given chunks of a variable, as a dictionary
+        keyed by chunk index, leaving out chunks that have not been written. 
+        Chunks in the chunk cache are reused, and the rest are read and decompressed in a pool of threads. 
+        """
+        index = self.get_chunk_index(layout.name)
+        chunks = dict()
+        missing = []
+        with self.chunk_lock:
+            for key in keys:
+                chunk = self.chunk_cache.pop((layout.name, key), None)
+                if chunk is not None:
+                    # reinsert as most recently used
+                    self.chunk_cache[(layout.name, key)] = chunk
+                    chunks[key] = chunk
+                elif key in index:
+                    missing.append(key)
+
+        def read_chunk(key):
+            address, size, filter_mask = index[key]
+            return self.read_chunk(storage, key, address, size, filter_mask)
+
+        if len(missing) > 1 and futures is not None:
+            with futures.ThreadPoolExecutor(max_workers=min(multiprocessing.cpu_count(), len(missing))) as executor:
+                decompressed = list(executor.map(read_chunk, missing))
+        else:
+            decompressed = [read_chunk(key) for key in missing]
+        chunks.update(zip(missing, decompressed))
+        self.store_chunks(layout.name, zip(missing, decompressed))
+
+        return chunks
+
+    def read_chunk(self, storage, key, address, size, filter_mask):
+        """
+        Reads a chunk and reverses the filters applied to it, skipping those disabled by the filter mask,
+        and returns it as big endian bytes. 
+        """
+        raw = self.read_bytes_at(address, size)
+        chunkshape = storage["chunk_shape"]
+        if storage.get("unfiltered_edges") and any(( (i + 1) * length > extent for i,length,extent in zip(key, chunkshape, storage["shape"]) )):
+            filter_mask = -1 # partial edge chunks are not filtered
+        for i,(filterid,values) in reversed(list(enumerate(storage["filters"]))):
+            if filter_mask & (1 << i):
+                continue
+            if filterid == 1:
+                raw = zlib.decompress(raw)
+            elif filterid == 2:
+                raw = self.unshuffle(raw, values[0] if values else storage["itemsize"])
+            elif filterid == 3:
+                raw = raw[:-4] # the fletcher32 checksum, which is not verified
+            else:
+                raise Exception("Chunks compressed with the HDF5 filter with id %s are not supported" % filterid)
+        return self.to_big_endian(raw, storage["byteorder"], storage["itemsize"])
+
+    def store_chunks(self, varname, chunks):
+        with self.chunk_lock:
+            for key,chunk in chunks:
+                if len(chunk) > self.chunk_cache_size // 2:
+                    continue # so as not to flush everything else
+                old = self.chunk_cache.pop((varname, key), None)
+                if old is not None:
+                    self.chunk_cache_used -= len(old)
+                self.chunk_cache[(varname, key)] = chunk
+                self.chunk_cache_used += len(chunk)
+            # evict the least recently used chunks
+            while self.chunk_cache_used > self.chunk_cache_size and self.chunk_cache:
+                _, chunk = self.chunk_cache.popitem(last=False)
+                self.chunk_cache_used -= len(chunk)
+
+    def unshuffle(self, raw, itemsize):
+        # the shuffle filter stores the first byte of every value, then the second byte, and so on
+        nvalues = len(raw) // itemsize
+        if itemsize <= 1 or not nvalues:
+            return raw
+        values = bytearray(len(raw))
+        for b in range(itemsize):
+            values[b:nvalues*itemsize:itemsize] = raw[b*nvalues:(b+1)*nvalues]
+        values[nvalues*itemsize:] = raw[nvalues*itemsize:]
+        return bytes(values)
+
+    def to_big_endian(self, raw, byteorder, itemsize):
+        raw = bytes(raw)
+        if byteorder == ">" or itemsize not in self.swap_typecodes:
+            return raw
+        values = array.array(self.swap_typecodes[itemsize])
+        (values.frombytes if hasattr(values, "frombytes") else values.fromstring)(raw)
+        values.byteswap()
+        return values.tobytes() if hasattr(values, "tobytes") else values.tostring()
+
+    def get_chunk_index(self, varname):
+        """
+        Returns where each chunk of a variable is stored, which is resolved the first time it is needed. 
+        """
+        index = self.chunk_indexes.get(varname)
+        if index is None:
+            index = self.chunk_indexes[varname] = self.read_chunk_index(self.get_varinfo(varname)["storage"])
+        return index
+
+    def read_chunk_index(self, storage):
+        """
+        Reads any of the types of chunk indexes of a variable. Returns a dictionary of the index of each chunk
+        along each dimension (its offset divided by the chunk shape) and the address, size and filter mask
+        of the chunk, leaving out chunks that have not been written. 
+        """
+        chunkshape = storage["chunk_shape"]
+        rank = len(chunkshape)
+        address = storage["index_address"]
+        chunksize = storage["itemsize"]
+        for length in chunkshape:
+            chunksize *= length
+
+        index = dict()
+        if address is None:
+            return index
+        kind = storage["index"]
+        if kind == "btree1":
+            # keyed by the size, filter mask and offsets of each chunk
+            for key,chunkaddress in self.read_btree_v1(address, 8 + 8*(rank + 1)):
+                size, filter_mask = struct.unpack_from("<II", key, 0)
+                offsets = struct.unpack_from("<%iQ" % rank, key, 8)
+                index[tuple(offset // length for offset,length in zip(offsets, chunkshape))] = (chunkaddress, size, filter_mask)
+        elif kind == "single":
+            index[tuple(0 for _ in chunkshape)] = (address, storage.get("single_size", chunksize), storage.get("single_mask", 0))
+        elif kind == "btree2":
+            # records of the address, and if filtered the size and filter mask, and the index of each chunk
+            for record in self.read_btree_v2(address):
+                chunkaddress, pos = self.parse_address(record, 0)
+                size, filter_mask = chunksize, 0
+                if len(record) > self.offset_size + 8*rank:
+                    size, pos = self.parse_uint(record, pos, len(record) - self.offset_size - 4 - 8*rank)
+                    filter_mask = self.uint_structs[4].unpack_from(record, pos)[0]
+                    pos += 4
+                if chunkaddress is not None:
+                    index[struct.unpack_from("<%iQ" % rank, record, pos)] = (chunkaddress, size, filter_mask)
+        elif kind in ("implicit", "fixedarray", "extensiblearray"):
+            # one entry per chunk in order, with the last dimension varying fastest, and for extensible arrays
+            # the unlimited dimension moved first, where the grid of chunks covers the maximum shape
+            maxshape = [maxlength if maxlength != self.unlimited_length else length
+                        for length,maxlength in zip(storage["shape"], storage["maxshape"] or storage["shape"])]
+            grid = [(maxlength + length - 1) // length for maxlength,length in zip(maxshape, chunkshape)]
+            order = list(range(rank))
+            if kind == "implicit":
+                nchunks = 1
+                for n in grid:
+                    nchunks *= n
+                entries = [(address + i*chunksize, chunksize, 0) for i in range(nchunks)]
+            elif kind == "fixedarray":
+                entries = self.read_fixed_array(address)
+            else:
+                unlimited = [i for i,maxlength in enumerate(storage["maxshape"]) if maxlength == self.unlimited_length]
+                if unlimited:
+                    order.remove(unlimited[0])
+                    order.insert(0, unlimited[0])
+                entries = self.read_extensible_array(address)
+            ordergrid = [grid[dim] for dim in order]
+            for i,(chunkaddress,size,filter_mask) in enumerate(entries):
+                if chunkaddress is None:
+                    continue
+                key = [0] * rank
+                remainder = i
+                for dim,n in reversed(list(zip(order, ordergrid))[1:]):
+                    remainder, key[dim] = divmod(remainder, n)
+                if rank:
+                    key[order[0]] = remainder
+                index[tuple(key)] = (chunkaddress, chunksize if size is None else size, filter_mask)
+        else:
+            raise Exception("The %s chunk index is not supported" % kind)
+        return index
+
+    def parse_chunk_entries(self, buf, n, entrysize, filtered):
+        # the address of each chunk, and if filtered its size and filter mask
+        entries = []
+        for i in range(n):
+            chunkaddress, pos = self.parse_address(buf, i*entrysize)
+            size, filter_mask = None, 0
+            if filtered:
+                size, pos = self.parse_uint(buf, pos, entrysize - self.offset_size - 4)
+                filter_mask = self.uint_structs[4].unpack_from(buf, pos)[0]
+            entries.append((chunkaddress, size, filter_mask))
+        return entries
+
+    def read_fixed_array(self, address):
+        """
+        Returns the chunk entries of a fixed array index, which are split into pages if there are many. 
+        """
+        buf = self.read_bytes_at(address, 8 + self.length_size + self.offset_size)
+        filtered, entrysize, pagebits = struct.unpack_from("<BBB", buf, 5)
+        nentries, pos = self.parse_uint(buf, 8, self.length_size)
+        datablock, _ = self.parse_address(buf, pos)
+        if datablock is None:
+            return []
+
+        prefixsize = 6 + self.offset_size
+        pagesize = 2**pagebits
+        if nentries <= pagesize:
+            return self.parse_chunk_entries(self.read_bytes_at(datablock + prefixsize, nentries*entrysize), nentries, entrysize, filtered)
+
+        # pages follow the data block prefix, a bitmap of which pages are initialized, and a checksum
+        npages = (nentries + pagesize - 1) // pagesize
+        bitmapsize = (npages + 7) // 8
+        bitmap = bytearray(self.read_bytes_at(datablock + prefixsize, bitmapsize))
+        pos = datablock + prefixsize + bitmapsize + 4
+        entries = []
+        for page in range(npages):
+            n = min(pagesize, nentries - page*pagesize)
+            if bitmap[page // 8] & (0x80 >> page % 8):
+                entries.extend(self.parse_chunk_entries(self.read_bytes_at(pos, n*entrysize), n, entrysize, filtered))
+            else:
+                entries.extend([(None, None, 0)] * n)
+            pos += n*entrysize + 4
+        return entries
+
+    def read_extensible_array(self, address):
+        """
+        Returns the chunk entries of an extensible array index, which are stored first in the index block,
+        then in data blocks that double in size, referenced from the index block or from super blocks. 
+        """
+        O, L = self.offset_size, self.length_size
+        buf = self.read_bytes_at(address, 12 + 6*L + O)
+        (filtered, entrysize, maxbits, iblockentries, dblockminentries,
+         sblockminpointers, pagebits) = struct.unpack_from("<BBBBBBB", buf, 5)
+        maxindex, _ = self.parse_uint(buf, 12 + 4*L, L)
+        indexblock, _ = self.parse_address(buf, 12 + 6*L)
+        if indexblock is None:
+            return []
+
+        # the number of data blocks in each super block, and the number of entries in each of its data blocks
+        nsblocks = 1 + maxbits - (dblockminentries.bit_length() - 1)
+        sblocks = [(2**(s // 2), 2**((s + 1) // 2) * dblockminentries) for s in range(nsblocks)]
+        iblocksblocks = 2 * (sblockminpointers.bit_length() - 1) # super blocks whose data blocks are in the index block
+        ndblockaddresses = 2 * (sblockminpointers - 1)
+        offsetsize = (maxbits + 7) // 8
+        pagesize = 2**pagebits
+
+        buf = self.read_bytes_at(indexblock, 6 + O + iblockentries*entrysize + (ndblockaddresses + nsblocks - iblocksblocks)*O)
+        pos = 6 + O
+        entries = self.parse_chunk_entries(buf[pos:pos+iblockentries*entrysize], iblockentries, entrysize, filtered)
+        pos += iblockentries*entrysize
+        dblocks = []
+        for s in range(iblocksblocks):
+            for _ in range(sblocks[s][0]):
+                dblockaddress, pos = self.parse_address(buf, pos)
+                dblocks.append((dblockaddress, sblocks[s][1], None))
+        for s in range(iblocksblocks, nsblocks):
+            sblockaddress, pos = self.parse_address(buf, pos)
+            ndblocks, nentries = sblocks[s]
+            if sblockaddress is None:
+                dblocks.extend([(None, nentries, None)] * ndblocks)
+                continue
+            # super blocks have a bitmap of the initialized pages of each of their data blocks if paged
+            bitmapsize = (nentries // pagesize + 7) // 8 if nentries > pagesize else 0
+            sbuf = self.read_bytes_at(sblockaddress, 6 + O + offsetsize + ndblocks*(bitmapsize + O))
+            spos = 6 + O + offsetsize
+            bitmaps = [bytearray(sbuf[spos+i*bitmapsize:spos+(i+1)*bitmapsize]) for i in range(ndblocks)]
+            spos += ndblocks*bitmapsize
+            for i in range(ndblocks):
+                dblockaddress, spos = self.parse_address(sbuf, spos)
+                dblocks.append((dblockaddress, nentries, bitmaps[i]))
+
+        prefixsize = 6 + O + offsetsize
+        for dblockaddress,nentries,bitmap in dblocks:
+            if len(entries) >= maxindex:
+                break
+            if dblockaddress is None:
+                entries.extend([(None, None, 0)] * nentries)
+            elif nentries > pagesize:
+                pos = dblockaddress + prefixsize + 4
+                for page in range(nentries // pagesize):
+                    if bitmap[page // 8] & (0x80 >> page % 8):
+                        entries.extend(self.parse_chunk_entries(self.read_bytes_at(pos, pagesize*entrysize), pagesize, entrysize, filtered))
+                    else:
+                        entries.extend([(None, None, 0)] * pagesize)
+                    pos += pagesize*entrysize + 4
+            else:
+                entries.extend(self.parse_chunk_entries(self.read_bytes_at(dblockaddress + prefixsize, nentries*entrysize), nentries, entrysize, filtered))
+        return entries[:maxindex]
+
+    def calc_layout(self, varname):
+        layout = _NetCDFClassicBackend.calc_layout(self, varname)
+        # values are located through the storage of the variable instead
+        return layout._replace(recsize = 0,
+                               byte_strides = tuple(self.calc_byte_strides_of(layout.shape, layout.itemsize)),
+                               )
+
+    def read_points(self, varname, points, labels=False, method="exact", output="list"):
+        """
+        Samples a variable's values at a batch of points, the same as for the other formats,
+        except that the chunks containing the points are read together first. 
+        """
+        layout = self.get_layout(varname)
+        storage = self.get_varinfo(varname)["storage"]
+
+        indexes = []
+        for point in points:
+            if isinstance(point, dict):
+                point = [point[dimname] for dimname in layout.dimnames]
+            if len(point) != len(layout.dimnames):
+                raise Exception("Each point must have one index for each of the variable's %s dimensions" % len(layout.dimnames))
+            if labels:
+                point = [self.get_label_index(dimname, label, method) for dimname,label in zip(layout.dimnames, point)]
+            for index,dimlength in zip(point, layout.shape):
+                if not 0 <= index < dimlength:
+                    raise Exception("Point %s is outside the bounds of the variable's dimensions" % (point,))
+            indexes.append(point)
+
+        ones = [1 for _ in layout.shape]
+        if storage["layout"] == "chunked":
+            # read all the chunks first so they are decompressed together
+            chunkshape = storage["chunk_shape"]
+            chunkstrides = self.calc_byte_strides_of(chunkshape, layout.itemsize)
+            keys = [tuple(index // length for index,length in zip(point, chunkshape)) for point in indexes]
+            chunks = self.get_chunks(layout, storage, set(keys))
+            raws = []
+            for point,key in zip(indexes, keys):
+                chunk = chunks.get(key)
+                if chunk is None or any(( index >= extent for index,extent in zip(point, storage["shape"]) )):
+                    raws.append(storage["fill"])
+                else:
+                    offset = sum(( (index - i*length) * chunkstride for index,i,length,chunkstride in zip(point, key, chunkshape, chunkstrides) ))
+                    raws.append(chunk[offset:offset+layout.itemsize])
+        else:
+            raws = [self.read_selection(layout, point, ones, ones) for point in indexes]
+
+        return self.decode_raw(layout, b"".join(raws), [len(indexes)], output)
+
+    def iter_records(self, varnames=None, start=0, stop=None, output="list"):
+        """
+        Iterates over the records of the file, yielding the record index and an ordered dictionary
+        of the decoded values of each of the given record variables in that record (defaults to all of them),
+        the same as for the other formats, where chunks spanning several records are decompressed only once. 
+        """
+        if varnames is None:
+            varnames = [var["name"] for var in self.header["var_list"] if self.get_layout(var["name"]).recvar]
+        layouts = [self.get_layout(varname) for varname in varnames]
+        for layout in layouts:
+            if not layout.recvar:
+                raise Exception("Can only iterate the records of record variables, not %r" % layout.name)
+        if output not in ("list", "numpy", "array", "packed"):
+            raise Exception("Output must be either 'list', 'numpy', 'array' or 'packed', not %r" % output)
+
+        if stop is None:
+            stop = self.numrecs
+        for index in range(start, stop):
+            record = collections.OrderedDict()
+            for layout in layouts:
+                shape = layout.shape[1:]
+                values = self.read_hyperslab(layout.name, [index] + [0 for _ in shape], [1] + list(shape), output=output)
+                if output == "numpy":
+                    values = values.reshape(shape)
+                elif output in ("array", "packed"):
+                    values.shape = shape
+                else:
+                    values = self.nest_values(values, shape) if shape else values[0]
+                record[layout.name] = values
+            yield index, record
+
+    def read_data_buffer(self, varname):
+        """
+        Returns the undecoded big endian bytes of a variable's data, assembled from its chunks
+        if chunked. 
+        """
+        layout = self.get_layout(varname)
+        return self.read_selection(layout, [0 for _ in layout.shape], list(layout.shape), [1 for _ in layout.shape])
+
+    def get_memmap(self, varname):
+        """
+        Returns a read-only numpy memmap of a variable's data, which is only possible for
+        variables stored contiguously (requires numpy). 
+        """
+        if numpy is None:
+            raise Exception("Memory mapping data as numpy arrays requires the numpy package")
+
+        layout = self.get_layout(varname)
+        storage = self.get_varinfo(varname)["storage"]
+        if storage["layout"] != "contiguous" or storage["address"] is None:
+            raise Exception("Only variables stored contiguously can be memory mapped, not chunked or compact ones")
+
+        dtype = numpy.dtype(self.numpy_dtypes[layout.dtype]).newbyteorder(storage["byteorder"])
+        return numpy.memmap(self.filepath, dtype=dtype, mode="r", offset=storage["address"], shape=layout.shape)
+
+
+
+class _NetCDFClassicWriterBackend(_NetCDFClassicBackend):
+    """
+    Builds the same header structure that the reader parses, and writes it and the values
+    of each variable to a new file. 
+    """
+
+    # number of bytes of fill values to write at a time
+    fill_write_size = 1024*1024
+
+    # reverse lookups
+    dtype_tags = dict((dtype, typecode) for typecode,dtype in _NetCDFClassicBackend.dtypecodes.items())
+    format_tags = dict((format, formatcode) for formatcode,format in _NetCDFClassicBackend.formatcodes.items())
+
+    def __init__(self, filepath, format="classic format"):
+        if format not in self.format_tags:
+            raise Exception("Format must be either 'classic format' or '64-bit offset format', not %r" % format)
+        self.filepath = filepath
+        self.fileobj = open(filepath, "wb")
+        self.header = dict(magic = (b"CDF", format),
+                           numrecs = 0,
+                           dim_list = [],
+                           gatt_list = [],
+                           var_list = [],
+                           )
+        self.defining = True
+        self.strict = True
+
+    ########
+    # Definitions
+    ########
+
+    def add_dimension(self, name, length=None):
+        """
+        Adds a dimension with a fixed length, or if length is None the record dimension,
+        along which records are appended. There can only be one record dimension. 
+        """
+        name = self.check_new_name(name, self.header["dim_list"])
+        if not length:
+            if any((dimdict["dim_length"] == 0 for dimdict in self.header["dim_list"])):
+                raise Exception("There can only be one record dimension")
+            length = 0
+        dimdict = dict( name = name,
+                        dim_length = length,
+                        )
+        self.header["dim_list"].append(dimdict)
+
+    def add_attribute(self, name, values, nc_type=None, varname=None):
+        """
+        Adds a global attribute, or an attribute of a variable if varname is given. 
+        Values can be a string, a number or a sequence of numbers. The type is guessed from the values
+        as NC_CHAR, NC_INT or NC_DOUBLE if not given as nc_type, eg "NC_FLOAT" or "NC_SHORT". 
+        """
+        if varname is None:
+            attlist = self.header["gatt_list"]
+        else:
+            attlist = self.get_new_varinfo(varname)["vatt_list"]
+        name = self.check_new_name(name, attlist)
+
+        if not isinstance(values, (bytes, list, tuple)):
+            if isinstance(values, type(u"")):
+                values = values.encode("utf8")
+            elif hasattr(values, "tolist"):
+                values = values.tolist() # numpy and array.array
+                if not isinstance(values, list):
+                    values = [values] # numpy scalars
+            else:
+                values = [values]
+        if nc_type is None:
+            if isinstance(values, bytes):
+                nc_type = "NC_CHAR"
+            elif any((isinstance(value, float) for value in values)):
+                nc_type = "NC_DOUBLE"
+            else:
+                nc_type = "NC_INT"
+        self.check_nc_type(nc_type)
+        if isinstance(values, bytes) != (nc_type == "NC_CHAR"):
+            raise Exception("Only string attributes can be of type NC_CHAR")
+
+        # store the values the same way as the reader
+        nelems = len(values)
+        if nc_type not in ("NC_BYTE", "NC_CHAR"):
+            values = values[0] if nelems == 1 else tuple(values)
+        elif not isinstance(values, bytes):
+            values = struct.pack("%ib" % nelems, *values)
+        attdict = dict( name = name,
+                        nc_type = nc_type,
+                        nelems = nelems,
+                        values = values,
+                        )
+        attlist.append(attdict)
+
+    def add_variable(self, name, nc_type, dimensions=(), attributes=None):
+        """
+        Adds a variable of the given type, eg "NC_SHORT", along the named dimensions, where the record
+        dimension can only be the first. Attributes is an optional dictionary of attribute names and values,
+        with types guessed as for add_attribute. 
+        """
+        name = self.check_new_name(name, self.header["var_list"])
+        self.check_nc_type(nc_type)
+        dimnames = [dimdict["name"] for dimdict in self.header["dim_list"]]
+        dimids = []
+        for i,dimname in enumerate(dimensions):
+            if not isinstance(dimname, bytes):
+                dimname = dimname.encode("utf8")
+            if dimname not in dimnames:
+                raise Exception("Could not find a dimension named %r" % dimname)
+            dimid = dimnames.index(dimname)
+            if i > 0 and self.header["dim_list"][dimid]["dim_length"] == 0:
+                raise Exception("The record dimension can only be the first dimension of a variable")
+            dimids.append(dimid)
+
+        vardict = dict( name = name,
+                        nelems = len(dimids),
+                        dimids = dimids,
+                        vatt_list = [],
+                        nc_type = nc_type,
+                        vsize = None,
+                        begin = None,
+                        )
+        self.header["var_list"].append(vardict)
+
+        for attname,values in (attributes or dict()).items():
+            self.add_attribute(attname, values, varname=name)
+
+    def check_new_name(self, name, items):
+        if not self.defining:
+            raise Exception("Cannot add more definitions after values have been written")
+        if not isinstance(name, bytes):
+            name = name.encode("utf8")
+        if not self.name_pattern.match(name):
+            raise Exception("Invalid name %r: must start with an alphanumeric or underscore, followed by alphanumerics or special characters" % name)
+        if any((item["name"] == name for item in items)):
+            raise Exception("The name %r is already in use" % name)
+        return name
+
+    def check_nc_type(self, nc_type):
+        if nc_type not in self.dtype_tags:
+            raise Exception("Type must be one of %s, not %r" % (", ".join(sorted(self.dtype_tags)), nc_type))
+
+    def get_new_varinfo(self, varname):
+        if not isinstance(varname, bytes):
+            varname = varname.encode("utf8")
+        for vardict in self.header["var_list"]:
+            if vardict["name"] == varname:
+                return vardict
+        raise Exception("Could not find a variable named %r" % varname)
+
+    def end_definitions(self):
+        """
+        Computes where each variable begins, and writes the header. Non-record variables come first
+        in the order they were added, followed by the record variables, and are filled with their
+        fill value so that any values not written later read as missing. 
+        """
+        self.defining = False
+        self.var_index = dict((vardict["name"], vardict) for vardict in self.header["var_list"])
+        offsetsize = 4 if self.header["magic"][-1] == "classic format" else 8
+
+        # the header size does not depend on the begin values, only on their size
+        for vardict in self.header["var_list"]:
+            vardict["vsize"] = self.calc_vsize(vardict["name"])
+            vardict["begin"] = 0
+        begin = len(self.pack_header())
+
+        recvars = []
+        for vardict in self.header["var_list"]:
+            if vardict["dimids"] and self.header["dim_list"][vardict["dimids"][0]]["dim_length"] == 0:
+                recvars.append(vardict)
+            else:
+                vardict["begin"] = begin
+                begin += vardict["vsize"]
+        for vardict in recvars:
+            vardict["begin"] = begin
+            begin += vardict["vsize"]
+        if offsetsize == 4 and begin >= 2**31:
+            raise Exception("Variables begin too far into the file for the classic format, use the 64-bit offset format instead")
+
+        self.build_indexes()
+        self.fileobj.write(self.pack_header())
+        for vardict in self.header["var_list"]:
+            layout = self.get_layout(vardict["name"])
+            if not layout.recvar:
+                self.write_fill_values(layout)
+
+    ########
+    # Writing
+    ########
+
+    def write_variable(self, varname, values, start=0):
+        """
+        Writes the values of a non-record variable, or a piece of them starting at the given
+        index into its flattened values, so large variables can be written a piece at a time. 
+        Values can be nested lists, an array.array, a numpy array, or bytes of big endian values. 
+        None values are written as the variable's fill value. 
+        """
+        if self.defining:
+            self.end_definitions()
+        layout = self.get_layout(varname)
+        if layout.recvar:
+            raise Exception("Record variables must be written with append_record")
+
+        data = self.encode_values(layout, values)
+        if start < 0 or (start * layout.itemsize + len(data)) > self.calc_nvalues(varname) * layout.itemsize:
+            raise Exception("The values do not fit inside the variable")
+        self.fileobj.seek(layout.begin + start * layout.itemsize)
+        self.fileobj.write(data)
+
+    def append_record(self, values):
+        """
+        Appends a record at the end of the file, given a dictionary of record variable names and
+        their values in this record, which are written as for write_variable. Record variables not given
+        are written as fill values. Only one record is held in memory at a time. 
+        """
+        if self.defining:
+            self.end_definitions()
+        values = dict((name if isinstance(name, bytes) else name.encode("utf8"), value) for name,value in values.items())
+
+        layouts = [self.get_layout(vardict["name"]) for vardict in self.header["var_list"]]
+        layouts = [layout for layout in layouts if layout.recvar]
+        if not layouts:
+            raise Exception("There are no record variables to append records to")
+
+        pieces = []
+        for layout in layouts:
+            size = self.calc_nvalues(layout.name) * layout.itemsize
+            if layout.name in values:
+                data = self.encode_values(layout, values.pop(layout.name))
+                if len(data) != size:
+                    raise Exception("Expected %s values for each record of %r" % (size // layout.itemsize, layout.name))
+            else:
+                data = self.calc_fill_bytes(layout) * (size // layout.itemsize)
+            pieces.append(data)
+            if len(layouts) > 1:
+                # a single record variable is not padded
+                pieces.append(self.PADDING_HEADER * (-size % 4))
+        if values:
+            raise Exception("Could not find record variables named %s" % ", ".join(map(repr, values)))
+
+        self.fileobj.seek(layouts[0].begin + self.numrecs * self.recsize)
+        self.fileobj.write(b"".join(pieces))
+        self.numrecs += 1
+
+    def close(self):
+        """
+        Writes the final number of records to the header, and closes the file. 
+        """
+        if self.fileobj.closed:
+            return
+        if self.defining:
+            self.end_definitions()
+
+        self.header["numrecs"] = self.numrecs
+        self.fileobj.seek(4)
+        self.fileobj.write(self.non_neg_struct.pack(self.numrecs))
+        self.fileobj.close()
+
+    def write_fill_values(self, layout):
+        """
+        Writes the fill value over all the values of a non-record variable, and its padding. 
+        """
+        size = self.calc_nvalues(layout.name) * layout.itemsize
+        fill = self.calc_fill_bytes(layout)
+        chunk = fill * max(1, self.fill_write_size // len(fill))
+        self.fileobj.seek(layout.begin)
+        for _ in range(size // len(chunk)):
+            self.fileobj.write(chunk)
+        self.fileobj.write(chunk[:size % len(chunk)])
+        self.fileobj.write(self.PADDING_HEADER * (-size % 4))
+
+    def encode_values(self, layout, values):
+        """
+        Converts values of a variable to big endian bytes. 
+        """
+        if isinstance(values, (bytes, bytearray)):
+            return bytes(values)
+        elif numpy is not None and isinstance(values, numpy.ndarray):
+            if isinstance(values, numpy.ma.MaskedArray):
+                values = values.filled(self.calc_fill_value(layout))
+            return values.astype(self.numpy_dtypes[layout.dtype]).tobytes()
+        elif isinstance(values, array.array) and values.typecode == self.array_typecodes.get(layout.dtype):
+            values = array.array(values.typecode, values)
+            if sys.byteorder == "little":
+                values.byteswap()
+            return values.tobytes() if hasattr(values, "tobytes") else values.tostring()
+
+        values = list(values)
+        while values and isinstance(values[0], (list, tuple)):
+            values = [value for subvalues in values for value in subvalues]
+        if None in values:
+            fill_value = self.calc_fill_value(layout)
+            values = [value if value is not None else fill_value for value in values]
+        return struct.pack("%s%i%s" % (self.endian, len(values), layout.struct_code), *values)
+
+    def calc_fill_value(self, layout):
+        return self.varattr_index[layout.name].get("_FillValue", self.default_fill_values[layout.dtype])
+
+    def calc_fill_bytes(self, layout):
+        fill_value = self.calc_fill_value(layout)
+        if layout.dtype == "NC_CHAR":
+            return fill_value[:1]
+        return struct.pack("%s%s" % (self.endian, layout.struct_code), fill_value)
+
+    ########
+    # Header
+    ########
+
+    def pack_header(self):
+        header = self.header
+        parts = [header["magic"][0],
+                 self.format_tags[header["magic"][-1]],
+                 self.STREAMING, # until the number of records is known
+                 self.pack_list("NC_DIMENSION", header["dim_list"], self.pack_dim),
+                 self.pack_list("NC_ATTRIBUTE", header["gatt_list"], self.pack_att),
+                 self.pack_list("NC_VARIABLE", header["var_list"], self.pack_var),
+                 ]
+        return b"".join(parts)
+
+    def pack_list(self, tag, items, pack_item):
+        if not items:
+            return self.ZERO + self.non_neg_struct.pack(0) # ABSENT
+        return self.tags[tag] + self.non_neg_struct.pack(len(items)) + b"".join(map(pack_item, items))
+
+    def pack_name(self, name):
+        return self.non_neg_struct.pack(len(name)) + name + self.PADDING_HEADER * (-len(name) % 4)
+
+    def pack_values(self, dtype, values, nelems):
+        if dtype in ("NC_BYTE", "NC_CHAR"):
+            data = values
+        else:
+            if not isinstance(values, tuple):
+                values = (values,)
+            data = struct.pack("%s%i%s" % (self.endian, nelems, self.struct_codes[dtype]), *values)
+        return data + self.PADDING_HEADER * (-len(data) % 4)
+
+    def pack_dim(self, dimdict):
+        return self.pack_name(dimdict["name"]) + self.non_neg_struct.pack(dimdict["dim_length"])
+
+    def pack_att(self, attdict):
+        return b"".join([self.pack_name(attdict["name"]),
+                         self.att_type_struct.pack(self.dtype_tags[attdict["nc_type"]], attdict["nelems"]),
+                         self.pack_values(attdict["nc_type"], attdict["values"], attdict["nelems"]),
+                         ])
+
+    def pack_var(self, vardict):
+        if self.header["magic"][-1] == "classic format":
+            begin = self.non_neg_struct.pack(vardict["begin"])
+        else:
+            begin = struct.pack(">q", vardict["begin"])
+        return b"".join([self.pack_name(vardict["name"]),
+                         self.non_neg_struct.pack(vardict["nelems"]),
+                         b"".join(self.non_neg_struct.pack(dimid) for dimid in vardict["dimids"]),
+                         self.pack_list("NC_ATTRIBUTE", vardict["vatt_list"], self.pack_att),
+                         self.dtype_tags[vardict["nc_type"]],
+                         self.non_neg_struct.pack(min(vardict["vsize"], 2**32 - 1)), # too large sizes are only allowed for the last variable and are ignored
+                         begin,
+                         ])
+
+
+class _NetCDFClassicMmapBackend(_NetCDFClassicBackend):
+    """
+    The classic backend, but with the file memory mapped so that data reads
+    return memoryview windows over the mapped file instead of copied bytes. 
+    """
+
+    def __init__(self, filepath, fileobj=None):
+        self.filepath = filepath
+        self.cache = None
+        self._file = fileobj or open(filepath, "rb")
+        self.fileobj = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.fileobj.seek(0)
+        try:
+            self.view = memoryview(self.fileobj)
+        except TypeError:
+            # python 2 mmaps only support the old buffer interface
+            self.view = None
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+        self.fileobj.close()
+        self._file.close()
+
+    def read_at(self, offset, n):
+        if self.view is not None:
+            raw = self.view[offset:offset+n]
+        else:
+            raw = buffer(self.fileobj, offset, n)
+        return raw
+
+
+class _NetCDF5MmapBackend(_NetCDFClassicMmapBackend, _NetCDF5Backend):
+    """
+    The 64-bit data format backend, with the file memory mapped. 
+    """
+    pass
+
+class _NetCDF4MmapBackend(_NetCDFClassicMmapBackend, _NetCDF4Backend):
+    """
+    The NetCDF-4 backend, with the file memory mapped. 
+    """
+    pass
+
 if __name__ == "__main__":
     filepath = "ECMWF_ERA-40_subset.nc"
     obj = NetCDF(filepath)
@@ -804,13 +4727,9 @@ if __name__ == "__main__":
     print len(rows), len(rows[0])
 
     import PIL, PIL.Image
-    img = PIL.Image.new("F",(len(rows[0]),len(rows)))
-    pxls = img.load()
-    #img.putdata([v for row in rows for v in row])
-    for y,row in enumerate(rows):
-        for x,v in enumerate(row):
-            #print x,y
-            pxls[x,y] = v
+    grid = obj.read_2d_data(varname, time=10, output="array")
+    height,width = grid.shape
+    img = PIL.Image.frombytes("F", (width,height), grid.tobytes(), "raw", "F;64F")
 
     import pythongis as pg
     rast = pg.raster.data.RasterData(image=img, cellwidth=1, cellheight=-1, xy_cell=(0,0), xy_geo=(0,0))
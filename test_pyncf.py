@@ -0,0 +1,791 @@
+"""
+Tests for pyncf, run with python -m unittest test_pyncf
+
+The files are written with NetCDFWriter into a temporary directory, from values that are
+simple functions of their indexes, so the expected values can be computed directly.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+import pyncf
+
+
+NUMRECS = 5
+LATITUDES = [30.0, 10.0, -10.0, -30.0]
+LONGITUDES = [0.0, 10.0, 20.0, 30.0, 40.0, 50.0]
+
+def temp_value(t, y, x):
+    # the packed value of temp, where every seventh value is the fill value
+    value = t*100 + y*10 + x
+    return -1 if value % 7 == 3 else value
+
+def pres_value(t, y, x):
+    return 1000.0 + t - y*0.5 + x*0.25
+
+def height_value(y, x):
+    return y*len(LONGITUDES) + x
+
+def write_grid(filepath, records=range(NUMRECS)):
+    with pyncf.NetCDFWriter(filepath) as writer:
+        writer.add_dimension("time")
+        writer.add_dimension("latitude", len(LATITUDES))
+        writer.add_dimension("longitude", len(LONGITUDES))
+        writer.add_attribute("title", "test grid")
+        writer.add_variable("time", "NC_DOUBLE", ["time"], {"units": "days since 2000-01-01"})
+        writer.add_variable("latitude", "NC_FLOAT", ["latitude"], {"units": "degrees_north"})
+        writer.add_variable("longitude", "NC_FLOAT", ["longitude"], {"units": "degrees_east"})
+        writer.add_variable("height", "NC_INT", ["latitude", "longitude"])
+        writer.add_variable("temp", "NC_SHORT", ["time", "latitude", "longitude"])
+        writer.add_attribute("scale_factor", 0.5, "NC_FLOAT", varname="temp")
+        writer.add_attribute("_FillValue", -1, "NC_SHORT", varname="temp")
+        writer.add_variable("pres", "NC_FLOAT", ["time", "latitude", "longitude"])
+        writer.write_variable("latitude", LATITUDES)
+        writer.write_variable("longitude", LONGITUDES)
+        writer.write_variable("height", [[height_value(y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))])
+        for t in records:
+            writer.append_record({"time": [t * 31.0],
+                                  "temp": [[temp_value(t, y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))],
+                                  "pres": [[pres_value(t, y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))]})
+
+def write_grid_netcdf4(filepath, format, **options):
+    # the same grid written with the netCDF4 library, in a format that NetCDFWriter cannot write
+    dataset = netCDF4.Dataset(filepath, "w", format=format)
+    dataset.createDimension("time", None)
+    dataset.createDimension("latitude", len(LATITUDES))
+    dataset.createDimension("longitude", len(LONGITUDES))
+    dataset.title = "test grid"
+    dataset.createVariable("time", "f8", ("time",))[:] = [t * 31.0 for t in range(NUMRECS)]
+    dataset.createVariable("latitude", "f4", ("latitude",))[:] = LATITUDES
+    dataset.createVariable("longitude", "f4", ("longitude",))[:] = LONGITUDES
+    dataset.createVariable("height", "i4", ("latitude", "longitude"), **options)[:] = \
+        [[height_value(y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))]
+    temp = dataset.createVariable("temp", "i2", ("time", "latitude", "longitude"), fill_value=-1, **options)
+    temp.scale_factor = numpy.float32(0.5)
+    temp.set_auto_maskandscale(False)
+    temp[:] = [[[temp_value(t, y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))] for t in range(NUMRECS)]
+    return dataset
+
+def expected_temp(t, y, x):
+    value = temp_value(t, y, x)
+    return None if value == -1 else value * 0.5
+
+
+class GridTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tempdir, "grid.nc")
+        write_grid(self.filepath)
+        self.ncfile = pyncf.NetCDF(self.filepath)
+
+    def tearDown(self):
+        self.ncfile.close()
+        shutil.rmtree(self.tempdir)
+
+
+class TestWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tempdir, "written.nc")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_round_trip(self):
+        write_grid(self.filepath)
+        with pyncf.NetCDF(self.filepath) as ncfile:
+            self.assertEqual(ncfile.header["numrecs"], NUMRECS)
+            self.assertEqual(ncfile.read_dimension_values("latitude"), LATITUDES)
+            self.assertEqual(ncfile.read_slice("time"), [t * 31.0 for t in range(NUMRECS)])
+            self.assertEqual(ncfile.read_slice("temp", [3, 0, 0], [1, 1, 6]),
+                             [[[expected_temp(3, 0, x) for x in range(6)]]])
+            pres = ncfile.read_slice("pres", [NUMRECS - 1, 3, 5], [1, 1, 1])
+            self.assertAlmostEqual(pres[0][0][0], pres_value(NUMRECS - 1, 3, 5), 4)
+
+    def test_unreadable_header_closes_file(self):
+        write_grid(self.filepath)
+        with open(self.filepath, "rb") as fileobj:
+            data = fileobj.read(64)
+        with open(self.filepath, "wb") as fileobj:
+            fileobj.write(data) # the header is cut off
+        opened = []
+        def tracking_open(*args):
+            fileobj = open(*args)
+            opened.append(fileobj)
+            return fileobj
+        pyncf.open = tracking_open
+        try:
+            for use_mmap in (False, True):
+                self.assertRaises(Exception, pyncf.NetCDF, self.filepath, use_mmap=use_mmap)
+        finally:
+            del pyncf.open
+        self.assertEqual(len(opened), 2)
+        self.assertTrue(all(fileobj.closed for fileobj in opened))
+
+    def test_partial_write(self):
+        with pyncf.NetCDFWriter(self.filepath) as writer:
+            writer.add_dimension("x", 6)
+            writer.add_variable("a", "NC_SHORT", ["x"], {"_FillValue": -9})
+            writer.add_variable("b", "NC_SHORT", ["x"])
+            writer.write_variable("a", [1, 2], start=2)
+        with pyncf.NetCDF(self.filepath, mask=False) as ncfile:
+            self.assertEqual(ncfile.read_slice("a"), [-9, -9, 1, 2, -9, -9])
+            self.assertEqual(ncfile.read_slice("b"), [-32767] * 6)
+        with pyncf.NetCDF(self.filepath) as ncfile:
+            self.assertEqual(ncfile.read_slice("a"), [None, None, 1, 2, None, None])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_numpy_scalar_attribute(self):
+        with pyncf.NetCDFWriter(self.filepath) as writer:
+            writer.add_attribute("scale", numpy.float32(1.5), "NC_FLOAT")
+            writer.add_attribute("count", numpy.int16(3))
+            writer.add_attribute("range", numpy.array([1.0, 2.0]))
+        with pyncf.NetCDF(self.filepath) as ncfile:
+            attributes = dict((attdict["name"], attdict["values"]) for attdict in ncfile.header["gatt_list"])
+            self.assertEqual(attributes[b"scale"], 1.5)
+            self.assertEqual(attributes[b"count"], 3)
+            self.assertEqual(attributes[b"range"], (1.0, 2.0))
+
+
+class TestRead2D(GridTestCase):
+
+    def test_read_2d_data(self):
+        self.assertEqual(self.ncfile.read_2d_data("height"),
+                         [[height_value(y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))])
+        self.assertEqual(self.ncfile.read_2d_data("temp", time=3),
+                         [[expected_temp(3, y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))])
+
+    def test_transposed(self):
+        self.assertEqual(self.ncfile.read_2d_data("height", xdim="latitude", ydim="longitude"),
+                         [[height_value(y, x) for y in range(len(LATITUDES))] for x in range(len(LONGITUDES))])
+        self.assertEqual(self.ncfile.read_2d_data("temp", xdim="time", ydim="longitude", latitude=2),
+                         [[expected_temp(t, 2, x) for t in range(NUMRECS)] for x in range(len(LONGITUDES))])
+
+
+def expected_slice(value_func, start, count, stride):
+    # the nested values of a hyperslab, computed from the value at each index
+    def nest(indexes, dim):
+        if dim == len(start):
+            return value_func(*indexes)
+        return [nest(indexes + (start[dim] + i * stride[dim],), dim + 1) for i in range(count[dim])]
+    return nest((), 0)
+
+
+class TestReadSlice(GridTestCase):
+
+    selections = [([0, 0, 0], [NUMRECS, 4, 6], [1, 1, 1]),
+                  ([1, 0, 1], [2, 2, 2], [2, 3, 3]),
+                  ([4, 3, 5], [1, 1, 1], [1, 1, 1]),
+                  ([0, 1, 0], [3, 0, 2], [1, 1, 1]),
+                  ]
+
+    def test_read_slice(self):
+        for start,count,stride in self.selections:
+            self.assertEqual(self.ncfile.read_slice("temp", start, count, stride),
+                             expected_slice(expected_temp, start, count, stride))
+            self.assertEqual(self.ncfile.read_slice("height", start[1:], count[1:], stride[1:]),
+                             expected_slice(height_value, start[1:], count[1:], stride[1:]))
+
+    def test_defaults(self):
+        self.assertEqual(self.ncfile.read_slice("temp"), expected_slice(expected_temp, [0, 0, 0], [NUMRECS, 4, 6], [1, 1, 1]))
+        self.assertEqual(self.ncfile.read_slice("temp", [3, 2, 4]), expected_slice(expected_temp, [3, 2, 4], [2, 2, 2], [1, 1, 1]))
+        self.assertEqual(self.ncfile.read_slice("time", [1], stride=[2]), [31.0, 93.0])
+
+    def test_out_of_bounds(self):
+        self.assertRaises(Exception, self.ncfile.read_slice, "height", [0, 0], [5, 1])
+        self.assertRaises(Exception, self.ncfile.read_slice, "height", [0, 0], [1, 1], [0, 1])
+        self.assertRaises(Exception, self.ncfile.read_slice, "height", [0], [1])
+
+
+class TestMmap(GridTestCase):
+
+    def test_same_as_file_reads(self):
+        with pyncf.NetCDF(self.filepath, use_mmap=True) as mapped:
+            for start,count,stride in TestReadSlice.selections:
+                self.assertEqual(mapped.read_slice("temp", start, count, stride), self.ncfile.read_slice("temp", start, count, stride))
+            self.assertEqual(mapped.read_2d_data("height"), self.ncfile.read_2d_data("height"))
+            self.assertEqual(mapped.read_point_series("pres", latitude=2, longitude=3),
+                             self.ncfile.read_point_series("pres", latitude=2, longitude=3))
+
+    def test_data_buffer(self):
+        expected = struct.pack(">24i", *[height_value(y, x) for y in range(len(LATITUDES)) for x in range(len(LONGITUDES))])
+        self.assertEqual(bytes(self.ncfile.read_data_buffer("height")), expected)
+        with pyncf.NetCDF(self.filepath, use_mmap=True) as mapped:
+            self.assertEqual(bytes(mapped.read_data_buffer("height")), expected)
+        self.assertRaises(Exception, self.ncfile.read_data_buffer, "temp")
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestNumpy(GridTestCase):
+
+    def test_numpy_output(self):
+        values = self.ncfile.read_slice("temp", output="numpy")
+        self.assertEqual(values.shape, (NUMRECS, len(LATITUDES), len(LONGITUDES)))
+        self.assertEqual(values.tolist(), self.ncfile.read_slice("temp"))
+        self.assertEqual(int(values.mask.sum()), sum((temp_value(t, y, x) == -1 for t in range(NUMRECS)
+                                                     for y in range(len(LATITUDES)) for x in range(len(LONGITUDES)))))
+        grid = self.ncfile.read_2d_data("height", output="numpy")
+        self.assertEqual(grid.tolist(), self.ncfile.read_2d_data("height"))
+
+    def test_nan_mask(self):
+        with pyncf.NetCDF(self.filepath, mask="nan") as ncfile:
+            values = ncfile.read_slice("temp", output="numpy")
+        expected = numpy.array(expected_slice(expected_temp, [0, 0, 0], [NUMRECS, 4, 6], [1, 1, 1]), dtype=float)
+        self.assertTrue(numpy.array_equal(numpy.isnan(values), numpy.isnan(expected)))
+        self.assertTrue(numpy.allclose(values[~numpy.isnan(values)], expected[~numpy.isnan(expected)]))
+
+    def test_memmap(self):
+        memmap = self.ncfile.get_memmap("height")
+        self.assertEqual(memmap.shape, (len(LATITUDES), len(LONGITUDES)))
+        self.assertEqual(memmap.tolist(), self.ncfile.read_2d_data("height"))
+        self.assertRaises(Exception, self.ncfile.get_memmap, "temp")
+
+
+class TestPoints(GridTestCase):
+
+    def test_point_series(self):
+        self.assertEqual(self.ncfile.read_point_series("temp", latitude=1, longitude=2),
+                         [expected_temp(t, 1, 2) for t in range(NUMRECS)])
+        self.assertRaises(Exception, self.ncfile.read_point_series, "height", latitude=1, longitude=2)
+
+    def test_read_points(self):
+        points = [(4, 3, 5), (0, 0, 0), {"time": 2, "latitude": 1, "longitude": 1}, (0, 0, 1), (4, 3, 5)]
+        expected = [expected_temp(4, 3, 5), expected_temp(0, 0, 0), expected_temp(2, 1, 1), expected_temp(0, 0, 1), expected_temp(4, 3, 5)]
+        self.assertEqual(self.ncfile.read_points("temp", points), expected)
+        self.assertEqual(self.ncfile.read_points("temp", []), [])
+
+    def test_labelled_points(self):
+        self.assertEqual(self.ncfile.read_points("height", [(-30.0, 50.0), (10.0, 20.0)], labels=True),
+                         [height_value(3, 5), height_value(1, 2)])
+        self.assertEqual(self.ncfile.read_points("height", [(11.0, 19.0)], labels=True, method="nearest"), [height_value(1, 2)])
+        self.assertRaises(Exception, self.ncfile.read_points, "height", [(11.0, 19.0)], labels=True)
+
+
+class TestBoundingBox(GridTestCase):
+
+    def test_read_bbox(self):
+        self.assertEqual(self.ncfile.read_bbox("height", (5, -20, 35, 20)),
+                         [[height_value(y, x) for x in (1, 2, 3)] for y in (1, 2)])
+        self.assertEqual(self.ncfile.read_bbox("temp", (5, -20, 35, 20), time=1),
+                         [[expected_temp(1, y, x) for x in (1, 2, 3)] for y in (1, 2)])
+
+    def test_antimeridian(self):
+        # a box from 45 east across the seam to 5 east only covers the last and first columns
+        self.assertEqual(self.ncfile.read_bbox("height", (45, -40, 5, 40)),
+                         [[height_value(y, 5), height_value(y, 0)] for y in range(len(LATITUDES))])
+
+
+class TestBlockCache(GridTestCase):
+
+    def test_read(self):
+        data = bytes(bytearray(range(256))) * 4
+        reads = []
+        def read_file_at(offset, n):
+            reads.append((offset, n))
+            return data[offset:offset+n]
+        cache = pyncf.BlockCache(maxsize=64, blocksize=16)
+        self.assertEqual(cache.read("a", read_file_at, 10, 20), data[10:30])
+        self.assertEqual(reads, [(0, 32)])
+        self.assertEqual(cache.read("a", read_file_at, 20, 20), data[20:40])
+        self.assertEqual(reads, [(0, 32), (32, 16)])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        # other files do not share blocks, and the least recently used are evicted
+        self.assertEqual(cache.read("b", read_file_at, 96, 30), data[96:126])
+        self.assertTrue(cache.size <= cache.maxsize)
+        self.assertEqual(cache.read("a", read_file_at, 0, 16), data[:16])
+        self.assertEqual(reads[-1], (0, 16))
+        # large reads bypass the cache
+        self.assertEqual(cache.read("a", read_file_at, 0, 100), data[:100])
+        self.assertEqual(reads[-1], (0, 100))
+
+    def test_shared_cache(self):
+        cache = pyncf.BlockCache(maxsize=4096, blocksize=64)
+        with pyncf.NetCDF(self.filepath, cache=cache) as first:
+            with pyncf.NetCDF(self.filepath, cache=cache) as second:
+                self.assertEqual(first.read_slice("temp"), self.ncfile.read_slice("temp"))
+                hits = cache.hits
+                self.assertEqual(second.read_slice("temp"), self.ncfile.read_slice("temp"))
+                self.assertTrue(cache.hits > hits)
+
+
+@unittest.skipIf(pyncf.futures is None, "concurrent.futures is not installed")
+class TestConcurrentReads(GridTestCase):
+
+    def test_read_slices(self):
+        requests = [("temp", [t, 0, 0], [1, 4, 6], None) for t in range(NUMRECS)]
+        requests.append(dict(varname="height", start=[1, 1], count=[2, 2], stride=[2, 3]))
+        expected = [expected_slice(expected_temp, [t, 0, 0], [1, 4, 6], [1, 1, 1]) for t in range(NUMRECS)]
+        expected.append(expected_slice(height_value, [1, 1], [2, 2], [2, 3]))
+        for max_workers in (1, 4):
+            self.assertEqual(self.ncfile.read_slices(requests, max_workers=max_workers), expected)
+
+    def test_shared_between_threads(self):
+        def read_all(t):
+            return self.ncfile.read_slice("temp", [t, 0, 0], [1, 4, 6])
+        with pyncf.futures.ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(read_all, list(range(NUMRECS)) * 4))
+        self.assertEqual(results, [expected_slice(expected_temp, [t, 0, 0], [1, 4, 6], [1, 1, 1]) for t in range(NUMRECS)] * 4)
+
+
+class TestRecords(GridTestCase):
+
+    def test_iter_records(self):
+        records = list(self.ncfile.iter_records())
+        self.assertEqual([index for index,_ in records], list(range(NUMRECS)))
+        for t,record in records:
+            self.assertEqual(list(record), [b"time", b"temp", b"pres"])
+            self.assertEqual(record[b"time"], t * 31.0)
+            self.assertEqual(record[b"temp"], expected_slice(expected_temp, [t, 0, 0], [1, 4, 6], [1, 1, 1])[0])
+
+    def test_range_and_variables(self):
+        records = list(self.ncfile.iter_records(["temp"], start=3))
+        self.assertEqual([index for index,_ in records], [3, 4])
+        self.assertEqual(list(records[0][1]), [b"temp"])
+        self.assertEqual(list(self.ncfile.iter_records(["time"], start=1, stop=3)), [(1, {b"time": 31.0}), (2, {b"time": 62.0})])
+        self.assertRaises(Exception, list, self.ncfile.iter_records(["height"]))
+
+
+class TestMasking(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tempdir, "masked.nc")
+        with pyncf.NetCDFWriter(self.filepath) as writer:
+            writer.add_dimension("x", 8)
+            writer.add_variable("a", "NC_SHORT", ["x"], {"missing_value": [7, 8], "valid_range": [0, 100]})
+            writer.add_variable("b", "NC_FLOAT", ["x"], {"valid_min": 1.0})
+            writer.add_variable("c", "NC_BYTE", ["x"], {"_FillValue": 5, "add_offset": 10.0})
+            writer.write_variable("a", [0, 7, 8, 100, 101, -1, 50, -32767])
+            writer.write_variable("b", [0, 1, 2, 3, 4, 5, 6, 7])
+            writer.write_variable("c", [0, 1, 2, 3, 4, 5, 6, 7])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_masked(self):
+        with pyncf.NetCDF(self.filepath) as ncfile:
+            self.assertEqual(ncfile.read_slice("a"), [0, None, None, 100, None, None, 50, None])
+            self.assertEqual(ncfile.read_slice("b"), [None, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0])
+            self.assertEqual(ncfile.read_slice("c"), [10.0, 11.0, 12.0, 13.0, 14.0, None, 16.0, 17.0])
+
+    def test_unmasked(self):
+        with pyncf.NetCDF(self.filepath, mask=False) as ncfile:
+            self.assertEqual(ncfile.read_slice("a"), [0, 7, 8, 100, 101, -1, 50, -32767])
+            self.assertEqual(ncfile.read_slice("c"), [10.0 + value for value in range(8)])
+
+    def test_nan(self):
+        with pyncf.NetCDF(self.filepath, mask="nan") as ncfile:
+            values = ncfile.read_slice("c")
+        self.assertTrue(values[5] != values[5])
+        self.assertEqual(values[:5] + values[6:], [10.0, 11.0, 12.0, 13.0, 14.0, 16.0, 17.0])
+
+    def test_invalid_mode(self):
+        self.assertRaises(Exception, pyncf.NetCDF, self.filepath, mask="none")
+
+
+class TestPacked(GridTestCase):
+
+    def test_packed_output(self):
+        packed = self.ncfile.read_slice("temp", [1, 0, 0], [2, 4, 6], output="packed")
+        self.assertEqual(packed.typecode, "h")
+        self.assertEqual(packed.shape, (2, 4, 6))
+        self.assertEqual(packed.tolist(), [temp_value(t, y, x) for t in (1, 2) for y in range(4) for x in range(6)])
+        self.assertEqual(packed.scale_factor, 0.5)
+        self.assertEqual(packed.missing_values, frozenset([-1]))
+
+    def test_decode(self):
+        packed = self.ncfile.read_2d_data("temp", time=2, output="packed")
+        self.assertEqual(packed.decode(), self.ncfile.read_2d_data("temp", time=2))
+        self.assertEqual(packed.encode(61.5), 123)
+        decoded = packed.decode("array")
+        self.assertEqual(decoded.shape, (4, 6))
+        for value,expected in zip(decoded, [expected_temp(2, y, x) for y in range(4) for x in range(6)]):
+            if expected is None:
+                self.assertTrue(value != value)
+            else:
+                self.assertEqual(value, expected)
+
+
+class TestGridArray(GridTestCase):
+
+    def test_array_output(self):
+        grid = self.ncfile.read_2d_data("height", output="array")
+        self.assertTrue(isinstance(grid, pyncf.GridArray))
+        self.assertEqual(grid.shape, (len(LATITUDES), len(LONGITUDES)))
+        self.assertEqual([row.tolist() for row in grid.rows()], self.ncfile.read_2d_data("height"))
+        self.assertEqual(grid.row(2).tolist(), [float(height_value(2, x)) for x in range(len(LONGITUDES))])
+        self.assertEqual(len(grid.tobytes()), len(grid) * grid.itemsize)
+
+    def test_masked_values_are_nan(self):
+        values = self.ncfile.read_slice("temp", output="array")
+        self.assertEqual(values.shape, (NUMRECS, len(LATITUDES), len(LONGITUDES)))
+        expected = [expected_temp(t, y, x) for t in range(NUMRECS) for y in range(len(LATITUDES)) for x in range(len(LONGITUDES))]
+        self.assertEqual([value != value for value in values], [value is None for value in expected])
+        self.assertEqual([value for value in values if value == value], [value for value in expected if value is not None])
+
+
+class TestMultiNetCDF(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filepaths = []
+        for i,records in enumerate(([0, 1], [], [2, 3, 4])):
+            filepath = os.path.join(self.tempdir, "part%s.nc" % i)
+            write_grid(filepath, records)
+            self.filepaths.append(filepath)
+        self.dataset = pyncf.MultiNetCDF(os.path.join(self.tempdir, "part*.nc"), max_open=2)
+
+    def tearDown(self):
+        self.dataset.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_records(self):
+        self.assertEqual(self.dataset.numrecs, NUMRECS)
+        self.assertEqual(self.dataset.read_dimension_values("time"), [t * 31.0 for t in range(NUMRECS)])
+        self.assertEqual(self.dataset.read_dimension_values("latitude"), LATITUDES)
+
+    def test_read_across_files(self):
+        for start,count,stride in TestReadSlice.selections:
+            self.assertEqual(self.dataset.read_slice("temp", start, count, stride),
+                             expected_slice(expected_temp, start, count, stride))
+        self.assertEqual(self.dataset.read_point_series("temp", latitude=2, longitude=1),
+                         [expected_temp(t, 2, 1) for t in range(NUMRECS)])
+        self.assertEqual(self.dataset.read_2d_data("temp", time=3),
+                         [[expected_temp(3, y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))])
+        self.assertEqual([(index, record[b"time"]) for index,record in self.dataset.iter_records(["time"], start=1)],
+                         [(t, t * 31.0) for t in range(1, NUMRECS)])
+
+    def test_read_2d_data(self):
+        self.assertEqual(self.dataset.read_2d_data("height"),
+                         [[height_value(y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))])
+        for t in range(NUMRECS):
+            self.assertEqual(self.dataset.read_2d_data("temp", time=t),
+                             [[expected_temp(t, y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))])
+        self.assertRaises(Exception, self.dataset.read_2d_data, "temp", xdim="longitude", ydim="time", latitude=0)
+
+    def test_mismatched_files(self):
+        filepath = os.path.join(self.tempdir, "other.nc")
+        with pyncf.NetCDFWriter(filepath) as writer:
+            writer.add_dimension("time")
+            writer.add_variable("time", "NC_DOUBLE", ["time"])
+        self.assertRaises(Exception, pyncf.MultiNetCDF, self.filepaths + [filepath])
+
+
+@unittest.skipIf(netCDF4 is None, "netCDF4 is not installed")
+class TestCDF5(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tempdir, "cdf5.nc")
+        dataset = write_grid_netcdf4(self.filepath, "NETCDF3_64BIT_DATA")
+        dataset.createVariable("unsigned", "u4", ("latitude", "longitude"))[:] = \
+            [[2**31 + height_value(y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))]
+        dataset.createVariable("int64", "i8", ("time", "latitude"))[:] = [[(t - y) * 2**40 for y in range(len(LATITUDES))] for t in range(NUMRECS)]
+        dataset.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_read(self):
+        for use_mmap in (False, True):
+            with pyncf.NetCDF(self.filepath, use_mmap=use_mmap) as ncfile:
+                self.assertEqual(ncfile.header["magic"][-1], "64-bit data format")
+                for start,count,stride in TestReadSlice.selections:
+                    self.assertEqual(ncfile.read_slice("temp", start, count, stride),
+                                     expected_slice(expected_temp, start, count, stride))
+                self.assertEqual(ncfile.read_2d_data("height"),
+                                 [[height_value(y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))])
+
+    def test_64bit_types(self):
+        with pyncf.NetCDF(self.filepath) as ncfile:
+            self.assertEqual(ncfile.read_slice("unsigned", [3, 4], [1, 2]), [[2**31 + height_value(3, x) for x in (4, 5)]])
+            self.assertEqual(ncfile.read_slice("int64"), [[(t - y) * 2**40 for y in range(len(LATITUDES))] for t in range(NUMRECS)])
+            self.assertEqual(ncfile.read_points("int64", [(4, 0), (0, 3)]), [4 * 2**40, -3 * 2**40])
+
+
+@unittest.skipIf(netCDF4 is None, "netCDF4 is not installed")
+class TestNetCDF4(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tempdir, "netcdf4.nc")
+        write_grid_netcdf4(self.filepath, "NETCDF4", zlib=True).close()
+        self.chunked = os.path.join(self.tempdir, "chunked.nc")
+        dataset = netCDF4.Dataset(self.chunked, "w", format="NETCDF4")
+        dataset.createDimension("time", None)
+        dataset.createDimension("latitude", len(LATITUDES))
+        dataset.createDimension("longitude", len(LONGITUDES))
+        temp = dataset.createVariable("temp", "i2", ("time", "latitude", "longitude"), fill_value=-1,
+                                      zlib=True, shuffle=True, chunksizes=(2, 3, 4))
+        temp.set_auto_maskandscale(False)
+        temp[:] = [[[temp_value(t, y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))] for t in range(NUMRECS)]
+        dataset.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_read(self):
+        for use_mmap in (False, True):
+            with pyncf.NetCDF(self.filepath, use_mmap=use_mmap) as ncfile:
+                self.assertEqual(ncfile.header["magic"][-1], "NetCDF-4 format")
+                self.assertEqual(ncfile.get_record_dimension()["name"], b"time")
+                self.assertEqual(ncfile.read_dimension_values("latitude"), LATITUDES)
+                for start,count,stride in TestReadSlice.selections:
+                    self.assertEqual(ncfile.read_slice("temp", start, count, stride),
+                                     expected_slice(expected_temp, start, count, stride))
+                self.assertEqual(ncfile.read_2d_data("height"),
+                                 [[height_value(y, x) for x in range(len(LONGITUDES))] for y in range(len(LATITUDES))])
+
+    def test_partial_chunks(self):
+        # chunks overhang the ends of the latitude and longitude dimensions, and the last record
+        with pyncf.NetCDF(self.chunked, mask=False) as ncfile:
+            self.assertEqual(ncfile.read_slice("temp"), expected_slice(temp_value, [0, 0, 0], [NUMRECS, 4, 6], [1, 1, 1]))
+            self.assertEqual(ncfile.read_slice("temp", [1, 1, 1], [2, 3, 2], [2, 1, 4]),
+                             expected_slice(temp_value, [1, 1, 1], [2, 3, 2], [2, 1, 4]))
+            self.assertEqual(ncfile.read_point_series("temp", latitude=3, longitude=5), [temp_value(t, 3, 5) for t in range(NUMRECS)])
+
+    def test_header_cache(self):
+        for _ in range(2):
+            with pyncf.NetCDF(self.chunked, mask=False, header_cache=self.tempdir) as ncfile:
+                self.assertEqual(ncfile.read_slice("temp", [4, 0, 0], [1, 1, 6]), [[[temp_value(4, 0, x) for x in range(6)]]])
+
+
+class TestVariable(GridTestCase):
+
+    def test_index_and_slices(self):
+        temp = self.ncfile.variables["temp"]
+        self.assertEqual(temp.shape, (NUMRECS, len(LATITUDES), len(LONGITUDES)))
+        self.assertEqual(temp[2, 1, 3], expected_temp(2, 1, 3))
+        self.assertEqual(temp[-1, 0, ::2], [expected_temp(4, 0, x) for x in range(0, 6, 2)])
+
+    def test_negative_step(self):
+        height = self.ncfile.variables["height"]
+        row = [height_value(1, x) for x in range(len(LONGITUDES))]
+        self.assertEqual(height[1, ::-1], row[::-1])
+        self.assertEqual(height[1, 4:0:-2], row[4:0:-2])
+        self.assertEqual(height[1, 3:2:-1], row[3:2:-1])
+        self.assertEqual(height[1, slice(5, 6, -1)], [])
+        self.assertEqual(height[::-1, 0], [height_value(y, 0) for y in reversed(range(len(LATITUDES)))])
+
+
+class TestLabels(GridTestCase):
+
+    def test_sel(self):
+        self.assertEqual(self.ncfile.sel("temp", time=62.0, latitude=10.0, longitude=30.0), expected_temp(2, 1, 3))
+        self.assertEqual(self.ncfile.sel("height", method="nearest", latitude=-12, longitude=(15, 35)),
+                         [height_value(2, x) for x in (2, 3)])
+
+    def test_sel_descending_range(self):
+        # latitudes are descending, and the range can be given in either order
+        expected = [[height_value(y, 0)] for y in (0, 1, 2)]
+        self.assertEqual(self.ncfile.sel("height", latitude=slice(-10, 30), longitude=(0, 0)), expected)
+        self.assertEqual(self.ncfile.sel("height", latitude=slice(30, -10), longitude=(0, 0)), expected)
+        self.assertEqual(self.ncfile.sel("height", latitude=(60, -30), longitude=(0, 0)), [[height_value(y, 0)] for y in range(4)])
+
+
+class TestOverviews(GridTestCase):
+
+    def test_stored_overview(self):
+        direct = self.ncfile.read_overview("height", 2)
+        self.assertEqual(direct, [[height_value(y, x) for x in range(0, 6, 2)] for y in range(0, 4, 2)])
+        self.ncfile.build_overviews("height", factors=(2,))
+        self.assertTrue(os.path.exists(self.filepath + ".ovr"))
+        stored = self.ncfile.read_overview("height", 2)
+        self.assertEqual(stored, direct)
+        self.assertTrue(all(( type(value) is type(direct[0][0]) for row in stored for value in row )))
+
+    def test_stored_overview_mask_mode(self):
+        self.ncfile.build_overviews("temp", factors=(1,), time=0)
+        with pyncf.NetCDF(self.filepath, mask=False) as unmasked:
+            expected = [[temp_value(0, y, x) * 0.5 for x in range(6)] for y in range(4)]
+            self.assertEqual(unmasked.read_overview("temp", 1, time=0), expected)
+        with pyncf.NetCDF(self.filepath) as masked:
+            expected = [[expected_temp(0, y, x) for x in range(6)] for y in range(4)]
+            self.assertEqual(masked.read_overview("temp", 1, time=0), expected)
+
+    def test_corrupt_overview_file(self):
+        with open(self.filepath + ".ovr", "wb") as fileobj:
+            fileobj.write(b"\x80\x02}q")
+        self.assertEqual(self.ncfile.read_overview("height", 2), [[height_value(y, x) for x in range(0, 6, 2)] for y in range(0, 4, 2)])
+
+    def test_pickled_overview_file(self):
+        # an overview file is never unpickled, so it cannot run code
+        marker = os.path.join(self.tempdir, "unpickled")
+        with open(self.filepath + ".ovr", "wb") as fileobj:
+            fileobj.write(b"cos\nmkdir\n(S'%s'\ntR." % marker.encode("utf8"))
+        self.assertEqual(self.ncfile.read_overview("height", 2), [[height_value(y, x) for x in range(0, 6, 2)] for y in range(0, 4, 2)])
+        self.assertFalse(os.path.exists(marker))
+
+    def test_truncated_overview_file(self):
+        self.ncfile.build_overviews("height", factors=(2,))
+        with open(self.filepath + ".ovr", "rb") as fileobj:
+            data = fileobj.read()
+        for size in (4, 20, len(data) - 8):
+            with open(self.filepath + ".ovr", "wb") as fileobj:
+                fileobj.write(data[:size])
+            with pyncf.NetCDF(self.filepath) as ncfile:
+                self.assertEqual(ncfile._backend.load_overviews(), dict())
+
+
+class TestHeaderCache(GridTestCase):
+
+    def open_cached(self):
+        with pyncf.NetCDF(self.filepath, header_cache=self.tempdir) as ncfile:
+            return ncfile.read_slice("height")
+
+    def test_round_trip(self):
+        expected = self.ncfile.read_slice("height")
+        self.assertEqual(self.open_cached(), expected)
+        self.assertEqual(len([name for name in os.listdir(self.tempdir) if name.endswith(".hdr")]), 1)
+        self.assertEqual(self.open_cached(), expected)
+
+    def test_corrupt_cache_file(self):
+        expected = self.ncfile.read_slice("height")
+        self.open_cached()
+        cachepath = pyncf._calc_header_cache_path(self.filepath, self.tempdir)
+        stat = os.stat(self.filepath)
+        stored = dict(source=(stat.st_size, stat.st_mtime), path=os.path.realpath(self.filepath), header=None, layouts=None)
+        for data in (b"\x80\x02}q", pyncf.pickle.dumps([1, 2], 2), pyncf.pickle.dumps(stored, 2)):
+            with open(cachepath, "wb") as fileobj:
+                fileobj.write(data)
+            self.assertEqual(self.open_cached(), expected)
+            # and is stored again
+            self.assertEqual(pyncf._load_header_cache(cachepath, self.filepath, stored["source"])["path"], stored["path"])
+
+    def test_unwritable_cache(self):
+        expected = self.ncfile.read_slice("height")
+        with pyncf.NetCDF(self.filepath, header_cache=os.path.join(self.tempdir, "missing")) as ncfile:
+            self.assertEqual(ncfile.read_slice("height"), expected)
+        # a directory in the way of the cache file cannot be replaced
+        os.mkdir(pyncf._calc_header_cache_path(self.filepath, self.tempdir))
+        self.assertEqual(self.open_cached(), expected)
+        self.assertEqual([name for name in os.listdir(self.tempdir) if name.endswith(".tmp")], [])
+
+
+class TestStatistics(GridTestCase):
+
+    def packed_temps(self, t):
+        return [temp_value(t, y, x) for y in range(len(LATITUDES)) for x in range(len(LONGITUDES))
+                if temp_value(t, y, x) != -1]
+
+    def test_band_statistics(self):
+        values = self.packed_temps(1)
+        stats = self.ncfile.get_band_statistics("temp", band=2, bins=4)
+        self.assertEqual(stats["count"], len(values))
+        self.assertEqual((stats["minimum"], stats["maximum"]), (min(values), max(values)))
+        self.assertAlmostEqual(stats["mean"], sum(values) / float(len(values)))
+        self.assertEqual(sum(stats["histogram"]["counts"]), len(values))
+        self.assertFalse(os.path.exists(self.filepath + ".aux.xml"))
+
+    def test_saved_statistics(self):
+        computed = self.ncfile.get_band_statistics("temp", band=2, bins=4, save=True)
+        self.assertTrue(os.path.exists(self.filepath + ".aux.xml"))
+        stored = self.ncfile.read_pam_statistics("temp", 2)
+        self.assertEqual(sorted(stored), sorted(computed))
+        self.assertEqual(stored["count"], computed["count"])
+        self.assertEqual(stored["histogram"], computed["histogram"])
+        self.assertEqual(self.ncfile.get_band_statistics("temp", band=2, bins=4), stored)
+        # only the keys that gdal writes, with the count as a percentage of the band
+        root = pyncf.ElementTree.parse(self.filepath + ".aux.xml").getroot()
+        self.assertEqual(sorted(mdi.get("key") for mdi in root.iter("MDI")),
+                         ["STATISTICS_MAXIMUM", "STATISTICS_MEAN", "STATISTICS_MINIMUM", "STATISTICS_STDDEV", "STATISTICS_VALID_PERCENT"])
+        percent = float(root.find(".//MDI[@key='STATISTICS_VALID_PERCENT']").text)
+        self.assertAlmostEqual(percent, 100.0 * computed["count"] / (len(LATITUDES) * len(LONGITUDES)))
+
+    def test_gdal_infinities(self):
+        with open(self.filepath + ".aux.xml", "w") as fileobj:
+            fileobj.write('<PAMDataset><Subdataset name="temp"><PAMDataset><PAMRasterBand band="1">'
+                          '<Histograms><HistItem><HistMin>1.#INF</HistMin><HistMax>-1.#INF</HistMax>'
+                          '<BucketCount>2</BucketCount><HistCounts>0|0</HistCounts></HistItem></Histograms>'
+                          '<Metadata><MDI key="STATISTICS_MEAN">-1.#IND</MDI></Metadata>'
+                          '</PAMRasterBand></PAMDataset></Subdataset></PAMDataset>')
+        stored = self.ncfile.read_pam_statistics("temp", 1)
+        self.assertEqual(stored["histogram"], dict(min=float("inf"), max=float("-inf"), counts=[0, 0]))
+        self.assertNotEqual(stored["mean"], stored["mean"])
+        self.assertIsNone(stored["count"])
+        # incomplete statistics are computed instead
+        self.assertEqual(self.ncfile.get_band_statistics("temp", band=1)["count"], len(self.packed_temps(0)))
+
+    def test_unwritable_pam_file(self):
+        with open(self.filepath + ".aux.xml", "w") as fileobj:
+            fileobj.write("<PAMDataset")
+        self.assertIsNone(self.ncfile.read_pam_statistics("temp", 1))
+        stats = self.ncfile.get_band_statistics("temp", band=1, save=True)
+        self.assertEqual(stats["count"], len(self.packed_temps(0)))
+        with open(self.filepath + ".aux.xml") as fileobj:
+            self.assertEqual(fileobj.read(), "<PAMDataset")
+        os.remove(self.filepath + ".aux.xml")
+        os.mkdir(self.filepath + ".aux.xml.tmp")
+        stats = self.ncfile.get_band_statistics("temp", band=1, save=True)
+        self.assertEqual(stats["count"], len(self.packed_temps(0)))
+
+
+class TestAggregate(GridTestCase):
+
+    def expected_means(self, masked):
+        means = []
+        for y in range(len(LATITUDES)):
+            for x in range(len(LONGITUDES)):
+                values = [temp_value(t, y, x) * 0.5 for t in range(NUMRECS)
+                          if not (masked and temp_value(t, y, x) == -1)]
+                means.append(sum(values) / float(len(values)) if values else None)
+        return means
+
+    def assertGridAlmostEqual(self, rows, expected):
+        values = [value for row in rows for value in row]
+        self.assertEqual(len(values), len(expected))
+        for value,expectedvalue in zip(values, expected):
+            if expectedvalue is None:
+                self.assertIsNone(value)
+            else:
+                self.assertAlmostEqual(value, expectedvalue)
+
+    def test_monthly(self):
+        result = self.ncfile.aggregate("pres", stat="max", groupby="month", max_workers=1)
+        self.assertEqual(sorted(result), [1, 2, 3, 4, 5])
+        self.assertAlmostEqual(result[3][1][2], pres_value(2, 1, 2), 4)
+
+    def test_masked(self):
+        for workers in (1, 2):
+            result = self.ncfile.aggregate("temp", groupby="all", max_workers=workers)
+            self.assertGridAlmostEqual(result[None], self.expected_means(True))
+
+    def test_unmasked(self):
+        with pyncf.NetCDF(self.filepath, mask=False) as unmasked:
+            for workers in (1, 2):
+                result = unmasked.aggregate("temp", groupby="all", max_workers=workers)
+                self.assertGridAlmostEqual(result[None], self.expected_means(False))
+
+    def test_masked_times(self):
+        filepath = os.path.join(self.tempdir, "times.nc")
+        with pyncf.NetCDFWriter(filepath) as writer:
+            writer.add_dimension("time")
+            writer.add_variable("time", "NC_DOUBLE", ["time"], {"units": "days since 2000-01-01", "_FillValue": -1.0})
+            writer.add_variable("value", "NC_FLOAT", ["time"])
+            for time,value in ((0.0, 1.0), (None, 100.0), (31.0, 2.0), (45.0, 4.0)):
+                writer.append_record({"time": [time], "value": [value]})
+        for mask in (True, "nan"):
+            with pyncf.NetCDF(filepath, mask=mask) as ncfile:
+                times = ncfile.read_dimension_times("time")
+                self.assertEqual([time.day if time else None for time in times], [1, None, 1, 15])
+                for workers in (1, 2):
+                    self.assertEqual(ncfile.aggregate("value", groupby="month", max_workers=workers), {1: 1.0, 2: 3.0})
+
+
+if __name__ == "__main__":
+    unittest.main()